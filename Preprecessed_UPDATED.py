@@ -1,10 +1,135 @@
+import copy
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
 from abc import ABC, abstractmethod
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from bson import json_util
 from pymongo import MongoClient
+from pymongo.read_preferences import Nearest, Secondary, SecondaryPreferred
+from pymongo.errors import ConnectionFailure, CursorNotFound, ExecutionTimeout, OperationFailure
+from normalization import normalize_labs, normalize_vitals
+from trends import add_trends
+from comeasure import co_labs_stage, draw_stage, join_draws
+from demographics import DemographicsCache
+from analytes import lab_tests
+from streaming_stats import clean_parts, collect_stats, part_paths
+from targets import BinEdges, build_targets, fit_edges
+from features import FeatureMatrix
+from bson_arrow import FACET_SCHEMAS, arrow_pipeline, decode_batch
+from snapshots import Snapshot, code_digest, dataset_checksums, digest, source_version
+from optimizer import optimize, optimize_pipeline
+from timelines import timeline_collection, timeline_version
 
 class PreprocessedLabs(ABC):
     # Class variable for MongoDB connection
     client = MongoClient('mongodb://localhost:27017/')
     db = client['your_database_name']
+    collection = db['your_collection_name']
+
+    # Number of stable PatientID hash buckets used for sampling
+    sample_buckets = 10000
+
+    # Local output layout: <output_dir>/<lab name>/<facet>/part-NNNNN.parquet
+    output_dir = 'output'
+    batch_size = 10000
+
+    # Extraction parameters: a lab pair is two results 80 to 100 days apart;
+    # vitals and diagnoses are looked back from the earlier lab of the pair
+    pair_window_days = (80, 101)
+    vitals_lookback_days = 350
+    diagnosis_lookback_years = 2
+
+    # Trend mode: the labs and co-measurement facets also carry every lab of
+    # the analyte before lab_before.date as lab_history, reduced to trend.*
+    # columns per batch. Set per instance through the constructor, since it
+    # shapes the base pipeline built there
+    trend_features = False
+
+    # Labs of other analytes count as drawn with a lab of the pair when they
+    # are at most this far from it
+    draw_tolerance_hours = 24
+
+    # Facet runs reuse an immutable snapshot when pipeline, parameters, source
+    # and batch stages all match; source_version overrides the detected one
+    use_snapshots = True
+    source_version = None
+
+    # Aggregations run over _id-ordered chunks of chunk_size documents with a
+    # checkpoint after each chunk; a chunk that fails on a transient error is
+    # retried up to max_retries times, backing off exponentially within
+    # retry_backoff seconds
+    chunk_size = 20000
+    max_retries = 8
+    retry_backoff = (1, 60)
+    # Elections, shutdowns and time limits surface as these server error codes
+    retryable_codes = {6, 7, 43, 50, 89, 91, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436}
+
+    # Read routing for the extraction reads. read_preference names a secondary
+    # mode, read_tags selects tagged members (e.g. [{'nodeType': 'ANALYTICS'}])
+    # and max_staleness_seconds (90 or more) bounds their replication lag.
+    # Hidden members are invisible to replica set discovery, so an analytics
+    # member that is hidden is reached directly through analytics_uri
+    read_preference = None
+    read_tags = None
+    max_staleness_seconds = -1
+    analytics_uri = None
+    read_modes = {
+        'secondary': Secondary,
+        'secondaryPreferred': SecondaryPreferred,
+        'nearest': Nearest
+    }
+
+    # With a cluster_time every read is a snapshot read at that time, so all
+    # facets of a run (including runs in other processes given the same time)
+    # see the same data. Members must keep that much history:
+    # minSnapshotHistoryWindowInSeconds has to cover the length of the run
+    cluster_time = None
+
+    # 'arrow' decodes raw BSON batches into the declared columns of each facet
+    # (bson_arrow.FACET_SCHEMAS) instead of building a dict per document.
+    # Medications are left out: pymongoarrow builds their nested list of
+    # records more slowly than the C decoder builds dicts
+    decoder = 'python'
+    arrow_facets = ['labs', 'vitals', 'diagnosis']
+
+    # Pipelines are rewritten before they run (fused stages, merged filters,
+    # pruned fields, earlier $match; see optimizer.py). With an
+    # optimizer_sample the rewrite is first timed against the pipeline as
+    # written on that many documents and dropped if their results differ, at
+    # the cost of four sample aggregations per new pipeline; 0 skips the check
+    optimize_pipelines = True
+    optimizer_sample = 0
+
+    # Facets read their pairs from the lab timelines kept by timelines.py
+    # instead of selecting them from lab_results; the patient fields are
+    # looked up by _id. Snapshots of these runs are keyed by the timeline
+    # version as well
+    read_timelines = False
+    timeline_facets = ['labs', 'diagnosis', 'vitals', 'medications']
+
+    # Dry runs (estimate) run the facets on a hashed sample of about
+    # estimate_sample documents and scale up what they measured. The
+    # recommended batch_size keeps a batch near target_batch_bytes in memory
+    # and the recommended chunk_size makes a chunk take target_chunk_seconds.
+    # Demo is measured from the sampled labs with an empty demographics cache
+    estimate_sample = 2000
+    estimate_facets = ['labs', 'diagnosis', 'vitals', 'medications', 'demo']
+    target_batch_bytes = 32 * 2 ** 20
+    target_chunk_seconds = 60
+
+    # Vectorized stages applied to every batch of a facet before it is written
+    batch_stages = {
+        'labs': [normalize_labs, add_trends],
+        'sweep': [normalize_labs],
+        'co_measurements': [normalize_labs, add_trends, join_draws],
+        'vitals': [normalize_vitals]
+    }
 
     # Private base pipeline
     __base_pipeline = [
@@ -159,86 +284,915 @@ class PreprocessedLabs(ABC):
                     '$size': 2
                 }
             }
-        }, {
-            '$project': {
-                'PatientID': 1, 
-                'Practice': 1, 
-                'lab_after': {
-                    '$arrayElemAt': [
-                        '$valid_labs', 0
-                    ]
-                }, 
-                'lab_before': {
-                    '$arrayElemAt': [
-                        '$valid_labs', 1
-                    ]
+        }
+    ]
+
+    __history_stage = {
+        '$set': {
+            'lab_history': {
+                '$map': {
+                    'input': {
+                        '$filter': {
+                            'input': '$lab_results', 
+                            'as': 'lab', 
+                            'cond': {
+                                '$lt': [
+                                    '$$lab.date', {
+                                        '$arrayElemAt': [
+                                            '$valid_labs.date', 1
+                                        ]
+                                    }
+                                ]
+                            }
+                        }
+                    }, 
+                    'as': 'lab', 
+                    'in': {
+                        'date': '$$lab.date', 
+                        'result': '$$lab.result', 
+                        'unit': '$$lab.unit', 
+                        'range': '$$lab.range'
+                    }
                 }
-            }
-        }, {
-            '$project': {
-                'PatientID': 1, 
-                'Practice': 1, 
-                'lab_after': {
-                    'date': '$lab_after.date', 
-                    'result': '$lab_after.result', 
-                    'unit': '$lab_after.unit', 
-                    'range': '$lab_after.range', 
-                    'api_test_name': '$lab_after.api_test_name'
-                }, 
-                'lab_before': {
-                    'date': '$lab_before.date', 
-                    'result': '$lab_before.result', 
-                    'unit': '$lab_before.unit', 
-                    'range': '$lab_before.range', 
-                    'api_test_name': '$lab_before.api_test_name'
+            }, 
+            'lab_results': '$$REMOVE'
+        }
+    }
+
+    @classmethod
+    def create_sample_index(cls):
+        # Stores a stable hash bucket of PatientID on every document so that
+        # sampling is a plain indexed range match instead of a collection scan
+        cls.collection.update_many(
+            {'sample_bucket': {'$exists': False}},
+            [
+                {
+                    '$set': {
+                        'sample_bucket': {
+                            '$mod': [
+                                {
+                                    '$add': [
+                                        {
+                                            '$mod': [
+                                                {
+                                                    '$toHashedIndexKey': '$PatientID'
+                                                }, cls.sample_buckets
+                                            ]
+                                        }, cls.sample_buckets
+                                    ]
+                                }, cls.sample_buckets
+                            ]
+                        }
+                    }
                 }
+            ]
+        )
+        cls.collection.create_index([('sample_bucket', 1)])
+        cls.collection.create_index([('Practice', 1), ('sample_bucket', 1)])
+
+    @classmethod
+    def get_sample_stage(cls, sample_fraction, stratify_by_practice=False):
+        if not 0 < sample_fraction <= 1:
+            raise ValueError('sample_fraction must be in (0, 1]')
+        if not stratify_by_practice:
+            return {
+                '$match': {
+                    'sample_bucket': {
+                        '$lt': int(round(sample_fraction * cls.sample_buckets))
+                    }
+                }
+            }
+        return {
+            '$match': {
+                '$or': [
+                    {
+                        'Practice': practice, 
+                        'sample_bucket': {
+                            '$lt': threshold
+                        }
+                    } for practice, threshold in cls.__practice_thresholds(sample_fraction).items()
+                ]
             }
         }
-    ]
 
     @classmethod
-    def get_base_pipeline(cls, api_test_name, api_test_names, new_api_test_name):
-        pipeline = cls.__base_pipeline.copy()
+    def __practice_thresholds(cls, sample_fraction):
+        # Per practice, the lowest bucket bound that keeps at least the
+        # requested fraction (and at least one patient) of that practice
+        cursor = cls.collection.aggregate([
+            {
+                '$group': {
+                    '_id': {
+                        'practice': '$Practice', 
+                        'bucket': '$sample_bucket'
+                    }, 
+                    'count': {
+                        '$sum': 1
+                    }
+                }
+            }
+        ], allowDiskUse=True, hint=[('Practice', 1), ('sample_bucket', 1)])
+        counts = {}
+        for row in cursor:
+            counts.setdefault(row['_id'].get('practice'), []).append((row['_id']['bucket'], row['count']))
+        thresholds = {}
+        for practice, buckets in counts.items():
+            buckets.sort()
+            wanted = max(1, round(sample_fraction * sum(count for _, count in buckets)))
+            seen = 0
+            for bucket, count in buckets:
+                seen += count
+                if seen >= wanted:
+                    thresholds[practice] = bucket + 1
+                    break
+        return thresholds
+
+    @classmethod
+    def get_base_pipeline(cls, api_test_name, api_test_names, new_api_test_name, sample_fraction=None, stratify_by_practice=False):
+        pipeline = copy.deepcopy(cls.__base_pipeline)
+        if sample_fraction is not None:
+            # Replaces the natural-order $limit with a deterministic hashed sample
+            pipeline[0] = cls.get_sample_stage(sample_fraction, stratify_by_practice)
         pipeline[1]['$match']['lab_results.api_test_name']['$in'] = api_test_names
         pipeline[2]['$set']['lab_results']['$map']['in']['$cond']['if']['$in'][1] = api_test_names
         pipeline[2]['$set']['lab_results']['$map']['in']['$cond']['then']['$mergeObjects'][1]['api_test_name'] = new_api_test_name
         pipeline[3]['$project']['lab_results']['$filter']['cond']['$eq'][1] = new_api_test_name
+        window = pipeline[5]['$addFields']['valid_labs']['$reduce']['in']['$cond']['if']['$and']
+        window[1]['$gte'][1], window[2]['$lt'][1] = cls.pair_window_days
+        return pipeline
+
+    def get_history_pipeline(self):
+        # The base pipeline of the labs facets. In trend mode the sorted
+        # history is kept past the pair selection and cut at lab_before only
+        # for the documents that have a pair; the other facets never carry it
+        pipeline = copy.deepcopy(self.base_pipeline)
+        if self.trend_features:
+            pipeline[6]['$project']['lab_results'] = 1
+            pipeline.append(copy.deepcopy(self.__history_stage))
         return pipeline
 
+    @staticmethod
+    def get_sweep_stages(windows):
+        # Pair selection of the base pipeline for several [min_days, max_days)
+        # windows in one $reduce: every window keeps its own latest pair and
+        # the number of consecutive labs that fell inside it
+        def window_step(i, min_days, max_days):
+            return {
+                '$let': {
+                    'vars': {
+                        'window': {
+                            '$arrayElemAt': [
+                                '$$value.windows', i
+                            ]
+                        }
+                    }, 
+                    'in': {
+                        '$cond': {
+                            'if': {
+                                '$and': [
+                                    {
+                                        '$gte': [
+                                            '$$gap', min_days
+                                        ]
+                                    }, {
+                                        '$lt': [
+                                            '$$gap', max_days
+                                        ]
+                                    }
+                                ]
+                            }, 
+                            'then': {
+                                '$mergeObjects': [
+                                    '$$window', {
+                                        'valid_labs': [
+                                            '$$value.last_lab', '$$this'
+                                        ], 
+                                        'pairs': {
+                                            '$add': [
+                                                '$$window.pairs', 1
+                                            ]
+                                        }
+                                    }
+                                ]
+                            }, 
+                            'else': '$$window'
+                        }
+                    }
+                }
+            }
+
+        return [
+            {
+                '$addFields': {
+                    'sweep': {
+                        '$reduce': {
+                            'input': '$lab_results', 
+                            'initialValue': {
+                                'windows': [
+                                    {
+                                        'min_days': min_days, 
+                                        'max_days': max_days, 
+                                        'valid_labs': [], 
+                                        'pairs': 0
+                                    } for min_days, max_days in windows
+                                ], 
+                                'last_lab': None
+                            }, 
+                            'in': {
+                                '$let': {
+                                    'vars': {
+                                        'gap': {
+                                            '$cond': {
+                                                'if': {
+                                                    '$ne': [
+                                                        '$$value.last_lab', None
+                                                    ]
+                                                }, 
+                                                'then': {
+                                                    '$dateDiff': {
+                                                        'startDate': '$$this.date', 
+                                                        'endDate': '$$value.last_lab.date', 
+                                                        'unit': 'day'
+                                                    }
+                                                }, 
+                                                'else': None
+                                            }
+                                        }
+                                    }, 
+                                    'in': {
+                                        'windows': [
+                                            window_step(i, min_days, max_days) for i, (min_days, max_days) in enumerate(windows)
+                                        ], 
+                                        'last_lab': '$$this'
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }, {
+                '$match': {
+                    'sweep.windows.valid_labs.1': {
+                        '$exists': True
+                    }
+                }
+            }, {
+                '$project': {
+                    'PatientID': 1, 
+                    'Practice': 1, 
+                    'windows': '$sweep.windows'
+                }
+            }, {
+                '$unwind': '$windows'
+            }, {
+                '$match': {
+                    'windows.valid_labs.1': {
+                        '$exists': True
+                    }
+                }
+            }, {
+                '$project': {
+                    'PatientID': 1, 
+                    'Practice': 1, 
+                    'window_min_days': '$windows.min_days', 
+                    'window_max_days': '$windows.max_days', 
+                    'pairs': '$windows.pairs', 
+                    'lab_after': {
+                        '$arrayElemAt': [
+                            '$windows.valid_labs', 0
+                        ]
+                    }, 
+                    'lab_before': {
+                        '$arrayElemAt': [
+                            '$windows.valid_labs', 1
+                        ]
+                    }
+                }
+            }, {
+                '$project': {
+                    'PatientID': 1, 
+                    'Practice': 1, 
+                    'window_min_days': 1, 
+                    'window_max_days': 1, 
+                    'pairs': 1, 
+                    'lab_after': {
+                        'date': '$lab_after.date', 
+                        'result': '$lab_after.result', 
+                        'unit': '$lab_after.unit', 
+                        'range': '$lab_after.range', 
+                        'api_test_name': '$lab_after.api_test_name'
+                    }, 
+                    'lab_before': {
+                        'date': '$lab_before.date', 
+                        'result': '$lab_before.result', 
+                        'unit': '$lab_before.unit', 
+                        'range': '$lab_before.range', 
+                        'api_test_name': '$lab_before.api_test_name'
+                    }
+                }
+            }
+        ]
+
+    def get_sweep_pipeline(self, windows):
+        # The base pipeline up to the sorted lab_results, then the sweep
+        return self.base_pipeline[:5] + self.get_sweep_stages(windows)
+
+    def get_timeline_pipeline(self, pipeline):
+        # The facet stages of a pipeline built on the base pipeline, run on the
+        # timelines: the sample stage and pair check, then the patient fields
+        # the base pipeline keeps (and lab_results for a history pipeline).
+        # A leading $limit only runs through run_chunks, which turns it into
+        # _id ranges of the patient collection and checks the cohort
+        start = len(self.base_pipeline)
+        history = pipeline[start:start + 1] == [self.__history_stage]
+        fields = {'valid_labs': '$valid_labs'}
+        if history:
+            fields['lab_results'] = '$labs'
+        stages = [self.base_pipeline[0], {
+            '$match': {
+                'valid_labs': {
+                    '$size': 2
+                }
+            }
+        }, {
+            '$lookup': {
+                'from': self.collection.name, 
+                'localField': '_id', 
+                'foreignField': '_id', 
+                'pipeline': [
+                    {
+                        '$project': {
+                            'PatientID': 1, 
+                            'Practice': 1, 
+                            'demographics': 1, 
+                            'vitals': 1, 
+                            'medications': 1, 
+                            'diagnosis': 1, 
+                            'Active_Meds': 1
+                        }
+                    }
+                ], 
+                'as': 'patient'
+            }
+        }, {
+            '$replaceWith': {
+                '$mergeObjects': [
+                    {
+                        '$arrayElemAt': [
+                            '$patient', 0
+                        ]
+                    }, fields
+                ]
+            }
+        }]
+        return copy.deepcopy(stages) + pipeline[start:]
+
+    def get_co_measurement_pipeline(self, labs):
+        # The labs pipeline of this class with the labs of the other given
+        # classes carried through pair selection and cut to those near a draw
+        tests = {}
+        for lab in labs:
+            if lab.name != self.name:
+                tests.update(lab_tests(lab))
+        pipeline = self.get_history_pipeline()
+        tail = self.get_labs_pipeline()[len(pipeline):]
+        for stage in pipeline[3:7]:
+            if '$project' in stage:
+                stage['$project']['co_labs'] = 1
+        pipeline.insert(2, co_labs_stage(tests))
+        for stage in tail:
+            stage['$project'].update({'co_before': 1, 'co_after': 1})
+        return pipeline + [draw_stage(self.draw_tolerance_hours)] + tail
+
     @abstractmethod
-    def run_aggregator_labs(self):
+    def get_labs_pipeline(self):
         pass
 
     @abstractmethod
-    def run_aggregator_demo(self):
+    def get_diagnosis_pipeline(self):
         pass
 
     @abstractmethod
-    def run_aggregator_diagnosis(self):
+    def get_vitals_pipeline(self):
         pass
 
     @abstractmethod
-    def run_aggregator_vitals(self):
+    def get_medications_pipeline(self):
         pass
 
-    @abstractmethod
+    def run_aggregator_labs(self):
+        return self.run_aggregator(self.get_labs_pipeline(), 'labs')
+
+    def run_aggregator_diagnosis(self):
+        return self.run_aggregator(self.get_diagnosis_pipeline(), 'diagnosis')
+
+    def run_aggregator_vitals(self):
+        return self.run_aggregator(self.get_vitals_pipeline(), 'vitals')
+
     def run_aggregator_medications(self):
-        pass
+        return self.run_aggregator(self.get_medications_pipeline(), 'medications')
+
+    def run_co_measurements(self, labs):
+        # Pairs of this class's analyte with the other analytes of each draw,
+        # e.g. ALTLab().run_co_measurements([ASTLab(), AlbuminLab()])
+        return self.run_aggregator(self.get_co_measurement_pipeline(labs), 'co_measurements')
+
+    def run_sweep(self, windows):
+        # One extraction for all candidate windows. Rows of the sweep facet are
+        # (patient, window) pairs; the returned table has, per window, the
+        # patients with a pair and the consecutive labs inside the window
+        self.run_aggregator(self.get_sweep_pipeline(windows), 'sweep')
+        rows = self.read_output('sweep', columns=['window_min_days', 'window_max_days', 'pairs'])
+        counts = rows.groupby(['window_min_days', 'window_max_days'])['pairs'].agg(patients='size', pairs='sum')
+        return counts.reindex(pd.MultiIndex.from_tuples([tuple(window) for window in windows], names=counts.index.names), fill_value=0).reset_index()
+
+    def facet_dir(self, facet):
+        return os.path.join(self.output_dir, self.name, facet)
+
+    def write_part(self, df, facet, part):
+        # ObjectIds are not representable in parquet
+        if '_id' in df.columns:
+            df['_id'] = df['_id'].astype(str)
+        df.to_parquet(os.path.join(self.facet_dir(facet), 'part-%05d.parquet' % part), index=False)
+
+    def clear_facet(self, facet):
+        path = self.facet_dir(facet)
+        os.makedirs(path, exist_ok=True)
+        for part in part_paths(path):
+            os.remove(part)
+
+    def read_output(self, facet, columns=None):
+        # A facet without rows is written as one part without columns
+        parts = part_paths(self.facet_dir(facet))
+        if columns is not None and not any(pq.read_schema(part).names for part in parts):
+            return pd.DataFrame(columns=columns)
+        return pd.read_parquet(self.facet_dir(facet), columns=columns)
+
+    def write_batch(self, batch, facet, part):
+        self.write_frame(pd.json_normalize(batch), facet, part)
+
+    def write_frame(self, df, facet, part):
+        for stage in self.batch_stages.get(facet, []):
+            df = stage(df)
+        self.write_part(df, facet, part)
+
+    def parameters(self):
+        return {
+            'pair_window_days': list(self.pair_window_days),
+            'vitals_lookback_days': self.vitals_lookback_days,
+            'diagnosis_lookback_years': self.diagnosis_lookback_years,
+            'trend_features': self.trend_features,
+            'batch_size': self.batch_size
+        }
+
+    def snapshot_inputs(self, facet, **inputs):
+        return dict({
+            'lab': self.name,
+            'facet': facet,
+            'parameters': self.parameters(),
+            'source': self.source_version or source_version(self.collection),
+            'stages': [code_digest(stage) for stage in self.batch_stages.get(facet, [])],
+            'decoder': self.facet_decoder(facet)
+        }, **inputs)
+
+    def facet_source(self, pipeline, facet):
+        # The pipeline a facet runs and the collection it reads, None for the
+        # patient collection
+        if self.read_timelines and facet in self.timeline_facets:
+            return self.get_timeline_pipeline(pipeline), timeline_collection(self).name
+        return pipeline, None
+
+    def run_aggregator(self, pipeline, facet):
+        pipeline, collection = self.facet_source(pipeline, facet)
+        timelines = {'timelines': timeline_version(self)} if collection else {}
+        inputs = self.snapshot_inputs(facet, pipeline=digest(pipeline), **timelines) if self.use_snapshots else None
+        snapshot = Snapshot.find(self.name, facet, inputs) if inputs else None
+        if snapshot is not None:
+            snapshot.materialize(self.facet_dir(facet))
+            return snapshot
+        if self.optimize_pipelines:
+            # Snapshots stay keyed by the pipeline as written
+            pipeline = optimize_pipeline(self, pipeline, facet, self.optimizer_sample, collection=collection)
+        self.run_chunks(pipeline, facet, collection)
+        if inputs:
+            return Snapshot.create(self.name, facet, inputs, self.facet_dir(facet))
+
+    @classmethod
+    def majority_time(cls):
+        # Latest majority-committed time, which every member can serve once it
+        # has replicated that far
+        hello = cls.client.admin.command('hello')
+        if 'lastWrite' not in hello:
+            raise ValueError('Reading at a cluster time needs a replica set')
+        return hello['lastWrite']['majorityOpTime']['ts']
+
+    def read_collection(self, name=None):
+        name = name or self.collection.name
+        collection = self.collection if name == self.collection.name else self.db[name]
+        if self.analytics_uri is not None:
+            if getattr(self, 'analytics_client', None) is None:
+                self.analytics_client = MongoClient(self.analytics_uri, directConnection=True)
+            collection = self.analytics_client[self.db.name][name]
+        if self.read_preference is not None:
+            mode = self.read_modes[self.read_preference](tag_sets=self.read_tags, max_staleness=self.max_staleness_seconds)
+            collection = collection.with_options(read_preference=mode)
+        return collection
+
+    def aggregate(self, pipeline, raw=False, collection=None):
+        # An explicit readConcern takes precedence over the collection's own
+        options = {'allowDiskUse': True, 'batchSize': self.batch_size}
+        if self.cluster_time is not None:
+            options['readConcern'] = {'level': 'snapshot', 'atClusterTime': self.cluster_time}
+        collection = self.read_collection(collection)
+        if raw:
+            return collection.aggregate_raw_batches(pipeline, **options)
+        return collection.aggregate(pipeline, **options)
+
+    def is_retryable(self, error):
+        if isinstance(error, (ConnectionFailure, CursorNotFound, ExecutionTimeout)):
+            return True
+        return isinstance(error, OperationFailure) and (error.has_error_label('RetryableError') or error.code in self.retryable_codes)
+
+    def retry(self, action, cleanup=None):
+        attempt = 0
+        while True:
+            try:
+                return action()
+            except Exception as error:
+                attempt += 1
+                if attempt > self.max_retries or not self.is_retryable(error):
+                    raise
+                if cleanup is not None:
+                    cleanup()
+                low, high = self.retry_backoff
+                time.sleep(min(high, low * 2 ** (attempt - 1)) * random.uniform(0.5, 1))
+
+    def checkpoint_path(self, facet):
+        return os.path.join(self.facet_dir(facet), '_checkpoint.json')
+
+    def save_checkpoint(self, facet, state):
+        path = self.checkpoint_path(facet)
+        with open(path + '.tmp', 'w') as f:
+            f.write(json_util.dumps(state))
+        os.replace(path + '.tmp', path)
+
+    def load_checkpoint(self, facet, key):
+        path = self.checkpoint_path(facet)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            state = json_util.loads(f.read())
+        return state if state.get('key') == key else None
+
+    def checkpoint_key(self, pipeline, facet, limit, collection=None):
+        # Everything that decides the chunks and the parts written for them;
+        # a checkpoint left by a run with any of it different starts over
+        return digest({
+            'pipeline': pipeline,
+            'limit': limit,
+            'collection': collection,
+            'stages': [code_digest(stage) for stage in self.batch_stages.get(facet, [])],
+            'decoder': self.facet_decoder(facet),
+            'batch_size': self.batch_size,
+            'chunk_size': self.chunk_size
+        })
+
+    def remove_parts(self, facet, first):
+        # Parts written by an unfinished chunk
+        for part in part_paths(self.facet_dir(facet)):
+            if int(re.search(r'part-(\d+)\.parquet$', part).group(1)) >= first:
+                os.remove(part)
+
+    def chunk_starts(self, limit=None):
+        # One covered pass over the _id index; every chunk_size-th _id starts a
+        # chunk and the last _id closes the final one
+        starts, last = [], None
+        pipeline = [{'$sort': {'_id': 1}}] + ([{'$limit': limit}] if limit else []) + [{'$project': {'_id': 1}}]
+        for i, doc in enumerate(self.aggregate(pipeline)):
+            if i % self.chunk_size == 0:
+                starts.append(doc['_id'])
+            last = doc['_id']
+        return starts, last
+
+    def facet_decoder(self, facet):
+        if self.decoder == 'arrow' and facet in self.arrow_facets and facet in FACET_SCHEMAS:
+            return 'arrow'
+        return 'python'
+
+    def run_chunk(self, pipeline, facet, part, collection=None):
+        if self.facet_decoder(facet) == 'arrow':
+            # Each raw batch holds up to batch_size documents and becomes a part
+            for raw_batch in self.aggregate(arrow_pipeline(pipeline, facet), raw=True, collection=collection):
+                df = decode_batch(raw_batch, facet)
+                if len(df):
+                    self.write_frame(df, facet, part)
+                    part += 1
+            return part
+        cursor = self.aggregate(pipeline, collection=collection)
+        batch = []
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) == self.batch_size:
+                self.write_batch(batch, facet, part)
+                batch, part = [], part + 1
+        if batch:
+            self.write_batch(batch, facet, part)
+            part += 1
+        return part
+
+    def run_chunks(self, pipeline, facet, collection=None):
+        # The leading $limit of the base pipeline becomes a bound on the chunked
+        # _id range, so the run covers the first documents in _id order. The
+        # ranges always come from the patient collection, whose _ids other
+        # collections read here (the timelines) share
+        limit = None
+        if '$limit' in pipeline[0]:
+            limit, pipeline = pipeline[0]['$limit'], pipeline[1:]
+        key = self.checkpoint_key(pipeline, facet, limit, collection)
+        state = self.load_checkpoint(facet, key)
+        if state is None:
+            self.clear_facet(facet)
+            starts, last = self.retry(lambda: self.chunk_starts(limit))
+            if collection is not None:
+                self.retry(lambda: self.check_cohort(collection, starts, last))
+            state = {'key': key, 'starts': starts, 'last': last, 'chunk': 0, 'part': 0}
+            self.save_checkpoint(facet, state)
+        else:
+            self.remove_parts(facet, state['part'])
+        starts = state['starts']
+        ranges = [{'$gte': low, '$lt': high} for low, high in zip(starts, starts[1:])]
+        if starts:
+            ranges.append({'$gte': starts[-1], '$lte': state['last']})
+        while state['chunk'] < len(ranges):
+            chunk = [{'$match': {'_id': ranges[state['chunk']]}}] + pipeline
+            state['part'] = self.retry(lambda: self.run_chunk(chunk, facet, state['part'], collection), lambda: self.remove_parts(facet, state['part']))
+            state['chunk'] += 1
+            self.save_checkpoint(facet, state)
+        if state['part'] == 0:
+            self.write_batch([], facet, 0)
+        os.remove(self.checkpoint_path(facet))
+
+    def check_cohort(self, collection, starts, last):
+        # Another collection (the timelines) read in place of the base
+        # pipeline must hold one document per patient document of its cohort
+        # that has the analyte: those in the _id range of a $limit, or in the
+        # sample
+        first = self.base_pipeline[0]
+        if '$limit' in first:
+            cohort = {'_id': {'$gte': starts[0], '$lte': last}} if starts else {'_id': {'$in': []}}
+        else:
+            cohort = first['$match']
+        expected = self.read_collection().count_documents({'$and': [cohort, self.base_pipeline[1]['$match']]})
+        found = self.read_collection(collection).count_documents(cohort)
+        if found != expected:
+            raise ValueError('%s holds %d documents of the cohort of %s, which has %d; refresh it with timelines.py' % (collection, found, self.name, expected))
+
+    def estimate(self):
+        # Dry run: documents matched, pair yield, output rows and bytes and
+        # wall time per facet, from the collection statistics and the facets
+        # run on a hashed sample (written to a scratch directory), along with
+        # the batch_size and chunk_size to run with. A $limit run is assumed
+        # to look like a hashed sample of its size. The index statistics tell
+        # whether the sample and the analyte match can use an index
+        stats = next(self.collection.aggregate([{'$collStats': {'storageStats': {}}}]))['storageStats']
+        indexes = {
+            name: {
+                'keys': [field for field, _ in index['key']], 
+                'bytes': stats.get('indexSizes', {}).get(name, 0)
+            } for name, index in self.collection.index_information().items()
+        }
+        sample_indexed = any(index['keys'][0] == 'sample_bucket' for index in indexes.values())
+        analyte_indexed = any(index['keys'][0] == 'lab_results.api_test_name' for index in indexes.values())
+        first = self.base_pipeline[0]
+        if '$limit' in first:
+            covered = ranged = min(first['$limit'], stats['count'])
+            bounds = []
+        else:
+            # Chunks range over the whole collection whatever the sample
+            covered, ranged = self.collection.count_documents(first['$match']), stats['count']
+            bounds = [first['$match']]
+        buckets = max(1, int(np.ceil(self.estimate_sample / max(stats['count'], 1) * self.sample_buckets)))
+        sample = {'$match': {'$and': bounds + [{'sample_bucket': {'$lt': buckets}}]}}
+        sampled = self.collection.count_documents(sample['$match'])
+        if not sampled:
+            raise ValueError('The sample of %s holds no documents%s' % (self.name, '' if sample_indexed else '; the sample index is not built (create_sample_index)'))
+        scale = covered / sampled
+
+        def count(pipeline):
+            return next(self.aggregate([sample] + pipeline + [{'$count': 'count'}]), {'count': 0})['count']
+
+        matched = count(self.base_pipeline[1:2])
+        pairs = count(self.base_pipeline[1:])
+        probe = copy.copy(self)
+        probe.output_dir = tempfile.mkdtemp(prefix='estimate-')
+        probe.use_snapshots = False
+        facets = {}
+        try:
+            for facet in self.estimate_facets:
+                probe.clear_facet(facet)
+                if facet == 'demo':
+                    if 'labs' not in facets:
+                        raise ValueError('demo is estimated from the sampled labs; list labs before it in estimate_facets')
+                    start = time.perf_counter()
+                    probe.run_aggregator_demo()
+                else:
+                    pipeline, collection = self.facet_source(getattr(self, 'get_%s_pipeline' % facet)(), facet)
+                    pipeline = [sample] + pipeline[1:]
+                    if self.optimize_pipelines:
+                        pipeline = optimize(pipeline)
+                    start = time.perf_counter()
+                    probe.run_chunk(pipeline, facet, 0, collection)
+                seconds = time.perf_counter() - start
+                parts = part_paths(probe.facet_dir(facet))
+                rows = sum(pq.ParquetFile(part).metadata.num_rows for part in parts)
+                memory = sum(pq.read_table(part).nbytes for part in parts)
+                facets[facet] = {
+                    'rows': int(rows * scale),
+                    'bytes': int(sum(os.path.getsize(part) for part in parts) * scale),
+                    'seconds': seconds * scale,
+                    'row_bytes': memory / max(rows, 1)
+                }
+        finally:
+            shutil.rmtree(probe.output_dir, ignore_errors=True)
+
+        def rounded(value):
+            # Two significant digits
+            return int(float('%.2g' % value))
+
+        # Only the pipeline facets are read in batches and chunks
+        chunked = [facets[facet] for facet in facets if facet != 'demo']
+        row_bytes = max(facet['row_bytes'] for facet in chunked)
+        batch_size = rounded(min(100000, max(1000, self.target_batch_bytes / max(row_bytes, 1))))
+        slowest = max(facet['seconds'] for facet in chunked)
+        chunk_size = rounded(max(1000, self.target_chunk_seconds * ranged / max(slowest, 1e-9)))
+        return {
+            'lab': self.name,
+            'documents': stats['count'],
+            'average_document_bytes': stats.get('avgObjSize', 0),
+            'index_bytes': stats.get('totalIndexSize', 0),
+            'indexes': indexes,
+            'sample_indexed': sample_indexed,
+            'analyte_indexed': analyte_indexed,
+            'covered_documents': covered,
+            'sample_documents': sampled,
+            'matched_documents': int(matched * scale),
+            'pairs': int(pairs * scale),
+            'pair_yield': pairs / matched if matched else 0.0,
+            'facets': facets,
+            'seconds': sum(facet['seconds'] for facet in facets.values()),
+            'recommended': {
+                'batch_size': batch_size,
+                'chunk_size': chunk_size,
+                'chunks': int(np.ceil(ranged / chunk_size))
+            }
+        }
+
+    # Demographics dimension shared by every lab class, one row per PatientID,
+    # cached under <output_dir>/<demographics_dir> (see demographics.py)
+    demographics_dir = 'demographics'
+    demographics_buckets = 64
+    demographics_fields = ['date_of_birth', 'gender', 'race_mapping', 'ethnicity_mapping']
+
+    def demographics_cache(self):
+        return DemographicsCache(os.path.join(self.output_dir, self.demographics_dir), self.demographics_fields, self.demographics_buckets)
+
+    def fetch_demographics(self, patient_ids):
+        fetched = []
+        for start in range(0, len(patient_ids), self.batch_size):
+            cursor = self.aggregate([
+                {
+                    '$match': {
+                        'PatientID': {
+                            '$in': list(patient_ids[start:start + self.batch_size])
+                        }
+                    }
+                }, {
+                    '$project': dict(
+                        {
+                            '_id': 0, 
+                            'PatientID': 1
+                        }, **{
+                            field: {
+                                '$getField': {
+                                    'field': field, 
+                                    'input': {
+                                        '$arrayElemAt': [
+                                            '$demographics', 0
+                                        ]
+                                    }
+                                }
+                            } for field in self.demographics_fields
+                        }
+                    )
+                }
+            ])
+            fetched.append(pd.DataFrame(list(cursor), columns=['PatientID'] + self.demographics_fields))
+        if not fetched:
+            return pd.DataFrame(columns=['PatientID'] + self.demographics_fields)
+        return pd.concat(fetched, ignore_index=True).drop_duplicates('PatientID')
+
+    def get_demographics(self, patient_ids):
+        return self.demographics_cache().get(patient_ids, self.fetch_demographics)
+
+    def run_aggregator_demo(self):
+        if not part_paths(self.facet_dir('labs')):
+            self.run_aggregator_labs()
+        # Keyed by the labs files it is derived from rather than by a pipeline
+        inputs = None
+        if self.use_snapshots:
+            inputs = self.snapshot_inputs('demo', labs=digest(dataset_checksums(self.facet_dir('labs'))), fields=self.demographics_fields, join=code_digest(self.join_demographics))
+            snapshot = Snapshot.find(self.name, 'demo', inputs)
+            if snapshot is not None:
+                snapshot.materialize(self.facet_dir('demo'))
+                return snapshot
+        self.clear_facet('demo')
+        # The pairs are first spilled by demographics bucket, so that each
+        # bucket of the cache is read (and its missing patients fetched) once
+        # and memory holds one bucket of pairs and demographics at a time.
+        # Demo parts follow the buckets rather than the labs parts
+        cache = self.demographics_cache()
+        columns = ['_id', 'PatientID', 'Practice', 'lab_before.date']
+        spill_dir = tempfile.mkdtemp(prefix='demo-')
+        try:
+            for i, path in enumerate(part_paths(self.facet_dir('labs'))):
+                if not pq.read_schema(path).names:
+                    continue
+                labs = pd.read_parquet(path, columns=columns)
+                for bucket, pairs in labs.groupby(cache.bucket(labs['PatientID'])):
+                    os.makedirs(os.path.join(spill_dir, '%03d' % bucket), exist_ok=True)
+                    pairs.to_parquet(os.path.join(spill_dir, '%03d' % bucket, 'part-%05d.parquet' % i), index=False)
+            part = 0
+            for bucket in range(cache.buckets):
+                spilled = part_paths(os.path.join(spill_dir, '%03d' % bucket))
+                if not spilled:
+                    continue
+                labs = pd.concat([pd.read_parquet(path) for path in spilled], ignore_index=True)
+                demo = self.join_demographics(labs, cache.get(labs['PatientID'].unique(), self.fetch_demographics))
+                self.write_part(demo.drop(columns='lab_before.date'), 'demo', part)
+                part += 1
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+        if not part:
+            self.write_part(pd.DataFrame(), 'demo', 0)
+        if inputs:
+            return Snapshot.create(self.name, 'demo', inputs, self.facet_dir('demo'))
+
+    @staticmethod
+    def join_demographics(pairs, demographics):
+        joined = pairs.merge(demographics, on='PatientID', how='left')
+        # Age at the earlier lab of the pair, using the same 365-day year as before
+        date_of_birth = pd.to_datetime(joined['date_of_birth'], errors='coerce')
+        joined['age'] = np.floor((joined['lab_before.date'] - date_of_birth) / np.timedelta64(365, 'D'))
+        return joined
+
+    # Columns imputed by the streaming cleaning passes
+    vitals_columns = ['height', 'weight', 'bmi', 'systolic', 'diastolic', 'map']
+    bmi_bounds = (10, 50)
+    demo_numeric_columns = ['age']
+    demo_categorical_columns = ['gender', 'race_mapping', 'ethnicity_mapping']
+
+    def clean_vitals(self, group_by=None):
+        # Median imputation and BMI outlier removal over the vitals facet
+        stats = collect_stats(self.facet_dir('vitals'), self.vitals_columns, [], group_by)
+        return clean_parts(self.facet_dir('vitals'), self.facet_dir('vitals_clean'), stats, [('bmi',) + tuple(self.bmi_bounds)])
+
+    def clean_demo(self, group_by=None):
+        # Median imputation of age and mode imputation of the categorical columns
+        stats = collect_stats(self.facet_dir('demo'), self.demo_numeric_columns, self.demo_categorical_columns, group_by)
+        return clean_parts(self.facet_dir('demo'), self.facet_dir('demo_clean'), stats)
+
+    def run_targets(self, method='quantile', version=None, refit=False):
+        # Reuses persisted bin edges unless asked to refit, so holdout and
+        # scoring runs bin exactly like the training run did
+        edges = None if refit else BinEdges.load(self.name, method, version)
+        if edges is None:
+            edges = fit_edges(self.facet_dir('labs'), self.name, method)
+        build_targets(self.facet_dir('labs'), self.facet_dir('targets'), edges)
+        return edges
+
+    def build_features(self, target='lab_after.value', spec=None, min_patients=2000):
+        return FeatureMatrix.build(self, target, spec, min_patients)
 
 class ALTLab(PreprocessedLabs):
-    def __init__(self):
+    def __init__(self, sample_fraction=None, stratify_by_practice=False, trend_features=None):
+        if trend_features is not None:
+            self.trend_features = trend_features
+        self.name = 'alanine_aminotransferase'
         self.base_pipeline = self.get_base_pipeline(
             api_test_name='Alanine aminotransferase (ALT) measurement',
             api_test_names=['Alanine aminotransferase (ALT) measurement'],
-            new_api_test_name='alanine_aminotransferase'
+            new_api_test_name='alanine_aminotransferase',
+            sample_fraction=sample_fraction,
+            stratify_by_practice=stratify_by_practice
         )
 
-    def run_aggregator_labs(self):
-        pipeline = self.base_pipeline.copy() + [
+    def get_labs_pipeline(self):
+        return self.get_history_pipeline() + [
             {
                 '$project': {
                     'PatientID': 1, 
                     'Practice': 1, 
+                    'lab_history': 1, 
                     'lab_after': {
                         '$arrayElemAt': [
                             '$valid_labs', 0
@@ -254,6 +1208,7 @@ class ALTLab(PreprocessedLabs):
                 '$project': {
                     'PatientID': 1, 
                     'Practice': 1, 
+                    'lab_history': 1, 
                     'lab_after': {
                         'date': '$lab_after.date', 
                         'result': '$lab_after.result', 
@@ -271,10 +1226,9 @@ class ALTLab(PreprocessedLabs):
                 }
             }
         ]
-        self.run_aggregator(pipeline, 'labs')
 
-    def run_aggregator_diagnosis(self):
-        pipeline = self.base_pipeline.copy() + [
+    def get_diagnosis_pipeline(self):
+        return self.base_pipeline.copy() + [
             {
                 '$project': {
                     'PatientID': 1, 
@@ -365,7 +1319,7 @@ class ALTLab(PreprocessedLabs):
                                                 '$dateSubtract': {
                                                     'startDate': '$valid_labs.lab_before.date', 
                                                     'unit': 'year', 
-                                                    'amount': 2
+                                                    'amount': self.diagnosis_lookback_years
                                                 }
                                             }
                                         ]
@@ -446,10 +1400,9 @@ class ALTLab(PreprocessedLabs):
                 }
             }
         ]
-        self.run_aggregator(pipeline, 'diagnosis')
 
-    def run_aggregator_vitals(self):
-        pipeline = self.base_pipeline.copy() + [
+    def get_vitals_pipeline(self):
+        return self.base_pipeline.copy() + [
             {
                 '$project': {
                     'PatientID': 1, 
@@ -487,7 +1440,7 @@ class ALTLab(PreprocessedLabs):
                                                 '$dateSubtract': {
                                                     'startDate': '$lab_before.date', 
                                                     'unit': 'day', 
-                                                    'amount': 350
+                                                    'amount': self.vitals_lookback_days
                                                 }
                                             }
                                         ]
@@ -499,93 +1452,9 @@ class ALTLab(PreprocessedLabs):
                 }
             }
         ]
-        self.run_aggregator(pipeline, 'vitals')
 
-    def run_aggregator_demo(self):
-        pipeline = self.base_pipeline.copy() + [
-            {
-                '$project': {
-                    'PatientID': 1, 
-                    'Practice': 1, 
-                    'demographics.date_of_birth': 1, 
-                    'demographics.gender': 1, 
-                    'demographics.race_mapping': 1, 
-                    'demographics.ethnicity_mapping': 1
-                }
-            }, {
-                '$addFields': {
-                    'age': {
-                        '$floor': {
-                            '$divide': [
-                                {
-                                    '$subtract': [
-                                        datetime.utcnow(), {
-                                            '$getField': {
-                                                'field': 'date_of_birth', 
-                                                'input': {
-                                                    '$arrayElemAt': [
-                                                        '$demographics', 0
-                                                    ]
-                                                }
-                                            }
-                                        }
-                                    ]
-                                }, 1000 * 60 * 60 * 24 * 365
-                            ]
-                        }
-                    }
-                }
-            }, {
-                '$set': {
-                    'date_of_birth': {
-                        '$getField': {
-                            'field': 'date_of_birth', 
-                            'input': {
-                                '$arrayElemAt': [
-                                    '$demographics', 0
-                                ]
-                            }
-                        }
-                    }, 
-                    'gender': {
-                        '$getField': {
-                            'field': 'gender', 
-                            'input': {
-                                '$arrayElemAt': [
-                                    '$demographics', 0
-                                ]
-                            }
-                        }
-                    }, 
-                    'race_mapping': {
-                        '$getField': {
-                            'field': 'race_mapping', 
-                            'input': {
-                                '$arrayElemAt': [
-                                    '$demographics', 0
-                                ]
-                            }
-                        }
-                    }, 
-                    'ethnicity_mapping': {
-                        '$getField': {
-                            'field': 'ethnicity_mapping', 
-                            'input': {
-                                '$arrayElemAt': [
-                                    '$demographics', 0
-                                ]
-                            }
-                        }
-                    }
-                }
-            }, {
-                '$unset': 'demographics'
-            }
-        ]
-        self.run_aggregator(pipeline, 'demo')
-
-    def run_aggregator_medications(self):
-        pipeline = self.base_pipeline.copy() + [
+    def get_medications_pipeline(self):
+        return self.base_pipeline.copy() + [
             {
                 '$addFields': {
                     'medications': {
@@ -730,22 +1599,27 @@ class ALTLab(PreprocessedLabs):
                 }
             }
         ]
-        self.run_aggregator(pipeline, 'medications')
 
 class ASTLab(PreprocessedLabs):
-    def __init__(self):
+    def __init__(self, sample_fraction=None, stratify_by_practice=False, trend_features=None):
+        if trend_features is not None:
+            self.trend_features = trend_features
+        self.name = 'aspartate_aminotransferase'
         self.base_pipeline = self.get_base_pipeline(
             api_test_name='Aspartate aminotransferase (AST) measurement',
             api_test_names=['Aspartate aminotransferase (AST) measurement'],
-            new_api_test_name='aspartate_aminotransferase'
+            new_api_test_name='aspartate_aminotransferase',
+            sample_fraction=sample_fraction,
+            stratify_by_practice=stratify_by_practice
         )
 
-    def run_aggregator_labs(self):
-        pipeline = self.base_pipeline.copy() + [
+    def get_labs_pipeline(self):
+        return self.get_history_pipeline() + [
             {
                 '$project': {
                     'PatientID': 1, 
                     'Practice': 1, 
+                    'lab_history': 1, 
                     'lab_after': {
                         '$arrayElemAt': [
                             '$valid_labs', 0
@@ -761,6 +1635,7 @@ class ASTLab(PreprocessedLabs):
                 '$project': {
                     'PatientID': 1, 
                     'Practice': 1, 
+                    'lab_history': 1, 
                     'lab_after': {
                         'date': '$lab_after.date', 
                         'result': '$lab_after.result', 
@@ -778,10 +1653,9 @@ class ASTLab(PreprocessedLabs):
                 }
             }
         ]
-        self.run_aggregator(pipeline, 'labs')
 
-    def run_aggregator_diagnosis(self):
-        pipeline = self.base_pipeline.copy() + [
+    def get_diagnosis_pipeline(self):
+        return self.base_pipeline.copy() + [
             {
                 '$project': {
                     'PatientID': 1, 
@@ -872,7 +1746,7 @@ class ASTLab(PreprocessedLabs):
                                                 '$dateSubtract': {
                                                     'startDate': '$valid_labs.lab_before.date', 
                                                     'unit': 'year', 
-                                                    'amount': 2
+                                                    'amount': self.diagnosis_lookback_years
                                                 }
                                             }
                                         ]
@@ -953,10 +1827,9 @@ class ASTLab(PreprocessedLabs):
                 }
             }
         ]
-        self.run_aggregator(pipeline, 'diagnosis')
 
-    def run_aggregator_vitals(self):
-        pipeline = self.base_pipeline.copy() + [
+    def get_vitals_pipeline(self):
+        return self.base_pipeline.copy() + [
             {
                 '$project': {
                     'PatientID': 1, 
@@ -994,7 +1867,7 @@ class ASTLab(PreprocessedLabs):
                                                 '$dateSubtract': {
                                                     'startDate': '$lab_before.date', 
                                                     'unit': 'day', 
-                                                    'amount': 350
+                                                    'amount': self.vitals_lookback_days
                                                 }
                                             }
                                         ]
@@ -1006,93 +1879,9 @@ class ASTLab(PreprocessedLabs):
                 }
             }
         ]
-        self.run_aggregator(pipeline, 'vitals')
 
-    def run_aggregator_demo(self):
-        pipeline = self.base_pipeline.copy() + [
-            {
-                '$project': {
-                    'PatientID': 1, 
-                    'Practice': 1, 
-                    'demographics.date_of_birth': 1, 
-                    'demographics.gender': 1, 
-                    'demographics.race_mapping': 1, 
-                    'demographics.ethnicity_mapping': 1
-                }
-            }, {
-                '$addFields': {
-                    'age': {
-                        '$floor': {
-                            '$divide': [
-                                {
-                                    '$subtract': [
-                                        datetime.utcnow(), {
-                                            '$getField': {
-                                                'field': 'date_of_birth', 
-                                                'input': {
-                                                    '$arrayElemAt': [
-                                                        '$demographics', 0
-                                                    ]
-                                                }
-                                            }
-                                        }
-                                    ]
-                                }, 1000 * 60 * 60 * 24 * 365
-                            ]
-                        }
-                    }
-                }
-            }, {
-                '$set': {
-                    'date_of_birth': {
-                        '$getField': {
-                            'field': 'date_of_birth', 
-                            'input': {
-                                '$arrayElemAt': [
-                                    '$demographics', 0
-                                ]
-                            }
-                        }
-                    }, 
-                    'gender': {
-                        '$getField': {
-                            'field': 'gender', 
-                            'input': {
-                                '$arrayElemAt': [
-                                    '$demographics', 0
-                                ]
-                            }
-                        }
-                    }, 
-                    'race_mapping': {
-                        '$getField': {
-                            'field': 'race_mapping', 
-                            'input': {
-                                '$arrayElemAt': [
-                                    '$demographics', 0
-                                ]
-                            }
-                        }
-                    }, 
-                    'ethnicity_mapping': {
-                        '$getField': {
-                            'field': 'ethnicity_mapping', 
-                            'input': {
-                                '$arrayElemAt': [
-                                    '$demographics', 0
-                                ]
-                            }
-                        }
-                    }
-                }
-            }, {
-                '$unset': 'demographics'
-            }
-        ]
-        self.run_aggregator(pipeline, 'demo')
-
-    def run_aggregator_medications(self):
-        pipeline = self.base_pipeline.copy() + [
+    def get_medications_pipeline(self):
+        return self.base_pipeline.copy() + [
             {
                 '$addFields': {
                     'medications': {
@@ -1237,10 +2026,12 @@ class ASTLab(PreprocessedLabs):
                 }
             }
         ]
-        self.run_aggregator(pipeline, 'medications')
 
 class AlbuminLab(PreprocessedLabs):
-    def __init__(self):
+    def __init__(self, sample_fraction=None, stratify_by_practice=False, trend_features=None):
+        if trend_features is not None:
+            self.trend_features = trend_features
+        self.name = 'albumin'
         self.base_pipeline = self.get_base_pipeline(
             api_test_name='Serum or plasma albumin measurement (mass/volume)',
             api_test_names=[
@@ -1251,15 +2042,18 @@ class AlbuminLab(PreprocessedLabs):
                 'Urine albumin measurement for detection of microalbuminuria', 
                 'Urine albumin measurement'
             ],
-            new_api_test_name='albumin'
+            new_api_test_name='albumin',
+            sample_fraction=sample_fraction,
+            stratify_by_practice=stratify_by_practice
         )
 
-    def run_aggregator_labs(self):
-        pipeline = self.base_pipeline.copy() + [
+    def get_labs_pipeline(self):
+        return self.get_history_pipeline() + [
             {
                 '$project': {
                     'PatientID': 1, 
                     'Practice': 1, 
+                    'lab_history': 1, 
                     'lab_after': {
                         '$arrayElemAt': [
                             '$valid_labs', 0
@@ -1275,6 +2069,7 @@ class AlbuminLab(PreprocessedLabs):
                 '$project': {
                     'PatientID': 1, 
                     'Practice': 1, 
+                    'lab_history': 1, 
                     'lab_after': {
                         'date': '$lab_after.date', 
                         'result': '$lab_after.result', 
@@ -1292,10 +2087,9 @@ class AlbuminLab(PreprocessedLabs):
                 }
             }
         ]
-        self.run_aggregator(pipeline, 'labs')
 
-    def run_aggregator_diagnosis(self):
-        pipeline = self.base_pipeline.copy() + [
+    def get_diagnosis_pipeline(self):
+        return self.base_pipeline.copy() + [
             {
                 '$project': {
                     'PatientID': 1, 
@@ -1386,7 +2180,7 @@ class AlbuminLab(PreprocessedLabs):
                                                 '$dateSubtract': {
                                                     'startDate': '$valid_labs.lab_before.date', 
                                                     'unit': 'year', 
-                                                    'amount': 2
+                                                    'amount': self.diagnosis_lookback_years
                                                 }
                                             }
                                         ]
@@ -1467,10 +2261,9 @@ class AlbuminLab(PreprocessedLabs):
                 }
             }
         ]
-        self.run_aggregator(pipeline, 'diagnosis')
 
-    def run_aggregator_vitals(self):
-        pipeline = self.base_pipeline.copy() + [
+    def get_vitals_pipeline(self):
+        return self.base_pipeline.copy() + [
             {
                 '$project': {
                     'PatientID': 1, 
@@ -1508,7 +2301,7 @@ class AlbuminLab(PreprocessedLabs):
                                                 '$dateSubtract': {
                                                     'startDate': '$lab_before.date', 
                                                     'unit': 'day', 
-                                                    'amount': 350
+                                                    'amount': self.vitals_lookback_days
                                                 }
                                             }
                                         ]
@@ -1520,93 +2313,9 @@ class AlbuminLab(PreprocessedLabs):
                 }
             }
         ]
-        self.run_aggregator(pipeline, 'vitals')
 
-    def run_aggregator_demo(self):
-        pipeline = self.base_pipeline.copy() + [
-            {
-                '$project': {
-                    'PatientID': 1, 
-                    'Practice': 1, 
-                    'demographics.date_of_birth': 1, 
-                    'demographics.gender': 1, 
-                    'demographics.race_mapping': 1, 
-                    'demographics.ethnicity_mapping': 1
-                }
-            }, {
-                '$addFields': {
-                    'age': {
-                        '$floor': {
-                            '$divide': [
-                                {
-                                    '$subtract': [
-                                        datetime.utcnow(), {
-                                            '$getField': {
-                                                'field': 'date_of_birth', 
-                                                'input': {
-                                                    '$arrayElemAt': [
-                                                        '$demographics', 0
-                                                    ]
-                                                }
-                                            }
-                                        }
-                                    ]
-                                }, 1000 * 60 * 60 * 24 * 365
-                            ]
-                        }
-                    }
-                }
-            }, {
-                '$set': {
-                    'date_of_birth': {
-                        '$getField': {
-                            'field': 'date_of_birth', 
-                            'input': {
-                                '$arrayElemAt': [
-                                    '$demographics', 0
-                                ]
-                            }
-                        }
-                    }, 
-                    'gender': {
-                        '$getField': {
-                            'field': 'gender', 
-                            'input': {
-                                '$arrayElemAt': [
-                                    '$demographics', 0
-                                ]
-                            }
-                        }
-                    }, 
-                    'race_mapping': {
-                        '$getField': {
-                            'field': 'race_mapping', 
-                            'input': {
-                                '$arrayElemAt': [
-                                    '$demographics', 0
-                                ]
-                            }
-                        }
-                    }, 
-                    'ethnicity_mapping': {
-                        '$getField': {
-                            'field': 'ethnicity_mapping', 
-                            'input': {
-                                '$arrayElemAt': [
-                                    '$demographics', 0
-                                ]
-                            }
-                        }
-                    }
-                }
-            }, {
-                '$unset': 'demographics'
-            }
-        ]
-        self.run_aggregator(pipeline, 'demo')
-
-    def run_aggregator_medications(self):
-        pipeline = self.base_pipeline.copy() + [
+    def get_medications_pipeline(self):
+        return self.base_pipeline.copy() + [
             {
                 '$addFields': {
                     'medications': {
@@ -1750,5 +2459,4 @@ class AlbuminLab(PreprocessedLabs):
                     }
                 }
             }
-        ]
-        self.run_aggregator(pipeline, 'medications')
\ No newline at end of file
+        ]
\ No newline at end of file
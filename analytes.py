@@ -0,0 +1,25 @@
+def lab_tests(lab):
+    # Raw api_test_name -> analyte, as matched by the lab's base pipeline
+    return {name: lab.name for name in lab.base_pipeline[1]['$match']['lab_results.api_test_name']['$in']}
+
+
+def analyte_expression(tests, name):
+    # The analyte of a raw api_test_name; names outside tests must be
+    # filtered out first
+    analytes = {}
+    for test, analyte in tests.items():
+        analytes.setdefault(analyte, []).append(test)
+    return {
+        '$switch': {
+            'branches': [
+                {
+                    'case': {
+                        '$in': [
+                            name, names
+                        ]
+                    }, 
+                    'then': analyte
+                } for analyte, names in sorted(analytes.items())
+            ]
+        }
+    }
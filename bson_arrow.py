@@ -0,0 +1,176 @@
+import pandas as pd
+import pyarrow as pa
+
+# Declared result schema of every facet pipeline. Documents are decoded from
+# raw BSON batches straight into these Arrow columns; fields outside the
+# schema are dropped and values of another type become null
+LAB = pa.struct([
+    ('date', pa.timestamp('ms')),
+    ('result', pa.string()),
+    ('unit', pa.string()),
+    ('range', pa.string()),
+    ('api_test_name', pa.string())
+])
+
+FACET_SCHEMAS = {
+    'labs': {
+        '_id': pa.string(),
+        'PatientID': pa.string(),
+        'Practice': pa.string(),
+        'lab_after': LAB,
+        'lab_before': LAB,
+        'lab_history': pa.list_(pa.struct([
+            ('date', pa.timestamp('ms')),
+            ('result', pa.string()),
+            ('unit', pa.string()),
+            ('range', pa.string())
+        ]))
+    },
+    'vitals': {
+        '_id': pa.string(),
+        'PatientID': pa.string(),
+        'Practice': pa.string(),
+        'lab_before': LAB,
+        'vitals': pa.list_(pa.struct([
+            ('name', pa.string()),
+            ('result', pa.string()),
+            ('unit', pa.string()),
+            ('date', pa.timestamp('ms'))
+        ]))
+    },
+    'diagnosis': {
+        '_id': pa.string(),
+        'PatientID': pa.string(),
+        'Practice': pa.string(),
+        'diagnosis': pa.list_(pa.struct([
+            ('icd_10', pa.string())
+        ]))
+    },
+    'medications': {
+        '_id': pa.string(),
+        'PatientID': pa.string(),
+        'Practice': pa.string(),
+        'valid_lab_date': pa.timestamp('ms'),
+        'medications': pa.list_(pa.struct([
+            ('date', pa.timestamp('ms')),
+            ('gpi', pa.string()),
+            ('status', pa.string()),
+            ('action', pa.string()),
+            ('end_date', pa.timestamp('ms')),
+            ('days', pa.float64()),
+            ('dose_per_day', pa.float64()),
+            ('dosage', pa.float64())
+        ]))
+    }
+}
+
+
+def to_string(path):
+    return {
+        '$toString': path
+    }
+
+
+def string_results(field):
+    return {
+        '$map': {
+            'input': '$' + field, 
+            'as': 'item', 
+            'in': {
+                '$mergeObjects': [
+                    '$$item', {
+                        'result': to_string('$$item.result')
+                    }
+                ]
+            }
+        }
+    }
+
+
+# Results are numbers or strings such as '<5' in the source; normalization
+# parses both, so they are sent as strings. ObjectIds and GPI codes likewise,
+# and the PatientID and Practice join keys, which the decoder would otherwise
+# null when the source stores them as numbers
+FACET_STAGES = {
+    'labs': [
+        {
+            '$set': {
+                '_id': to_string('$_id'), 
+                'PatientID': to_string('$PatientID'), 
+                'Practice': to_string('$Practice'), 
+                'lab_after.result': to_string('$lab_after.result'), 
+                'lab_before.result': to_string('$lab_before.result'), 
+                'lab_history': string_results('lab_history')
+            }
+        }
+    ],
+    'vitals': [
+        {
+            '$set': {
+                '_id': to_string('$_id'), 
+                'PatientID': to_string('$PatientID'), 
+                'Practice': to_string('$Practice'), 
+                'lab_before.result': to_string('$lab_before.result'), 
+                'vitals': string_results('vitals')
+            }
+        }
+    ],
+    'diagnosis': [
+        {
+            '$set': {
+                '_id': to_string('$_id'), 
+                'PatientID': to_string('$PatientID'), 
+                'Practice': to_string('$Practice')
+            }
+        }
+    ],
+    'medications': [
+        {
+            '$set': {
+                '_id': to_string('$_id'), 
+                'PatientID': to_string('$PatientID'), 
+                'Practice': to_string('$Practice'), 
+                'medications': {
+                    '$map': {
+                        'input': '$medications', 
+                        'as': 'med', 
+                        'in': {
+                            '$mergeObjects': [
+                                '$$med', {
+                                    'gpi': to_string('$$med.gpi')
+                                }
+                            ]
+                        }
+                    }
+                }
+            }
+        }
+    ]
+}
+
+
+def arrow_pipeline(pipeline, facet):
+    projection = {field: 1 for field in FACET_SCHEMAS[facet]}
+    return pipeline + FACET_STAGES[facet] + [{'$project': projection}]
+
+
+def types_mapper(arrow_type):
+    # Strings and lists stay Arrow-backed; numbers and dates become NumPy
+    if pa.types.is_string(arrow_type) or pa.types.is_list(arrow_type):
+        return pd.ArrowDtype(arrow_type)
+
+
+def flatten(table):
+    # Nested records become dotted columns, as pd.json_normalize names them
+    while any(pa.types.is_struct(field.type) for field in table.schema):
+        table = table.flatten()
+    return table
+
+
+def decode_batch(raw_batch, facet):
+    # pymongoarrow is only needed for the Arrow decoding path
+    from pymongoarrow.context import PyMongoArrowContext
+    from pymongoarrow.schema import Schema
+    context = PyMongoArrowContext(Schema(FACET_SCHEMAS[facet]), allow_invalid=True)
+    context.process_bson_stream(raw_batch)
+    return flatten(context.finish()).to_pandas(types_mapper=types_mapper, coerce_temporal_nanoseconds=True)
@@ -0,0 +1,253 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from analytes import analyte_expression, lab_tests
+
+
+def gap_pipeline(tests, match=None):
+    # Days between consecutive labs of the same analyte, counted per analyte,
+    # Practice and day on the server. The sorted lab array is walked by index,
+    # so each document costs time linear in its number of labs
+    return ([match] if match else []) + [
+        {
+            '$match': {
+                'lab_results.api_test_name': {
+                    '$in': list(tests)
+                }
+            }
+        }, {
+            '$project': {
+                '_id': 0, 
+                'Practice': 1, 
+                'labs': {
+                    '$sortArray': {
+                        'input': {
+                            '$map': {
+                                'input': {
+                                    '$filter': {
+                                        'input': '$lab_results', 
+                                        'as': 'lab', 
+                                        'cond': {
+                                            '$and': [
+                                                {
+                                                    '$in': [
+                                                        '$$lab.api_test_name', list(tests)
+                                                    ]
+                                                }, {
+                                                    '$eq': [
+                                                        {
+                                                            '$type': '$$lab.date'
+                                                        }, 'date'
+                                                    ]
+                                                }
+                                            ]
+                                        }
+                                    }
+                                }, 
+                                'as': 'lab', 
+                                'in': {
+                                    'analyte': analyte_expression(tests, '$$lab.api_test_name'), 
+                                    'date': '$$lab.date'
+                                }
+                            }
+                        }, 
+                        'sortBy': {
+                            'analyte': 1, 
+                            'date': 1
+                        }
+                    }
+                }
+            }
+        }, {
+            '$project': {
+                'Practice': 1, 
+                'gaps': {
+                    '$filter': {
+                        'input': {
+                            '$map': {
+                                'input': {
+                                    '$range': [
+                                        1, {
+                                            '$size': '$labs'
+                                        }
+                                    ]
+                                }, 
+                                'as': 'i', 
+                                'in': {
+                                    '$let': {
+                                        'vars': {
+                                            'this': {
+                                                '$arrayElemAt': [
+                                                    '$labs', '$$i'
+                                                ]
+                                            }, 
+                                            'previous': {
+                                                '$arrayElemAt': [
+                                                    '$labs', {
+                                                        '$subtract': [
+                                                            '$$i', 1
+                                                        ]
+                                                    }
+                                                ]
+                                            }
+                                        }, 
+                                        'in': {
+                                            'analyte': '$$this.analyte', 
+                                            'same': {
+                                                '$eq': [
+                                                    '$$this.analyte', '$$previous.analyte'
+                                                ]
+                                            }, 
+                                            'days': {
+                                                '$dateDiff': {
+                                                    'startDate': '$$previous.date', 
+                                                    'endDate': '$$this.date', 
+                                                    'unit': 'day'
+                                                }
+                                            }
+                                        }
+                                    }
+                                }
+                            }
+                        }, 
+                        'as': 'gap', 
+                        'cond': '$$gap.same'
+                    }
+                }
+            }
+        }, {
+            '$unwind': '$gaps'
+        }, {
+            '$group': {
+                '_id': {
+                    'analyte': '$gaps.analyte', 
+                    'practice': '$Practice', 
+                    'days': '$gaps.days'
+                }, 
+                'count': {
+                    '$sum': 1
+                }
+            }
+        }
+    ]
+
+
+class GapHistogram:
+    # Counts of consecutive-lab gaps in fixed bins of bin_days per (analyte,
+    # practice); the last bin holds every gap of max_days or more. Histograms
+    # with the same bins add up, so partitions are counted separately and merged
+    def __init__(self, bin_days=1, max_days=730):
+        self.bin_days = bin_days
+        self.max_days = max_days
+        self.counts = {}
+
+    @property
+    def bins(self):
+        return self.max_days // self.bin_days + 1
+
+    @property
+    def edges(self):
+        return np.arange(self.bins) * self.bin_days
+
+    def add(self, analyte, practice, days, counts):
+        index = np.minimum(np.asarray(days, dtype=np.int64) // self.bin_days, self.bins - 1)
+        added = np.bincount(index, np.asarray(counts, dtype=np.int64), minlength=self.bins).astype(np.int64)
+        key = (analyte, practice)
+        self.counts[key] = self.counts.get(key, 0) + added
+        return self
+
+    def update(self, rows):
+        # Rows are the grouped documents of gap_pipeline
+        rows = pd.DataFrame([dict(row['_id'], count=row['count']) for row in rows], columns=['analyte', 'practice', 'days', 'count'])
+        for (analyte, practice), group in rows.groupby(['analyte', 'practice'], dropna=False, sort=False):
+            self.add(analyte, None if pd.isna(practice) else practice, group['days'], group['count'])
+        return self
+
+    def merge(self, other):
+        if (other.bin_days, other.max_days) != (self.bin_days, self.max_days):
+            raise ValueError('Histograms with different bins cannot be merged')
+        for key, counts in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + counts
+        return self
+
+    def total(self, analyte, practice=None):
+        # All practices unless one is named
+        counts = [c for (a, p), c in self.counts.items() if a == analyte and (practice is None or p == practice)]
+        return np.sum(counts, axis=0) if counts else np.zeros(self.bins, dtype=np.int64)
+
+    def share(self, analyte, low, high, practice=None):
+        # Fraction of gaps in [low, high) days, e.g. the pair window
+        counts = self.total(analyte, practice)
+        inside = counts[(self.edges >= low) & (self.edges + self.bin_days <= high)].sum()
+        return inside / counts.sum() if counts.sum() else np.nan
+
+    def quantiles(self, analyte, qs, practice=None):
+        # Lower edge of the bin holding each quantile
+        cumulative = np.cumsum(self.total(analyte, practice))
+        if not cumulative[-1]:
+            return [np.nan for _ in qs]
+        return [int(self.edges[np.searchsorted(cumulative, q * cumulative[-1])]) for q in qs]
+
+    def to_frame(self):
+        return pd.DataFrame([
+            {'analyte': analyte, 'practice': practice, 'days': int(edge), 'count': int(count)}
+            for (analyte, practice), counts in sorted(self.counts.items(), key=lambda item: (item[0][0], str(item[0][1])))
+            for edge, count in zip(self.edges, counts) if count
+        ], columns=['analyte', 'practice', 'days', 'count'])
+
+    def to_dict(self):
+        return {
+            'bin_days': self.bin_days,
+            'max_days': self.max_days,
+            'counts': [{'analyte': a, 'practice': p, 'counts': c.tolist()} for (a, p), c in self.counts.items()]
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        histogram = cls(state['bin_days'], state['max_days'])
+        histogram.counts = {(entry['analyte'], entry['practice']): np.asarray(entry['counts'], dtype=np.int64) for entry in state['counts']}
+        return histogram
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def bucket_matches(lab, partitions, sample_fraction=None):
+    # Disjoint ranges of the indexed sample_bucket field, covering the sample
+    # (or every bucket); a single unsampled partition needs no match at all
+    if partitions == 1 and sample_fraction is None:
+        return [None]
+    limit = lab.sample_buckets if sample_fraction is None else int(round(sample_fraction * lab.sample_buckets))
+    bounds = np.linspace(0, limit, partitions + 1).round().astype(int)
+    return [
+        {
+            '$match': {
+                'sample_bucket': {
+                    '$gte': int(low), 
+                    '$lt': int(high)
+                }
+            }
+        } for low, high in zip(bounds[:-1], bounds[1:]) if high > low
+    ]
+
+
+def collect_gaps(labs, partitions=1, sample_fraction=None, workers=None, bin_days=1, max_days=730):
+    # One pass over the collection for all analytes of the given lab classes,
+    # split into sample_bucket partitions that run concurrently on the server
+    lab = labs[0]
+    tests = {}
+    for each in labs:
+        tests.update(lab_tests(each))
+    matches = bucket_matches(lab, partitions, sample_fraction)
+    histogram = GapHistogram(bin_days, max_days)
+    with ThreadPoolExecutor(workers or len(matches)) as pool:
+        for part in pool.map(lambda match: GapHistogram(bin_days, max_days).update(lab.aggregate(gap_pipeline(tests, match))), matches):
+            histogram.merge(part)
+    return histogram
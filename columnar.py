@@ -0,0 +1,541 @@
+import argparse
+import copy
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from bson_arrow import FACET_SCHEMAS, flatten, types_mapper
+from equivalence import FACETS, compare_outputs
+from Preprecessed_UPDATED import ALTLab, ASTLab, AlbuminLab
+from analytes import lab_tests
+from streaming_stats import part_paths
+
+# Arrays of a patient document and the table each is flattened into; every
+# table row carries the document row and its position in the array
+ARRAYS = {
+    'lab_results': ('labs', [
+        ('api_test_name', pa.string()),
+        ('date', pa.timestamp('ms')),
+        ('result', pa.string()),
+        ('unit', pa.string()),
+        ('range', pa.string())
+    ]),
+    'vitals': ('vitals', [
+        ('name', pa.string()),
+        ('result', pa.string()),
+        ('unit', pa.string()),
+        ('date', pa.timestamp('ms'))
+    ]),
+    'medications': ('medications', [
+        ('date', pa.timestamp('ms')),
+        ('gpi', pa.string()),
+        ('status', pa.string()),
+        ('action', pa.string()),
+        ('end_date', pa.timestamp('ms')),
+        ('days', pa.float64()),
+        ('dose_g', pa.float64()),
+        ('frequency', pa.float64())
+    ]),
+    'diagnosis': ('diagnoses', [
+        ('date', pa.timestamp('ms')),
+        ('status', pa.string()),
+        ('icd_10', pa.string())
+    ])
+}
+
+LABS = {
+    'alt': ALTLab,
+    'ast': ASTLab,
+    'albumin': AlbuminLab
+}
+
+TABLES = ['patients'] + [table for table, _ in ARRAYS.values()]
+
+# Lab method of the Mongo path behind each facet
+RUNS = {
+    'labs': 'run_aggregator_labs',
+    'diagnosis': 'run_aggregator_diagnosis',
+    'vitals': 'run_aggregator_vitals',
+    'medications': 'run_aggregator_medications',
+    'demo': 'run_aggregator_demo'
+}
+
+logger = logging.getLogger('columnar')
+
+
+def to_double(path):
+    return {
+        '$convert': {
+            'input': path, 
+            'to': 'double', 
+            'onError': None
+        }
+    }
+
+
+def export_pipeline(demographics_fields):
+    # Patient documents in _id order with the fields the facet pipelines read.
+    # Results, ids and GPI codes are sent as strings, as bson_arrow does.
+    # Demographics are one computed document: as a nested projection they
+    # would be mapped over the demographics array
+    def records(field, fields):
+        return {
+            '$map': {
+                'input': '$' + field, 
+                'as': 'item', 
+                'in': fields
+            }
+        }
+
+    return [
+        {
+            '$sort': {
+                '_id': 1
+            }
+        }, {
+            '$project': {
+                '_id': {
+                    '$toString': '$_id'
+                }, 
+                'PatientID': {
+                    '$toString': '$PatientID'
+                }, 
+                'Practice': 1, 
+                'sample_bucket': 1, 
+                'demographics': {
+                    '$let': {
+                        'vars': {
+                            'first': {
+                                '$arrayElemAt': [
+                                    '$demographics', 0
+                                ]
+                            }
+                        }, 
+                        'in': {
+                            field: {
+                                '$getField': {
+                                    'field': field, 
+                                    'input': '$$first'
+                                }
+                            } for field in demographics_fields
+                        }
+                    }
+                }, 
+                'lab_results': records('lab_results', {
+                    'api_test_name': '$$item.api_test_name', 
+                    'date': '$$item.date', 
+                    'result': {
+                        '$toString': '$$item.result'
+                    }, 
+                    'unit': '$$item.unit', 
+                    'range': '$$item.range'
+                }), 
+                'vitals': records('vitals', {
+                    'name': '$$item.name', 
+                    'result': {
+                        '$toString': '$$item.result'
+                    }, 
+                    'unit': '$$item.unit', 
+                    'date': '$$item.date'
+                }), 
+                'medications': records('medications', {
+                    'date': '$$item.date', 
+                    'gpi': {
+                        '$toString': '$$item.gpi'
+                    }, 
+                    'status': '$$item.status', 
+                    'action': '$$item.action', 
+                    'end_date': '$$item.end_date', 
+                    'days': to_double('$$item.sig_parsed.days'), 
+                    'dose_g': to_double('$$item.sig_parsed.dose_g'), 
+                    'frequency': to_double('$$item.sig_parsed.frequency')
+                }), 
+                'diagnosis': records('diagnosis', {
+                    'date': '$$item.date', 
+                    'status': '$$item.status', 
+                    'icd_10': '$$item.icd_10'
+                })
+            }
+        }
+    ]
+
+
+def export_schema(demographics_fields):
+    # Values of another type than declared (e.g. a date stored as a string)
+    # are decoded as null, which the facet pipelines treat alike
+    demographics = [(field, pa.timestamp('ms') if field == 'date_of_birth' else pa.string()) for field in demographics_fields]
+    return dict({
+        '_id': pa.string(),
+        'PatientID': pa.string(),
+        'Practice': pa.string(),
+        'sample_bucket': pa.int64(),
+        'demographics': pa.struct(demographics)
+    }, **{field: pa.list_(pa.struct(fields)) for field, (_, fields) in ARRAYS.items()})
+
+
+def split_documents(documents, first_row):
+    # A decoded batch of documents as one row per patient plus one table per
+    # array. The patients table keeps the length of each array, null where the
+    # document has none, so that facets can tell a missing array from an
+    # empty one
+    rows = np.arange(first_row, first_row + documents.num_rows, dtype=np.int64)
+    patients = {'row': rows}
+    for field in ('_id', 'PatientID', 'Practice', 'sample_bucket'):
+        patients[field] = documents.column(field)
+    demographics = documents.column('demographics').combine_chunks()
+    for field in demographics.type:
+        patients[field.name] = pc.struct_field(demographics, field.name)
+    tables = {}
+    for field, (table, fields) in ARRAYS.items():
+        array = documents.column(field).combine_chunks()
+        patients[field + '_count'] = pc.list_value_length(array)
+        parents = pc.list_parent_indices(array).to_numpy()
+        lengths = pc.fill_null(pc.list_value_length(array), 0).to_numpy().astype(np.int64)
+        values = pc.list_flatten(array)
+        columns = {
+            'row': rows[parents],
+            'position': np.arange(len(parents), dtype=np.int32) - np.repeat(np.cumsum(lengths) - lengths, lengths).astype(np.int32)
+        }
+        for name, _ in fields:
+            columns[name] = pc.struct_field(values, name)
+        tables[table] = pa.table(columns)
+    tables['patients'] = pa.table(patients)
+    return tables
+
+
+def export_tables(lab, path):
+    # One pass over the collection, through the read routing of `lab`, into
+    # <path>/<table>/part-NNNNN.parquet. Rows are numbered in _id order, so the
+    # first n rows are the documents a $limit of n covers in run_chunks
+    from pymongoarrow.context import PyMongoArrowContext
+    from pymongoarrow.schema import Schema
+    schema = Schema(export_schema(lab.demographics_fields))
+    for table in TABLES:
+        os.makedirs(os.path.join(path, table), exist_ok=True)
+        for part in part_paths(os.path.join(path, table)):
+            os.remove(part)
+    rows = 0
+    for part, raw_batch in enumerate(lab.aggregate(export_pipeline(lab.demographics_fields), raw=True)):
+        context = PyMongoArrowContext(schema, allow_invalid=True)
+        context.process_bson_stream(raw_batch)
+        documents = context.finish()
+        for table, data in split_documents(documents, rows).items():
+            pq.write_table(data, os.path.join(path, table, 'part-%05d.parquet' % part))
+        rows += documents.num_rows
+    logger.info('exported %d documents to %s', rows, path)
+    return rows
+
+
+def scope_condition(stage):
+    # SQL for the documents the first stage of a base pipeline keeps: the
+    # leading $limit, or the hashed sample match of get_sample_stage
+    if '$limit' in stage:
+        return 'p.row < ?', [stage['$limit']]
+    query = stage['$match']
+    conditions, parameters = [], []
+    for term in query['$or'] if '$or' in query else [query]:
+        condition = ['p.sample_bucket < ?']
+        parameters.append(term['sample_bucket']['$lt'])
+        if 'Practice' in term:
+            condition.append('p.Practice IS NOT DISTINCT FROM ?')
+            parameters.append(term['Practice'])
+        conditions.append('(%s)' % ' AND '.join(condition))
+    return '(%s)' % (' OR '.join(conditions) or 'false'), parameters
+
+
+def lab_struct(alias, name):
+    return "{'date': %s.date, 'result': %s.result, 'unit': %s.unit, 'range': %s.range, 'api_test_name': %s}" % (alias, alias, alias, alias, name)
+
+
+# Every facet is one row per pair, in document order
+PAIRS_FROM = '''
+    FROM pairs x
+    JOIN patients p USING (row)
+    JOIN labs a ON a.row = x.row AND a.position = x.after_position
+    JOIN labs b ON b.row = x.row AND b.position = x.before_position
+'''
+
+# Facet queries; {lab_after} and {lab_before} are the records of the pair
+FACET_QUERIES = {
+    'labs': '''
+        SELECT p._id, p.PatientID, p.Practice, {lab_after} AS lab_after, {lab_before} AS lab_before, {history} AS lab_history
+        {pairs}
+        LEFT JOIN (
+            SELECT y.row, list({{'date': l.date, 'result': l.result, 'unit': l.unit, 'range': l.range}} ORDER BY y.rank) AS lab_history
+            FROM analyte y
+            JOIN pairs x USING (row)
+            JOIN labs l ON l.row = y.row AND l.position = y.position
+            WHERE y.date < x.before_date OR y.date IS NULL
+            GROUP BY y.row
+        ) h USING (row)
+        ORDER BY x.row
+    ''',
+    'diagnosis': '''
+        SELECT p._id, p.PatientID, p.Practice, CASE WHEN p.diagnosis_count IS NOT NULL THEN coalesce(d.diagnosis, []) END AS diagnosis
+        {pairs}
+        LEFT JOIN (
+            SELECT row, list({{'icd_10': icd_10}} ORDER BY position) AS diagnosis
+            FROM (
+                SELECT x.row, d.position, split_part(d.icd_10, '.', 1) AS icd_10
+                FROM pairs x
+                JOIN diagnoses d USING (row)
+                WHERE d.status = 'Active' AND d.date < x.before_date AND d.date >= x.before_date - to_years(?)
+                QUALIFY row_number() OVER (PARTITION BY x.row, split_part(d.icd_10, '.', 1) ORDER BY d.position) = 1
+            )
+            GROUP BY row
+        ) d USING (row)
+        ORDER BY x.row
+    ''',
+    'vitals': '''
+        SELECT p._id, p.PatientID, p.Practice, {lab_before} AS lab_before, CASE WHEN p.vitals_count IS NOT NULL THEN coalesce(v.vitals, []) END AS vitals
+        {pairs}
+        LEFT JOIN (
+            SELECT x.row, list({{'name': v.name, 'result': v.result, 'unit': v.unit, 'date': v.date}} ORDER BY v.position) AS vitals
+            FROM pairs x
+            JOIN vitals v USING (row)
+            WHERE v.date < x.before_date AND v.date >= x.before_date - to_days(?)
+            GROUP BY x.row
+        ) v USING (row)
+        ORDER BY x.row
+    ''',
+    'medications': '''
+        SELECT p._id, p.PatientID, p.Practice, x.after_date AS valid_lab_date, CASE WHEN p.medications_count IS NOT NULL THEN coalesce(m.medications, []) END AS medications
+        {pairs}
+        LEFT JOIN (
+            SELECT row, list({{
+                'date': date, 'gpi': gpi, 'status': status, 'action': action, 'end_date': end_date, 'days': days, 'dose_per_day': dose_per_day,
+                'dosage': CASE WHEN epoch_ms(date) + days * 86400000 > epoch_ms(after_date) THEN (epoch_ms(after_date) - epoch_ms(date)) / 86400000 * dose_per_day ELSE dose_per_day * days END
+            }} ORDER BY position) AS medications
+            FROM (
+                SELECT x.row, x.after_date, m.*, m.dose_g * m.frequency AS dose_per_day
+                FROM pairs x
+                JOIN medications m USING (row)
+                WHERE m.date >= x.before_date AND m.date <= x.after_date AND m.status = 'Active'
+            )
+            GROUP BY row
+        ) m USING (row)
+        ORDER BY x.row
+    ''',
+    'demo': '''
+        SELECT p._id, p.PatientID, p.Practice, b.date AS "lab_before.date", {demographics}
+        {pairs}
+        LEFT JOIN (
+            SELECT * FROM patients QUALIFY row_number() OVER (PARTITION BY PatientID ORDER BY row) = 1
+        ) d ON d.PatientID = p.PatientID
+        ORDER BY x.row
+    '''
+}
+
+
+def write_batch(lab, facet, table, part):
+    # Runs in a worker: the batch stages of the facet and the part write of
+    # the Mongo path. Demographics arrive joined and are split back out so
+    # that join_demographics computes age exactly as run_aggregator_demo does
+    df = flatten(table).to_pandas(types_mapper=types_mapper, coerce_temporal_nanoseconds=True)
+    if facet != 'demo':
+        return lab.write_frame(df, facet, part)
+    fields = lab.demographics_fields
+    demographics = df[['PatientID'] + fields].drop_duplicates('PatientID')
+    df = lab.join_demographics(df.drop(columns=fields), demographics)
+    lab.write_part(df.drop(columns='lab_before.date'), facet, part)
+
+
+class ColumnarStore:
+    # An export of the collection (export_tables) loaded into DuckDB. The
+    # facets of a lab are computed from its own base pipeline parameters as
+    # vectorized queries on every core, then pass through the same batch
+    # stages and part layout as the Mongo path (the 'arrow' decoder columns)
+    def __init__(self, path, database=':memory:', threads=None):
+        # Only the store needs duckdb; exporting does not
+        import duckdb
+        self.path = path
+        self.threads = threads or os.cpu_count()
+        self.connection = duckdb.connect(database, config={'threads': self.threads})
+        for table in TABLES:
+            # A database file keeps the tables of an earlier load
+            self.connection.execute('CREATE TABLE IF NOT EXISTS %s AS SELECT * FROM read_parquet(?)' % table, [os.path.join(path, table, 'part-*.parquet')])
+
+    def sample_stage(self, lab, sample_fraction, stratify_by_practice=False):
+        # get_sample_stage computed from the export: the stratified thresholds
+        # are found as PreprocessedLabs finds them, without the server
+        if not stratify_by_practice:
+            return lab.get_sample_stage(sample_fraction)
+        counts = self.connection.execute('SELECT Practice, sample_bucket, count(*) FROM patients GROUP BY ALL ORDER BY Practice, sample_bucket').fetchall()
+        thresholds = {}
+        for practice in dict.fromkeys(practice for practice, _, _ in counts):
+            buckets = [(bucket, count) for each, bucket, count in counts if each == practice]
+            wanted = max(1, round(sample_fraction * sum(count for _, count in buckets)))
+            seen = 0
+            for bucket, count in buckets:
+                seen += count
+                if seen >= wanted:
+                    thresholds[practice] = bucket + 1
+                    break
+        return {
+            '$match': {
+                '$or': [
+                    {
+                        'Practice': practice, 
+                        'sample_bucket': {
+                            '$lt': threshold
+                        }
+                    } for practice, threshold in thresholds.items()
+                ]
+            }
+        }
+
+    def select_pairs(self, lab, first_stage=None):
+        # Pair selection of the base pipeline: the labs of the analyte sorted
+        # by date descending (ties in array order), each compared with the one
+        # before it, and the last pair inside the window kept. Labs without a
+        # date sort last and never pair
+        tests = list(lab_tests(lab))
+        condition, parameters = scope_condition(first_stage or lab.base_pipeline[0])
+        self.connection.execute('''
+            CREATE OR REPLACE TEMP TABLE analyte AS
+            SELECT l.row, l.position, l.date, row_number() OVER (PARTITION BY l.row ORDER BY l.date DESC NULLS LAST, l.position) AS rank
+            FROM labs l
+            JOIN (
+                SELECT p.row FROM patients p
+                WHERE %s AND EXISTS (SELECT 1 FROM labs m WHERE m.row = p.row AND list_contains(?, m.api_test_name))
+            ) USING (row)
+            WHERE list_contains(?, l.api_test_name) OR l.api_test_name = ?
+        ''' % condition, parameters + [tests, tests, lab.name])
+        min_days, max_days = lab.pair_window_days
+        self.connection.execute('''
+            CREATE OR REPLACE TEMP TABLE pairs AS
+            SELECT row, max(rank) AS before_rank, arg_max(position, rank) AS before_position, arg_max(date, rank) AS before_date,
+                arg_max(after_position, rank) AS after_position, arg_max(after_date, rank) AS after_date
+            FROM (
+                SELECT *, lag(position) OVER w AS after_position, lag(date) OVER w AS after_date
+                FROM analyte
+                WINDOW w AS (PARTITION BY row ORDER BY rank)
+            )
+            WHERE date_diff('day', date, after_date) >= ? AND date_diff('day', date, after_date) < ?
+            GROUP BY row
+        ''', [min_days, max_days])
+        return self.connection.execute('SELECT count(*) FROM pairs').fetchone()[0]
+
+    def facet_query(self, lab, facet):
+        name = "'%s'" % lab.name.replace("'", "''")
+        query = FACET_QUERIES[facet].format(
+            pairs=PAIRS_FROM,
+            lab_after=lab_struct('a', name),
+            lab_before=lab_struct('b', name),
+            history='coalesce(h.lab_history, [])' if lab.trend_features else 'NULL::STRUCT("date" TIMESTAMP, "result" VARCHAR, "unit" VARCHAR, "range" VARCHAR)[]',
+            demographics=', '.join('d.%s' % field for field in lab.demographics_fields)
+        )
+        parameters = {'diagnosis': [lab.diagnosis_lookback_years], 'vitals': [lab.vitals_lookback_days]}.get(facet, [])
+        return query, parameters
+
+    def run_facet(self, lab, facet, pool, workers):
+        # Result batches of batch_size rows become parts, written by the pool
+        # while the query streams; at most two batches per worker are in flight
+        query, parameters = self.facet_query(lab, facet)
+        schema = pa.schema(FACET_SCHEMAS[facet]) if facet in FACET_SCHEMAS else None
+        lab.clear_facet(facet)
+        reader = self.connection.execute(query, parameters).fetch_record_batch(lab.batch_size)
+        running, part = set(), 0
+        for batch in reader:
+            if not batch.num_rows:
+                continue
+            table = pa.Table.from_batches([batch])
+            running.add(pool.submit(write_batch, lab, facet, table.cast(schema) if schema is not None else table, part))
+            part += 1
+            if len(running) >= 2 * workers:
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    future.result()
+        for future in running:
+            future.result()
+        if part == 0:
+            lab.write_batch([], facet, 0)
+        return part
+
+    def run(self, lab, facets=FACETS, workers=None, first_stage=None):
+        # Seconds spent per step; pairs are selected once for all facets
+        seconds = {}
+        start = time.time()
+        pairs = self.select_pairs(lab, first_stage)
+        seconds['pairs'] = time.time() - start
+        logger.info('%s: %d pairs', lab.name, pairs)
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for facet in facets:
+                start = time.time()
+                parts = self.run_facet(lab, facet, pool, workers)
+                seconds[facet] = time.time() - start
+                logger.info('%s %s: %d parts in %.1fs', lab.name, facet, parts, seconds[facet])
+        return seconds
+
+
+def benchmark(labs, store, output_dir, facets=FACETS, workers=None):
+    # Runs every facet of every lab through the Mongo path and through the
+    # store into output_dir/mongo and output_dir/columnar, and compares them
+    # patient by patient. The Mongo path decodes with the Arrow schemas the
+    # store writes, and never reuses a snapshot
+    results = []
+    for lab in labs:
+        mongo, columnar = copy.copy(lab), copy.copy(lab)
+        mongo.output_dir, columnar.output_dir = os.path.join(output_dir, 'mongo'), os.path.join(output_dir, 'columnar')
+        mongo.use_snapshots, mongo.decoder, mongo.arrow_facets = False, 'arrow', list(FACET_SCHEMAS)
+        seconds = {}
+        for facet in facets:
+            start = time.time()
+            getattr(mongo, RUNS[facet])()
+            seconds[facet] = time.time() - start
+        columnar_seconds = store.run(columnar, facets, workers)
+        for facet in facets:
+            _, summary = compare_outputs(mongo.facet_dir(facet), columnar.facet_dir(facet))
+            results.append({
+                'lab': lab.name,
+                'facet': facet,
+                'mongo_seconds': seconds[facet],
+                'columnar_seconds': columnar_seconds[facet],
+                'pairs_seconds': columnar_seconds['pairs'],
+                'equal': summary['equal'],
+                'differing_patients': summary['differing_patients']
+            })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extract the lab facets offline from a columnar export of the collection.')
+    parser.add_argument('command', choices=['export', 'run', 'benchmark'])
+    parser.add_argument('--export-dir', default=os.path.join('output', 'export'))
+    parser.add_argument('--database', default=':memory:', help='DuckDB file to keep the loaded tables in')
+    parser.add_argument('--output-dir', default=None, help='output_dir of the facets (default: the labs\' own)')
+    parser.add_argument('--labs', nargs='+', choices=sorted(LABS), default=sorted(LABS))
+    parser.add_argument('--facets', nargs='+', choices=FACETS, default=FACETS)
+    parser.add_argument('--sample-fraction', type=float, default=None)
+    parser.add_argument('--stratify-by-practice', action='store_true')
+    parser.add_argument('--threads', type=int, default=None, help='DuckDB threads (default: all cores)')
+    parser.add_argument('--workers', type=int, default=None, help='processes writing parts (default: all cores)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    instances = [LABS[name]() for name in args.labs]
+    if args.command == 'export':
+        export_tables(instances[0], args.export_dir)
+        return 0
+    start = time.time()
+    store = ColumnarStore(args.export_dir, args.database, args.threads)
+    logger.info('loaded %s in %.1fs', args.export_dir, time.time() - start)
+    if args.command == 'benchmark':
+        for result in benchmark(instances, store, args.output_dir or os.path.join('output', 'benchmark'), args.facets, args.workers):
+            print('%(lab)s %(facet)s: mongo %(mongo_seconds).1fs, columnar %(columnar_seconds).1fs (+%(pairs_seconds).1fs pairs), equal %(equal)s' % result)
+        return 0
+    for lab in instances:
+        if args.output_dir is not None:
+            lab.output_dir = args.output_dir
+        first_stage = store.sample_stage(lab, args.sample_fraction, args.stratify_by_practice) if args.sample_fraction is not None else None
+        store.run(lab, args.facets, args.workers, first_stage)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
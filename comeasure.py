@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+from analytes import analyte_expression
+from normalization import explode_records, normalize_values
+
+# Analytes that get joint columns on co-measurement rows, whatever the anchor
+DRAW_ANALYTES = ['alanine_aminotransferase', 'aspartate_aminotransferase', 'albumin']
+
+# Sides of a pair and the array of other labs kept near each of its draws
+DRAW_SIDES = {
+    'lab_before': 'co_before',
+    'lab_after': 'co_after'
+}
+
+
+def co_labs_stage(tests):
+    # The dated labs of the other analytes, taken before the base pipeline
+    # filters lab_results down to the anchor analyte
+    return {
+        '$set': {
+            'co_labs': {
+                '$sortArray': {
+                    'input': {
+                        '$map': {
+                            'input': {
+                                '$filter': {
+                                    'input': '$lab_results', 
+                                    'as': 'lab', 
+                                    'cond': {
+                                        '$and': [
+                                            {
+                                                '$in': [
+                                                    '$$lab.api_test_name', list(tests)
+                                                ]
+                                            }, {
+                                                '$eq': [
+                                                    {
+                                                        '$type': '$$lab.date'
+                                                    }, 'date'
+                                                ]
+                                            }
+                                        ]
+                                    }
+                                }
+                            }, 
+                            'as': 'lab', 
+                            'in': {
+                                'analyte': analyte_expression(tests, '$$lab.api_test_name'), 
+                                'date': '$$lab.date', 
+                                'result': '$$lab.result', 
+                                'unit': '$$lab.unit'
+                            }
+                        }
+                    }, 
+                    'sortBy': {
+                        'date': 1
+                    }
+                }
+            }
+        }
+    }
+
+
+def near_draw(index, tolerance_ms):
+    return {
+        '$filter': {
+            'input': '$co_labs', 
+            'as': 'lab', 
+            'cond': {
+                '$lte': [
+                    {
+                        '$abs': {
+                            '$subtract': [
+                                '$$lab.date', {
+                                    '$arrayElemAt': [
+                                        '$valid_labs.date', index
+                                    ]
+                                }
+                            ]
+                        }
+                    }, tolerance_ms
+                ]
+            }
+        }
+    }
+
+
+def draw_stage(tolerance_hours):
+    # After pair selection valid_labs is [lab_after, lab_before]; only labs
+    # within the tolerance of either draw are kept
+    tolerance_ms = int(tolerance_hours * 3600 * 1000)
+    return {
+        '$set': {
+            'co_before': near_draw(1, tolerance_ms), 
+            'co_after': near_draw(0, tolerance_ms), 
+            'co_labs': '$$REMOVE'
+        }
+    }
+
+
+def join_draws(df):
+    # For each draw of the pair, the value of every analyte measured with it:
+    # the anchor's own result, or the closest lab of another analyte kept by
+    # draw_stage. The closest lab is found by grouping, so a batch is joined in
+    # time linear in its labs. Also adds the AST/ALT (De Ritis) ratio
+    for side, column in DRAW_SIDES.items():
+        if column not in df.columns:
+            continue
+        labs = explode_records(df[column]).reindex(columns=['analyte', 'date', 'result', 'unit'])
+        row = pd.Index(df.index).get_indexer(labs.index)
+        analyte = labs['analyte'].to_numpy(dtype=object)
+        value, censored, _, _ = normalize_values(analyte, labs['result'], labs['unit'])
+        dates = pd.to_datetime(labs['date']).to_numpy(dtype='datetime64[ns]')
+        anchor_dates = pd.to_datetime(df[side + '.date']).to_numpy(dtype='datetime64[ns]')
+        near = pd.DataFrame({
+            'row': row,
+            'analyte': analyte,
+            'distance': np.abs(dates - anchor_dates[row]),
+            'value': value,
+            'censored': censored,
+            'date': dates
+        })
+        # A pair side without a date has no nearest lab
+        near = near[near['value'].notna() & near['distance'].notna()]
+        # Labs arrive in date order, so ties go to the earlier lab
+        near = near.loc[near.groupby(['row', 'analyte'])['distance'].idxmin()] if len(near) else near
+        anchor = df[side + '.api_test_name'].to_numpy(dtype=object)
+        for name in DRAW_ANALYTES:
+            values = np.where(anchor == name, df[side + '.value'].to_numpy(dtype=float), np.nan)
+            flags = np.where(anchor == name, df[side + '.censored'].to_numpy(dtype=float), np.nan)
+            found = near[near['analyte'] == name]
+            values[found['row'].to_numpy()] = found['value'].to_numpy()
+            flags[found['row'].to_numpy()] = found['censored'].to_numpy()
+            df['%s.%s.value' % (side, name)] = values
+            df['%s.%s.censored' % (side, name)] = flags
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ast = df[side + '.aspartate_aminotransferase.value'].to_numpy()
+            alt = df[side + '.alanine_aminotransferase.value'].to_numpy()
+            df[side + '.ast_alt_ratio'] = np.where(alt > 0, ast / alt, np.nan)
+        df = df.drop(columns=column)
+    return df
@@ -0,0 +1,88 @@
+import os
+import uuid
+import numpy as np
+import pandas as pd
+from streaming_stats import part_paths
+
+
+class DemographicsCache:
+    # The demographics dimension shared by every lab class, one row per
+    # PatientID, in append-only parts under <path>/bucket-NNN split by a hash
+    # of the PatientID. A lookup reads only the buckets of the ids asked for.
+    # Rows fetched for ids not cached yet become a new part of their bucket,
+    # so lab classes running at the same time never overwrite each other; a
+    # PatientID written by both is read once
+    def __init__(self, path, fields, buckets=64):
+        self.path = path
+        self.fields = list(fields)
+        self.buckets = buckets
+
+    @property
+    def columns(self):
+        return ['PatientID'] + self.fields
+
+    def bucket(self, patient_ids):
+        ids = np.asarray(patient_ids, dtype=object).astype(str).astype(object)
+        return (pd.util.hash_array(ids) % np.uint64(self.buckets)).astype(np.int64)
+
+    def bucket_dir(self, bucket):
+        return os.path.join(self.path, 'bucket-%03d' % bucket)
+
+    def read_bucket(self, bucket, patient_ids=None):
+        frames = [pd.read_parquet(part) for part in part_paths(self.bucket_dir(bucket))]
+        if not frames:
+            return pd.DataFrame(columns=self.columns)
+        frame = pd.concat(frames, ignore_index=True)
+        if patient_ids is not None:
+            frame = frame[frame['PatientID'].isin(patient_ids)]
+        return frame.drop_duplicates('PatientID')
+
+    def get(self, patient_ids, fetch=None):
+        # Cached rows of the given ids. Ids not cached are passed to fetch, if
+        # given, and the rows it returns are added to the cache
+        patient_ids = pd.Index(pd.unique(np.asarray(patient_ids, dtype=object)))
+        buckets = self.bucket(patient_ids)
+        found = [self.read_bucket(bucket, patient_ids[buckets == bucket]) for bucket in np.unique(buckets)]
+        found = pd.concat(found, ignore_index=True) if found else pd.DataFrame(columns=self.columns)
+        missing = patient_ids.difference(found['PatientID'])
+        if fetch is not None and len(missing):
+            fetched = fetch(missing)
+            self.add(fetched)
+            found = pd.concat([found, fetched], ignore_index=True) if len(found) else fetched
+        return found.reset_index(drop=True)
+
+    def add(self, frame):
+        for bucket, rows in frame.groupby(self.bucket(frame['PatientID'])):
+            path = self.bucket_dir(bucket)
+            os.makedirs(path, exist_ok=True)
+            name = uuid.uuid4().hex
+            # Readers never see a partial part
+            rows.to_parquet(os.path.join(path, '.%s.tmp' % name), index=False)
+            os.replace(os.path.join(path, '.%s.tmp' % name), os.path.join(path, 'part-%s.parquet' % name))
+
+    def load(self):
+        # Every cached row, indexed by PatientID
+        frames = [self.read_bucket(bucket) for bucket in range(self.buckets)]
+        return pd.concat(frames, ignore_index=True).drop_duplicates('PatientID').set_index('PatientID')
+
+
+class DemographicsIndex:
+    # An in-memory index of the cache for long-running readers, loaded once.
+    # Ids not in it are passed to fetch and kept in memory only, so that
+    # lookups never touch the disk; ids fetch found nothing for are not
+    # asked for again
+    def __init__(self, cache, fetch=None):
+        self.fields = cache.fields
+        self.fetch = fetch
+        self.frame = cache.load()
+        self.absent = set()
+
+    def get(self, patient_ids):
+        patient_ids = pd.Index(pd.unique(np.asarray(patient_ids, dtype=object)))
+        missing = patient_ids.difference(self.frame.index).difference(list(self.absent))
+        if self.fetch is not None and len(missing):
+            fetched = self.fetch(missing).drop_duplicates('PatientID').set_index('PatientID')
+            self.frame = pd.concat([self.frame, fetched]) if len(self.frame) else fetched
+            self.absent.update(missing.difference(fetched.index))
+        found = self.frame.loc[patient_ids.intersection(self.frame.index, sort=False)]
+        return found.rename_axis('PatientID').reset_index()
@@ -0,0 +1,253 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from streaming_stats import part_paths
+
+FACETS = ['labs', 'diagnosis', 'vitals', 'medications', 'demo']
+
+# Per-patient records of the spill files besides the fields themselves
+ROWS = '\x00rows'
+ROW_HASH = '\x00row'
+
+SPILL_SCHEMA = pa.schema([
+    ('patient', pa.string()),
+    ('field', pa.string()),
+    ('hash', pa.uint64())
+])
+
+# Value families, so that e.g. a number and a string never hash alike
+SALTS = {
+    'number': np.uint64(0x9e3779b97f4a7c15),
+    'date': np.uint64(0xc2b2ae3d27d4eb4f),
+    'string': np.uint64(0x165667b19e3779f9),
+    'record': np.uint64(0x85ebca6b0c2b2ae3),
+    'list': np.uint64(0x3c6ef372fe94f82b),
+    'json': np.uint64(0x27d4eb2f165667c5)
+}
+
+
+def mix(x):
+    # splitmix64 finalizer
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return x ^ (x >> np.uint64(31))
+
+
+def name_hash(name):
+    return np.uint64(int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), 'little'))
+
+
+def plain(value):
+    # Nested values as JSON-able structures that do not depend on how a part
+    # happened to type them; null members of records are dropped
+    if isinstance(value, dict):
+        return {str(key): plain(item) for key, item in value.items() if not is_null(item)}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [plain(item) for item in value]
+    if is_null(value):
+        return None
+    if isinstance(value, (bool, np.bool_, int, np.integer, float, np.floating)):
+        return float(value) + 0.0
+    if isinstance(value, (pd.Timestamp, np.datetime64)) or hasattr(value, 'isoformat'):
+        return {'$date': pd.Timestamp(value).isoformat()}
+    return str(value)
+
+
+def is_null(value):
+    return not isinstance(value, (dict, list, tuple, np.ndarray)) and bool(pd.isna(value))
+
+
+def array_hashes(array):
+    # One uint64 per value of an Arrow array, 0 for nulls. Equal values hash
+    # alike whatever type a part stored them with: json_normalize types each
+    # batch anew, so a field can be int64 in one part, double in another and
+    # null-typed where a batch had no value. Records and lists are hashed
+    # from their flattened children, so nested columns stay vectorized
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    if pa.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    kind = array.type
+    null = array.is_null().to_numpy(zero_copy_only=False)
+    if pa.types.is_null(kind):
+        return np.zeros(len(array), dtype=np.uint64)
+    if pa.types.is_struct(kind):
+        # Null members count as absent, as they are in the JSON of a record
+        total = np.zeros(len(array), dtype=np.uint64)
+        for field, child in zip(kind, array.flatten()):
+            hashes = array_hashes(child)
+            with np.errstate(over='ignore'):
+                total += np.where(hashes == 0, np.uint64(0), mix(hashes ^ name_hash(field.name)))
+        hashes = total ^ SALTS['record']
+    elif pa.types.is_list(kind) or pa.types.is_large_list(kind):
+        # Order matters: each element is hashed with its position
+        lengths = pc.fill_null(pc.list_value_length(array), 0).to_numpy().astype(np.int64)
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        values = array_hashes(array.flatten())
+        position = np.arange(len(values)) - np.repeat(starts, lengths)
+        with np.errstate(over='ignore'):
+            sums = np.concatenate([np.zeros(1, dtype=np.uint64), np.cumsum(mix(values ^ mix(position.astype(np.uint64) + SALTS['list'])), dtype=np.uint64)])
+            hashes = (sums[ends] - sums[starts]) ^ SALTS['list']
+    elif pa.types.is_integer(kind) or pa.types.is_floating(kind) or pa.types.is_boolean(kind) or pa.types.is_decimal(kind):
+        numbers = pc.cast(array, pa.float64()).to_numpy(zero_copy_only=False) + 0.0
+        hashes = pd.util.hash_array(np.where(null, 0.0, numbers)) ^ SALTS['number']
+    elif pa.types.is_timestamp(kind) or pa.types.is_date(kind):
+        unit = pa.timestamp('ns', tz=getattr(kind, 'tz', None))
+        stamps = pc.cast(pc.cast(array, unit), pa.int64()).to_numpy(zero_copy_only=False)
+        hashes = pd.util.hash_array(np.where(null, 0, stamps).astype(np.int64)) ^ SALTS['date']
+    elif pa.types.is_string(kind) or pa.types.is_large_string(kind):
+        hashes = pd.util.hash_array(np.where(null, '', array.to_numpy(zero_copy_only=False)).astype(object)) ^ SALTS['string']
+    else:
+        text = np.array([json.dumps(plain(value), sort_keys=True, separators=(',', ':')) for value in array.to_pylist()], dtype=object)
+        hashes = pd.util.hash_array(text) ^ SALTS['json']
+    hashes = mix(hashes.astype(np.uint64))
+    hashes[hashes == 0] = 1
+    hashes[null] = 0
+    return hashes
+
+
+def batch_records(batch, key, ignore=()):
+    # (patient, field, hash) sums of one record batch: every non-null field of
+    # every row, the row count, and a hash of each whole row so that values
+    # swapped between rows of a patient are still seen
+    patients = pc.cast(batch.column(key), pa.string()).to_numpy(zero_copy_only=False)
+    patients = np.where(pd.isna(patients), 'None', patients).astype(object)
+    rows = np.zeros(batch.num_rows, dtype=np.uint64)
+    fields = []
+    for column in sorted(batch.schema.names):
+        if column == key or column in ignore:
+            continue
+        hashes = array_hashes(batch.column(column))
+        contribution = np.where(hashes == 0, np.uint64(0), mix(hashes ^ name_hash(column)))
+        with np.errstate(over='ignore'):
+            rows += contribution
+        fields.append(pd.DataFrame({'patient': patients, 'field': column, 'hash': contribution})[hashes != 0])
+    fields.append(pd.DataFrame({'patient': patients, 'field': ROWS, 'hash': np.ones(batch.num_rows, dtype=np.uint64)}))
+    fields.append(pd.DataFrame({'patient': patients, 'field': ROW_HASH, 'hash': mix(rows)}))
+    records = pd.concat(fields, ignore_index=True)
+    return records.groupby(['patient', 'field'], sort=False, as_index=False)['hash'].sum()
+
+
+def spill(path, work_dir, partitions, key, batch_size, ignore=()):
+    # Streams the parts of a facet into one spill file per PatientID hash
+    # partition; memory holds one batch at a time
+    os.makedirs(work_dir, exist_ok=True)
+    writers = [ipc.new_stream(os.path.join(work_dir, 'partition-%05d.arrow' % i), SPILL_SCHEMA) for i in range(partitions)]
+    columns = set()
+    try:
+        for part in part_paths(path):
+            for batch in pq.ParquetFile(part).iter_batches(batch_size):
+                if not batch.num_rows:
+                    continue
+                columns.update(batch.schema.names)
+                records = batch_records(batch, key, ignore)
+                partition = pd.util.hash_array(records['patient'].to_numpy(dtype=object)) % np.uint64(partitions)
+                for i, group in records.groupby(partition):
+                    writers[int(i)].write_table(pa.Table.from_pandas(group, schema=SPILL_SCHEMA, preserve_index=False))
+    finally:
+        for writer in writers:
+            writer.close()
+    return columns - {key} - set(ignore)
+
+
+def read_spill(work_dir, i):
+    with ipc.open_stream(os.path.join(work_dir, 'partition-%05d.arrow' % i)) as reader:
+        records = reader.read_pandas()
+    return records.groupby(['patient', 'field'], sort=False)['hash'].sum()
+
+
+def compare_partition(left, right):
+    # Differing patients of one partition with the fields that differ
+    index = left.index.union(right.index)
+    left, right = left.reindex(index, fill_value=0), right.reindex(index, fill_value=0)
+    changed = index[(left != right).to_numpy()].to_frame(index=False)
+    if not len(changed):
+        return []
+    report = []
+    for patient, group in changed.groupby('patient', sort=True):
+        if not left.get((patient, ROWS), 0):
+            status = 'only_right'
+        elif not right.get((patient, ROWS), 0):
+            status = 'only_left'
+        else:
+            status = 'changed'
+        fields = sorted(field for field in group['field'] if not field.startswith('\x00'))
+        if status == 'changed' and ROWS in set(group['field']):
+            fields.insert(0, '(row count)')
+        elif status == 'changed' and not fields:
+            fields = ['(rows)']
+        report.append({'PatientID': patient, 'status': status, 'fields': fields})
+    return report
+
+
+def compare_outputs(left, right, key='PatientID', partitions=64, batch_size=65536, ignore=(), work_dir=None):
+    # Compares two outputs of one facet (facet directories or snapshots) as
+    # multisets of rows per PatientID. Both sides are hashed in one streaming
+    # pass into `partitions` spill files each, then compared a partition at a
+    # time; returns the differing patients and a summary
+    left, right = getattr(left, 'path', left), getattr(right, 'path', right)
+    work_dir = tempfile.mkdtemp(prefix='equivalence-', dir=work_dir)
+    try:
+        left_columns = spill(left, os.path.join(work_dir, 'left'), partitions, key, batch_size, ignore)
+        right_columns = spill(right, os.path.join(work_dir, 'right'), partitions, key, batch_size, ignore)
+        report, patients = [], {'left': 0, 'right': 0}
+        for i in range(partitions):
+            left_hashes, right_hashes = read_spill(os.path.join(work_dir, 'left'), i), read_spill(os.path.join(work_dir, 'right'), i)
+            for side, hashes in (('left', left_hashes), ('right', right_hashes)):
+                patients[side] += int((hashes.index.get_level_values('field') == ROWS).sum())
+            report.extend(compare_partition(left_hashes, right_hashes))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    differences = pd.DataFrame(report, columns=['PatientID', 'status', 'fields'])
+    summary = {
+        'patients_left': patients['left'],
+        'patients_right': patients['right'],
+        'differing_patients': len(differences),
+        'columns_only_left': sorted(left_columns - right_columns),
+        'columns_only_right': sorted(right_columns - left_columns),
+        'equal': not len(differences)
+    }
+    return differences, summary
+
+
+def compare_labs(left_dir, right_dir, labs, facets=FACETS, **options):
+    # Every facet of every lab under two output_dir layouts
+    results = {}
+    for lab in labs:
+        for facet in facets:
+            results[lab, facet] = compare_outputs(os.path.join(left_dir, lab, facet), os.path.join(right_dir, lab, facet), **options)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the facet outputs of two extraction runs patient by patient.')
+    parser.add_argument('left', help='output_dir of the first run')
+    parser.add_argument('right', help='output_dir of the second run')
+    parser.add_argument('--labs', nargs='+', default=['alanine_aminotransferase', 'aspartate_aminotransferase', 'albumin'])
+    parser.add_argument('--facets', nargs='+', default=FACETS)
+    parser.add_argument('--partitions', type=int, default=64, help='PatientID hash partitions; memory scales with one partition')
+    parser.add_argument('--ignore', nargs='*', default=[], help='columns left out of the comparison, e.g. _id')
+    parser.add_argument('--show', type=int, default=20, help='differing patients printed per facet')
+    args = parser.parse_args(argv)
+    equal = True
+    for (lab, facet), (differences, summary) in compare_labs(args.left, args.right, args.labs, args.facets, partitions=args.partitions, ignore=args.ignore).items():
+        equal &= summary['equal']
+        print('%s %s: %s' % (lab, facet, json.dumps(summary)))
+        for row in differences.head(args.show).itertuples(index=False):
+            print('  %s %s %s' % (row.PatientID, row.status, ', '.join(row.fields)))
+    return 0 if equal else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from sklearn.pipeline import Pipeline
+from search import SharedArrays, attach, worker_arrays
+from splits import group_codes
+
+
+def model_hash(model):
+    return hashlib.sha256(pickle.dumps(model)).hexdigest()[:16]
+
+
+def strata(matrix, stratify, n_bins=10):
+    if stratify == 'practice':
+        return group_codes(matrix.practices)
+    if stratify == 'patient':
+        return group_codes(matrix.patient_ids)
+    if stratify == 'target':
+        y = np.asarray(matrix.y)
+        return np.digitize(y, np.unique(np.quantile(y, np.arange(1, n_bins) / n_bins)))
+    if stratify is None:
+        return np.zeros(len(matrix.y), dtype=np.int64)
+    raise ValueError('Unknown stratification %r' % stratify)
+
+
+def stratified_sample(codes, size, seed=0):
+    # Exactly size rows, allocated to strata in proportion to their rows with
+    # at least one per stratum when size allows it. Fractional quotas are
+    # settled by drawing strata with probability proportional to their
+    # remainders, so with more strata than rows the strata themselves are
+    # sampled proportionally. Rows are taken in a seeded random order within
+    # each stratum, so the sample is stable
+    n = len(codes)
+    if size is None or size >= n:
+        return np.arange(n)
+    counts = np.bincount(codes)
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(n)
+    base = (counts > 0).astype(np.int64) if size >= np.count_nonzero(counts) else np.zeros(len(counts), dtype=np.int64)
+    share = (counts - base) * (size - base.sum()) / max((counts - base).sum(), 1)
+    quota = base + np.floor(share).astype(np.int64)
+    remainder = share - np.floor(share)
+    extra = size - quota.sum()
+    if extra > 0:
+        quota[rng.choice(len(counts), extra, replace=False, p=remainder / remainder.sum())] += 1
+    order = order[np.argsort(codes[order], kind='stable')]
+    starts = np.cumsum(counts) - counts
+    rank = np.arange(n) - starts[codes[order]]
+    return np.sort(order[rank < quota[codes[order]]])
+
+
+worker_explainer = {}
+
+
+def start_worker(specs, estimator, preprocess, feature_perturbation):
+    attach(specs)
+    import shap
+    background = worker_arrays['background'] if feature_perturbation == 'interventional' else None
+    worker_explainer['preprocess'] = preprocess
+    worker_explainer['explainer'] = shap.TreeExplainer(estimator, data=background, feature_perturbation=feature_perturbation)
+
+
+def explain_chunk(start, end):
+    X = worker_arrays['X'][worker_arrays['rows'][start:end]]
+    if worker_explainer['preprocess'] is not None:
+        X = worker_explainer['preprocess'].transform(X)
+    return np.asarray(worker_explainer['explainer'].shap_values(X, check_additivity=False), dtype=np.float32)
+
+
+class ShapResult:
+    def __init__(self, values, rows, expected_value, names):
+        self.values = values
+        self.rows = rows
+        self.expected_value = expected_value
+        self.names = names
+
+    def importance(self):
+        # Mean |SHAP| per feature, largest first
+        mean = np.abs(self.values).mean(axis=0)
+        return sorted(zip(self.names, mean.tolist()), key=lambda item: -item[1])
+
+    def save(self, path):
+        np.save(os.path.join(path, 'values.npy'), self.values)
+        np.save(os.path.join(path, 'rows.npy'), self.rows)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'expected_value': self.expected_value, 'names': self.names}, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        return cls(np.load(os.path.join(path, 'values.npy')), np.load(os.path.join(path, 'rows.npy')), meta['expected_value'], meta['names'])
+
+
+def explain(matrix, model, sample=5000, background=200, stratify='practice', feature_perturbation='interventional', chunk_size=250, max_workers=None, seed=0, cache_dir=os.path.join('artifacts', 'shap')):
+    # TreeSHAP over a stratified sample of the feature matrix, split into chunks
+    # across processes. Results are cached under the matrix version and model
+    # hash; finished chunks are kept, so an interrupted run resumes
+    codes = strata(matrix, stratify)
+    rows = stratified_sample(codes, sample, seed)
+    background_rows = stratified_sample(codes, background, seed + 1)
+    key = hashlib.sha256(json.dumps({
+        'rows': hashlib.sha256(rows.tobytes()).hexdigest(),
+        'background': hashlib.sha256(background_rows.tobytes()).hexdigest(),
+        'feature_perturbation': feature_perturbation,
+        'chunk_size': chunk_size
+    }, sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, matrix.version, model_hash(model), key)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        return ShapResult.load(path)
+    os.makedirs(path, exist_ok=True)
+    preprocess, estimator = (model[:-1], model[-1]) if isinstance(model, Pipeline) else (None, model)
+    background_X = matrix.X[background_rows]
+    if preprocess is not None:
+        background_X = preprocess.transform(background_X)
+    # shap is only needed for explanations; the base value does not depend on
+    # the rows explained, so it comes from one explainer in this process
+    import shap
+    expected_value = shap.TreeExplainer(
+        estimator,
+        data=background_X if feature_perturbation == 'interventional' else None,
+        feature_perturbation=feature_perturbation
+    ).expected_value
+    chunks = {}
+    bounds = [(start, min(start + chunk_size, len(rows))) for start in range(0, len(rows), chunk_size)]
+    with SharedArrays({'X': matrix.X, 'rows': rows, 'background': np.asarray(background_X, dtype=np.float64)}) as shared:
+        initargs = (shared.specs, estimator, preprocess, feature_perturbation)
+        with ProcessPoolExecutor(max_workers, initializer=start_worker, initargs=initargs) as pool:
+            pending = {}
+            for i, (start, end) in enumerate(bounds):
+                chunk_path = os.path.join(path, 'chunk-%05d.npy' % i)
+                if os.path.exists(chunk_path):
+                    chunks[i] = np.load(chunk_path)
+                else:
+                    pending[i] = pool.submit(explain_chunk, start, end)
+            for i, future in pending.items():
+                chunks[i] = future.result()
+                np.save(os.path.join(path, 'chunk-%05d.npy' % i), chunks[i])
+    result = ShapResult(
+        np.concatenate([chunks[i] for i in range(len(bounds))]) if bounds else np.empty((0, len(matrix.names)), dtype=np.float32),
+        rows,
+        float(np.ravel(expected_value)[0]),
+        matrix.names
+    )
+    result.save(path)
+    for i in range(len(bounds)):
+        os.remove(os.path.join(path, 'chunk-%05d.npy' % i))
+    return result
+
+
+def summary_plot(result, matrix, path, max_display=20):
+    import matplotlib.pyplot as plt
+    import shap
+    shap.summary_plot(result.values, matrix.X[result.rows], feature_names=result.names, max_display=max_display, show=False)
+    plt.savefig(path, bbox_inches='tight', dpi=150)
+    plt.close()
+
+
+def dependence_plot(result, matrix, feature, path, interaction_index='auto'):
+    import matplotlib.pyplot as plt
+    import shap
+    shap.dependence_plot(feature, result.values, matrix.X[result.rows], feature_names=result.names, interaction_index=interaction_index, show=False)
+    plt.savefig(path, bbox_inches='tight', dpi=150)
+    plt.close()
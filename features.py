@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from streaming_stats import part_paths
+from trends import TREND_FEATURES
+
+LAB_FEATURES = ['lab_before.value', 'lab_before.censored', 'lab_before.range_low', 'lab_before.range_high']
+VITAL_FEATURES = ['height', 'weight', 'bmi', 'systolic', 'diastolic', 'map']
+GENDER_CODES = {'F': 0, 'M': 1}
+
+
+def read_facet(path, columns=None):
+    if not part_paths(path):
+        return None
+    return pd.read_parquet(path, columns=columns)
+
+
+def facet_path(lab, facet):
+    # Prefer the cleaned output of a facet when it exists
+    cleaned = lab.facet_dir(facet + '_clean')
+    return cleaned if part_paths(cleaned) else lab.facet_dir(facet)
+
+
+def load_frame(lab):
+    # One row per lab pair, keyed by the patient document _id
+    frame = read_facet(lab.facet_dir('targets'))
+    demo = read_facet(facet_path(lab, 'demo'), ['_id', 'age', 'gender', 'race_mapping', 'ethnicity_mapping'])
+    vitals = read_facet(facet_path(lab, 'vitals'))
+    diagnosis = read_facet(lab.facet_dir('diagnosis'), ['_id', 'diagnosis'])
+    medications = read_facet(lab.facet_dir('medications'), ['_id', 'medications'])
+    if demo is not None:
+        frame = frame.merge(demo, on='_id', how='left')
+    if vitals is not None:
+        frame = frame.merge(vitals[['_id'] + [c for c in VITAL_FEATURES if c in vitals]], on='_id', how='left')
+    if diagnosis is not None:
+        frame = frame.merge(diagnosis, on='_id', how='left')
+    if medications is not None:
+        frame = frame.merge(medications, on='_id', how='left')
+    return frame
+
+
+def diagnosis_codes(frame):
+    codes = frame['diagnosis'].explode().dropna()
+    return pd.DataFrame({
+        'row': codes.index,
+        'code': [entry.get('icd_10') for entry in codes]
+    }).dropna().drop_duplicates()
+
+
+def medication_doses(frame):
+    meds = frame['medications'].explode().dropna()
+    meds = pd.DataFrame(meds.tolist(), index=meds.index)
+    if not len(meds):
+        return pd.DataFrame(columns=['row', 'group', 'dosage'])
+    # The first two GPI digits are the drug group
+    return pd.DataFrame({
+        'row': meds.index,
+        'group': meds['gpi'].astype('string').str[:2].to_numpy(),
+        'dosage': pd.to_numeric(meds['dosage'], errors='coerce').to_numpy()
+    }).dropna(subset=['group'])
+
+
+class FeatureSpec:
+    # Encoding vocabularies fitted on training data and reused at scoring time
+    def __init__(self, races=(), ethnicities=(), icd_codes=(), gpi_groups=(), trends=False):
+        self.races = list(races)
+        self.ethnicities = list(ethnicities)
+        self.icd_codes = list(icd_codes)
+        self.gpi_groups = list(gpi_groups)
+        self.trends = trends
+
+    @classmethod
+    def fit(cls, frame, min_patients=2000):
+        races = sorted(frame['race_mapping'].dropna().unique()) if 'race_mapping' in frame else []
+        ethnicities = sorted(frame['ethnicity_mapping'].dropna().unique()) if 'ethnicity_mapping' in frame else []
+        icd_codes = gpi_groups = []
+        if 'diagnosis' in frame:
+            counts = diagnosis_codes(frame)['code'].value_counts()
+            icd_codes = sorted(counts[counts >= min_patients].index)
+        if 'medications' in frame:
+            counts = medication_doses(frame).drop_duplicates(['row', 'group'])['group'].value_counts()
+            gpi_groups = sorted(counts[counts >= min_patients].index)
+        trends = all(name in frame for name in TREND_FEATURES)
+        return cls(races, ethnicities, icd_codes, gpi_groups, trends)
+
+    @property
+    def names(self):
+        return (
+            LAB_FEATURES
+            + (TREND_FEATURES if self.trends else [])
+            + ['age', 'gender']
+            + ['race=' + value for value in self.races]
+            + ['ethnicity=' + value for value in self.ethnicities]
+            + VITAL_FEATURES
+            + ['icd_10=' + code for code in self.icd_codes]
+            + ['med_count']
+            + ['gpi=' + group for group in self.gpi_groups]
+        )
+
+    def transform(self, frame):
+        X = np.full((len(frame), len(self.names)), np.nan, dtype=np.float32)
+        column = {name: i for i, name in enumerate(self.names)}
+        frame = frame.reset_index(drop=True)
+        for name in LAB_FEATURES + (TREND_FEATURES if self.trends else []) + ['age'] + VITAL_FEATURES:
+            if name in frame:
+                X[:, column[name]] = frame[name].to_numpy(dtype=np.float32)
+        if 'gender' in frame:
+            X[:, column['gender']] = frame['gender'].map(GENDER_CODES).to_numpy(dtype=np.float32)
+        for prefix, source, values in (('race=', 'race_mapping', self.races), ('ethnicity=', 'ethnicity_mapping', self.ethnicities)):
+            if source in frame:
+                for value in values:
+                    X[:, column[prefix + value]] = (frame[source] == value).to_numpy(dtype=np.float32)
+        if 'diagnosis' in frame:
+            codes = diagnosis_codes(frame)
+            codes = codes[codes['code'].isin(self.icd_codes)]
+            X[:, [column['icd_10=' + code] for code in self.icd_codes]] = 0
+            X[codes['row'].to_numpy(), [column['icd_10=' + code] for code in codes['code']]] = 1
+        if 'medications' in frame:
+            doses = medication_doses(frame)
+            X[:, column['med_count']] = np.bincount(doses['row'].to_numpy(dtype=np.int64), minlength=len(frame))
+            doses = doses[doses['group'].isin(self.gpi_groups)]
+            totals = doses.groupby(['row', 'group'])['dosage'].sum(min_count=1).reset_index()
+            X[:, [column['gpi=' + group] for group in self.gpi_groups]] = 0
+            X[totals['row'].to_numpy(), [column['gpi=' + group] for group in totals['group']]] = totals['dosage'].to_numpy(dtype=np.float32)
+        return X
+
+    def to_dict(self):
+        return {
+            'races': self.races,
+            'ethnicities': self.ethnicities,
+            'icd_codes': self.icd_codes,
+            'gpi_groups': self.gpi_groups,
+            'trends': self.trends
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(**json.load(f))
+
+
+class FeatureMatrix:
+    # Row-aligned fixed-width .npy arrays under <lab output>/features, opened
+    # memory-mapped so splitters and search workers share the page cache
+    arrays = ['X', 'y', 'patient_ids', 'practices', 'dates']
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        for name in self.arrays:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.names = meta['names']
+        self.target = meta['target']
+        self.version = meta['version']
+        self.spec = FeatureSpec(**meta['spec'])
+
+    @classmethod
+    def build(cls, lab, target='lab_after.value', spec=None, min_patients=2000):
+        frame = load_frame(lab)
+        frame = frame[frame[target].notna()]
+        spec = spec or FeatureSpec.fit(frame, min_patients)
+        path = lab.facet_dir('features')
+        os.makedirs(path, exist_ok=True)
+        X = spec.transform(frame)
+        arrays = {
+            'X': X,
+            'y': frame[target].to_numpy(dtype=np.float64),
+            'patient_ids': frame['PatientID'].astype(str).to_numpy(dtype=str),
+            'practices': frame['Practice'].astype(str).to_numpy(dtype=str),
+            'dates': frame['lab_after.date'].to_numpy(dtype='datetime64[ns]')
+        }
+        digest = hashlib.sha256()
+        for name in cls.arrays:
+            np.save(os.path.join(path, name + '.npy'), arrays[name])
+            digest.update(np.ascontiguousarray(arrays[name]).tobytes())
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({
+                'names': spec.names,
+                'target': target,
+                'version': digest.hexdigest()[:16],
+                'spec': spec.to_dict()
+            }, f, indent=2)
+        return cls(path)
@@ -0,0 +1,259 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Canonical spelling of every raw unit seen in lab_results and vitals,
+# keyed by the stripped, lower-cased raw unit
+UNIT_ALIASES = {
+    'u/l': 'U/L',
+    'iu/l': 'U/L',
+    'unit/l': 'U/L',
+    'units/l': 'U/L',
+    'u/liter': 'U/L',
+    'ukat/l': 'ukat/L',
+    'µkat/l': 'ukat/L',
+    'g/dl': 'g/dL',
+    'gm/dl': 'g/dL',
+    'g/l': 'g/L',
+    'mg/dl': 'mg/dL',
+    'mg/l': 'mg/L',
+    'ug/ml': 'mg/L',
+    'cm': 'cm',
+    'm': 'm',
+    'in': 'in',
+    'inch': 'in',
+    'inches': 'in',
+    '[in_i]': 'in',
+    'kg': 'kg',
+    'g': 'g',
+    'lb': 'lb',
+    'lbs': 'lb',
+    '[lb_av]': 'lb',
+    'oz': 'oz',
+    'kg/m2': 'kg/m2',
+    'kg/m^2': 'kg/m2',
+    'mmhg': 'mm[Hg]',
+    'mm hg': 'mm[Hg]',
+    'mm[hg]': 'mm[Hg]'
+}
+
+# Canonical vital names, keyed by the stripped, lower-cased raw name
+VITAL_ALIASES = {
+    'height': 'height',
+    'body height': 'height',
+    'ht': 'height',
+    'weight': 'weight',
+    'body weight': 'weight',
+    'wt': 'weight',
+    'bmi': 'bmi',
+    'body mass index': 'bmi',
+    'systolic': 'systolic',
+    'bp systolic': 'systolic',
+    'systolic blood pressure': 'systolic',
+    'diastolic': 'diastolic',
+    'bp diastolic': 'diastolic',
+    'diastolic blood pressure': 'diastolic'
+}
+
+# Unit every measurement is converted to. A missing or purely numeric unit
+# (e.g. '61' recorded instead of U/L) is assumed to already be this unit.
+TARGET_UNITS = {
+    'alanine_aminotransferase': 'U/L',
+    'aspartate_aminotransferase': 'U/L',
+    'albumin': 'g/dL',
+    'height': 'cm',
+    'weight': 'kg',
+    'bmi': 'kg/m2',
+    'systolic': 'mm[Hg]',
+    'diastolic': 'mm[Hg]'
+}
+
+# Multiplier from (measurement, canonical unit) to the target unit
+UNIT_FACTORS = {
+    ('alanine_aminotransferase', 'U/L'): 1.0,
+    ('alanine_aminotransferase', 'ukat/L'): 60.0,
+    ('aspartate_aminotransferase', 'U/L'): 1.0,
+    ('aspartate_aminotransferase', 'ukat/L'): 60.0,
+    ('albumin', 'g/dL'): 1.0,
+    ('albumin', 'g/L'): 0.1,
+    ('albumin', 'mg/dL'): 0.001,
+    ('albumin', 'mg/L'): 0.0001,
+    ('height', 'cm'): 1.0,
+    ('height', 'm'): 100.0,
+    ('height', 'in'): 2.54,
+    ('weight', 'kg'): 1.0,
+    ('weight', 'g'): 0.001,
+    ('weight', 'lb'): 0.45359237,
+    ('weight', 'oz'): 0.028349523125,
+    ('bmi', 'kg/m2'): 1.0,
+    ('systolic', 'mm[Hg]'): 1.0,
+    ('diastolic', 'mm[Hg]'): 1.0
+}
+
+# Values outside these bounds (in target units) are physiologically impossible
+PLAUSIBLE_RANGES = {
+    'alanine_aminotransferase': (0, 10000),
+    'aspartate_aminotransferase': (0, 20000),
+    'albumin': (0, 10),
+    'height': (30, 250),
+    'weight': (1, 350),
+    'bmi': (5, 150),
+    'systolic': (40, 300),
+    'diastolic': (20, 200)
+}
+
+# Bits of the per-value flag column
+FLAG_UNPARSED = 1
+FLAG_UNIT_REPAIRED = 2
+FLAG_UNIT_UNKNOWN = 4
+FLAG_IMPOSSIBLE = 8
+
+# Fields of lab_before and lab_after read by normalize_labs
+LAB_FIELDS = ['api_test_name', 'result', 'unit', 'range']
+
+# Fields of a single entry of the vitals array
+VITAL_FIELDS = {
+    'name': 'name',
+    'result': 'result',
+    'unit': 'unit',
+    'date': 'date'
+}
+
+NUMBER = r'^(<=|>=|<|>)?\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)$'
+BOUNDED_RANGE = r'^([-+]?(?:\d+\.?\d*|\.\d+))\s*(?:-|–|to)\s*([-+]?(?:\d+\.?\d*|\.\d+))$'
+ONE_SIDED_RANGE = r'^(<=|>=|<|>)\s*([-+]?(?:\d+\.?\d*|\.\d+))$'
+
+
+def compile_lookup(series, table, default=None):
+    # Looks up only the distinct values, then broadcasts back by code;
+    # code -1 (missing) lands on the trailing default
+    codes, uniques = pd.factorize(series)
+    values = np.array([table.get(value, default) for value in uniques] + [default], dtype=object)
+    return values[codes]
+
+
+def compile_lookup2(first, second, table, default=np.nan):
+    first_codes, first_uniques = pd.factorize(first)
+    second_codes, second_uniques = pd.factorize(second)
+    grid = np.full((len(first_uniques) + 1, len(second_uniques) + 1), default, dtype=float)
+    for i, a in enumerate(first_uniques):
+        for j, b in enumerate(second_uniques):
+            grid[i, j] = table.get((a, b), default)
+    return grid[first_codes, second_codes]
+
+
+def clean_strings(series):
+    return pd.Series(series, copy=False).astype('string').str.strip().str.replace(',', '', regex=False)
+
+
+def parse_results(series):
+    parts = clean_strings(series).str.extract(NUMBER)
+    value = pd.to_numeric(parts[1], errors='coerce').to_numpy(dtype=float)
+    censored = parts[0].map({'<': -1, '<=': -1, '>': 1, '>=': 1}).fillna(0).to_numpy(dtype=np.int8)
+    return value, censored
+
+
+def parse_ranges(series):
+    strings = clean_strings(series)
+    bounded = strings.str.extract(BOUNDED_RANGE)
+    one_sided = strings.str.extract(ONE_SIDED_RANGE)
+    side_value = pd.to_numeric(one_sided[1], errors='coerce').to_numpy(dtype=float)
+    upper_side = one_sided[0].isin(['<', '<=']).to_numpy()
+    lower_side = one_sided[0].isin(['>', '>=']).to_numpy()
+    low = pd.to_numeric(bounded[0], errors='coerce').to_numpy(dtype=float)
+    high = pd.to_numeric(bounded[1], errors='coerce').to_numpy(dtype=float)
+    low = np.where(lower_side, side_value, low)
+    high = np.where(upper_side, side_value, high)
+    return low, high
+
+
+def normalize_values(measurement, result, unit):
+    # Returns target-unit values, censoring (-1 '<', 1 '>'), unit factors and flags
+    measurement = np.asarray(measurement, dtype=object)
+    value, censored = parse_results(result)
+    unparsed = np.isnan(value)
+    raw_unit = clean_strings(unit).str.lower()
+    canonical = compile_lookup(raw_unit, UNIT_ALIASES)
+    corrupted = raw_unit.str.fullmatch(r'[\d.]*').fillna(True).to_numpy(dtype=bool)
+    canonical = np.where(corrupted & pd.isna(canonical), compile_lookup(measurement, TARGET_UNITS), canonical)
+    factor = compile_lookup2(measurement, canonical, UNIT_FACTORS)
+    value = value * factor
+    low = compile_lookup(measurement, {name: bounds[0] for name, bounds in PLAUSIBLE_RANGES.items()}, np.nan).astype(float)
+    high = compile_lookup(measurement, {name: bounds[1] for name, bounds in PLAUSIBLE_RANGES.items()}, np.nan).astype(float)
+    impossible = (value < low) | (value > high)
+    flags = (
+        unparsed * FLAG_UNPARSED
+        | corrupted * FLAG_UNIT_REPAIRED
+        | (~unparsed & np.isnan(factor)) * FLAG_UNIT_UNKNOWN
+        | impossible * FLAG_IMPOSSIBLE
+    ).astype(np.int8)
+    value[impossible] = np.nan
+    return value, censored, factor, flags
+
+
+def normalize_labs(df):
+    for prefix in ('lab_before', 'lab_after'):
+        if not any(column.startswith(prefix + '.') for column in df.columns):
+            continue
+        # json_normalize leaves out fields that no document of the batch has
+        df = df.reindex(columns=df.columns.union([prefix + '.' + field for field in LAB_FIELDS], sort=False))
+        measurement = df[prefix + '.api_test_name'].to_numpy(dtype=object)
+        value, censored, factor, flags = normalize_values(measurement, df[prefix + '.result'], df[prefix + '.unit'])
+        low, high = parse_ranges(df[prefix + '.range'])
+        df[prefix + '.value'] = value
+        df[prefix + '.censored'] = censored
+        df[prefix + '.unit_normalized'] = compile_lookup(measurement, TARGET_UNITS)
+        df[prefix + '.range_low'] = low * factor
+        df[prefix + '.range_high'] = high * factor
+        df[prefix + '.flags'] = flags
+    return df
+
+
+def explode_records(column):
+    # One row per element of a list-of-records column, indexed by the row it
+    # belongs to. Arrow-backed columns are flattened without building a Python
+    # dict per element
+    if isinstance(column.dtype, pd.ArrowDtype):
+        array = pa.array(column.array)
+        parents = pc.list_parent_indices(array).to_numpy()
+        values = pc.list_flatten(array)
+        return pd.DataFrame({
+            field.name: pc.struct_field(values, field.name).to_pandas(types_mapper=pd.ArrowDtype if pa.types.is_string(field.type) else None)
+            for field in values.type
+        }).set_axis(column.index[parents])
+    records = column.explode().dropna()
+    return pd.DataFrame(records.tolist(), index=records.index)
+
+
+def normalize_vitals(df):
+    # Explodes the vitals array of each pair, normalizes every reading in one
+    # pass and keeps the latest valid reading per vital as a wide column
+    if 'vitals' not in df.columns:
+        return df
+    readings = explode_records(df['vitals'])
+    columns = ['height', 'weight', 'bmi', 'systolic', 'diastolic']
+    wide = pd.DataFrame(index=df.index, columns=columns, dtype=float)
+    invalid = pd.Series(0, index=df.index, dtype='int32')
+    if len(readings):
+        readings = readings.reindex(columns=list(VITAL_FIELDS.values()))
+        name = compile_lookup(clean_strings(readings[VITAL_FIELDS['name']]).str.lower(), VITAL_ALIASES)
+        value, _, _, flags = normalize_values(name, readings[VITAL_FIELDS['result']], readings[VITAL_FIELDS['unit']])
+        readings = pd.DataFrame({
+            'name': name,
+            'value': value,
+            'date': readings[VITAL_FIELDS['date']].to_numpy()
+        }, index=readings.index)
+        known = ~pd.isna(name)
+        rejected = known & np.isnan(value)
+        invalid = invalid.add(pd.Series(rejected, index=readings.index).groupby(level=0).sum(), fill_value=0).astype('int32')
+        readings = readings[known & ~rejected].sort_values('date', kind='stable')
+        latest = readings.groupby([readings.index, 'name'])['value'].last().unstack()
+        wide.update(latest.reindex(columns=columns))
+    computed_bmi = wide['weight'] / (wide['height'] / 100) ** 2
+    wide['bmi'] = wide['bmi'].fillna(computed_bmi.where(computed_bmi.between(*PLAUSIBLE_RANGES['bmi'])))
+    wide['map'] = (wide['systolic'] + 2 * wide['diastolic']) / 3
+    df = df.drop(columns='vitals')
+    df[wide.columns] = wide
+    df['vitals.invalid'] = invalid
+    return df
@@ -0,0 +1,631 @@
+import copy
+import hashlib
+import logging
+import re
+import time
+from bson import json_util
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger('optimizer')
+
+# Stages that compute fields of the current document
+FIELD_STAGES = ['$project', '$addFields', '$set']
+
+# Arguments evaluated once per array element
+ITERATIONS = {
+    '$map': 'in',
+    '$filter': 'cond',
+    '$reduce': 'in'
+}
+
+# Operators whose input array can give up a $let to the enclosing expression
+ARRAY_INPUTS = ['$filter', '$map', '$reduce', '$sortArray']
+
+
+# Verdicts of the sample check by pipeline, so that facets run again in the
+# same process (lab classes, sweeps, reruns) do not repeat the sample runs
+VERDICTS = {}
+
+
+class Unfusable(Exception):
+    pass
+
+
+def canonical(value):
+    return json_util.dumps(value, sort_keys=True)
+
+
+def is_operator(value):
+    return isinstance(value, dict) and len(value) == 1 and next(iter(value)).startswith('$')
+
+
+def is_spec(value):
+    # A nested projection, as opposed to an expression
+    return isinstance(value, dict) and not is_operator(value)
+
+
+def is_flag(value):
+    return isinstance(value, (bool, int, float))
+
+
+def is_cheap(expr):
+    # Expressions worth repeating rather than binding
+    if not isinstance(expr, (dict, list)):
+        return True
+    if is_operator(expr) and '$literal' in expr:
+        return True
+    if is_operator(expr) and '$arrayElemAt' in expr:
+        array, index = expr['$arrayElemAt']
+        return isinstance(array, str) and isinstance(index, int)
+    return False
+
+
+def paths(expr):
+    # Field paths and variables of an expression
+    if isinstance(expr, str):
+        if expr.startswith('$'):
+            yield expr
+    elif isinstance(expr, list):
+        for item in expr:
+            yield from paths(item)
+    elif isinstance(expr, dict):
+        for key, value in expr.items():
+            if key == '$literal':
+                continue
+            if key == '$getField' and not (isinstance(value, dict) and 'input' in value):
+                yield '$$CURRENT'
+            yield from paths(value)
+
+
+def field_refs(expr):
+    # Top-level fields read by an expression, or None for the whole document
+    fields = set()
+    for path in paths(expr):
+        if path.startswith('$$'):
+            if path[2:].split('.')[0] in ('ROOT', 'CURRENT'):
+                return None
+        else:
+            fields.add(path[1:].split('.')[0])
+    return fields
+
+
+def bound(expr):
+    # Variables defined inside an expression
+    names = set()
+    if isinstance(expr, list):
+        for item in expr:
+            names |= bound(item)
+    elif isinstance(expr, dict):
+        for key, value in expr.items():
+            if key == '$literal':
+                continue
+            if isinstance(value, dict):
+                if key in ('$map', '$filter'):
+                    names.add(value.get('as', 'this'))
+                elif key == '$reduce':
+                    names |= {'this', 'value'}
+                elif key == '$let' and isinstance(value.get('vars'), dict):
+                    names |= set(value['vars'])
+            names |= bound(value)
+    return names
+
+
+def variables(expr):
+    return bound(expr) | {path[2:].split('.')[0] for path in paths(expr) if path.startswith('$$')}
+
+
+def rename(expr, old, new):
+    if isinstance(expr, str):
+        if expr == '$$' + old or expr.startswith('$$' + old + '.'):
+            return '$$' + new + expr[len(old) + 2:]
+        return expr
+    if isinstance(expr, list):
+        return [rename(item, old, new) for item in expr]
+    if isinstance(expr, dict):
+        return {key: value if key == '$literal' else rename(value, old, new) for key, value in expr.items()}
+    return expr
+
+
+def fresh_name(base, taken):
+    # User variables start with a lowercase letter
+    name = re.sub(r'[^A-Za-z0-9_]', '_', base)
+    if not re.match(r'[a-z]', name):
+        name = 'v_' + name
+    candidate, i = name, 1
+    while candidate in taken:
+        i += 1
+        candidate = '%s_%d' % (name, i)
+    taken.add(candidate)
+    return candidate
+
+
+def stage_fields(stage):
+    # (operator, spec) of a stage fusion can rewrite, otherwise None
+    name = next(iter(stage))
+    spec = stage[name]
+    if name not in FIELD_STAGES or not isinstance(spec, dict) or not spec or len(stage) != 1:
+        return None
+    for key, value in spec.items():
+        if '.' in key or key.startswith('$'):
+            return None
+        if name == '$project':
+            if is_flag(value) and not value and key != '_id':
+                return None
+            if key == '_id' and not is_flag(value):
+                return None
+            if is_spec(value) and not valid_spec(value):
+                return None
+        elif is_spec(value):
+            # $addFields merges a nested document into the existing one
+            return None
+    return name, spec
+
+
+def valid_spec(spec):
+    for key, value in spec.items():
+        if '.' in key or key.startswith('$'):
+            return False
+        if is_flag(value) and not value:
+            return False
+        if is_spec(value) and not valid_spec(value):
+            return False
+    return True
+
+
+def spec_expression(spec):
+    # A nested projection with only computed leaves as an object expression
+    expression = {}
+    for key, value in spec.items():
+        if is_flag(value):
+            raise Unfusable()
+        expression[key] = spec_expression(value) if is_spec(value) else value
+    return expression
+
+
+def keeps(kind, spec, field):
+    # Whether a stage passes the field through unchanged
+    if field not in spec:
+        return kind != '$project' or field == '_id'
+    return is_flag(spec[field]) and bool(spec[field])
+
+
+
+def as_expression(value):
+    # Constants of $addFields would be flags in a $project
+    if isinstance(value, (dict, list)) or isinstance(value, str) and value.startswith('$'):
+        return value
+    return {'$literal': value}
+
+
+def resolve(path, kind, spec):
+    # What a path read after the first stage reads before it: a path, or an
+    # expression of the first stage and the fields to take from it
+    parts = path[1:].split('.')
+    top, rest = parts[0], parts[1:]
+    if keeps(kind, spec, top):
+        return path, None, top
+    if top not in spec or is_flag(spec[top]):
+        return '$$REMOVE', None, top
+    value = spec[top]
+    if is_spec(value):
+        # A nested projection also reaches into arrays of the input
+        raise Unfusable()
+    value = as_expression(value)
+    while rest:
+        if isinstance(value, str):
+            if value == '$$REMOVE':
+                return value, None, top
+            if not value.startswith('$$'):
+                return '.'.join([value] + rest), None, top
+            raise Unfusable()
+        literal = value
+        if is_operator(value) and '$mergeObjects' in value and len(value['$mergeObjects']) == 1:
+            literal = value['$mergeObjects'][0]
+        if not is_spec(literal):
+            break
+        if rest[0] not in literal:
+            return '$$REMOVE', None, top
+        value, rest = as_expression(literal[rest[0]]), rest[1:]
+    if isinstance(value, str):
+        return '.'.join([value] + rest), None, top
+    if is_spec(value):
+        value = {'$mergeObjects': [value]}
+    return value, rest, top
+
+
+def substitute(expr, kind, spec, uses):
+    # Rewrites an expression of the second stage over the input of the first.
+    # A computed field read once, whole and outside any per-element argument
+    # is inlined; otherwise it is bound once in a $let around the expression
+    found = {}
+
+    def collect(expr, repeated):
+        if isinstance(expr, str):
+            if expr.startswith('$') and not expr.startswith('$$'):
+                value, rest, top = resolve(expr, kind, spec)
+                if rest is not None:
+                    key = canonical(value)
+                    reads = found.get(key, (value, top, 0))[2]
+                    found[key] = (value, top, reads + (2 if rest or repeated else 1))
+        elif isinstance(expr, list):
+            for item in expr:
+                collect(item, repeated)
+        elif isinstance(expr, dict):
+            for key, value in expr.items():
+                if key == '$literal':
+                    continue
+                if key in ITERATIONS and isinstance(value, dict):
+                    for arg, item in value.items():
+                        collect(item, repeated or arg == ITERATIONS[key])
+                else:
+                    collect(value, repeated)
+
+    collect(expr, False)
+    taken = variables(expr)
+    names, bindings = {}, {}
+    for key, (value, top, reads) in found.items():
+        if not is_cheap(value):
+            uses[key] = uses.get(key, 0) + 1
+        if reads > 1:
+            names[key] = fresh_name(top, taken)
+            bindings[names[key]] = copy.deepcopy(value)
+
+    def rewrite(expr):
+        if isinstance(expr, str):
+            if expr.startswith('$') and not expr.startswith('$$'):
+                value, rest, top = resolve(expr, kind, spec)
+                if rest is None:
+                    return value
+                key = canonical(value)
+                if key in names:
+                    return '.'.join(['$$' + names[key]] + rest)
+                return copy.deepcopy(value)
+            return expr
+        if isinstance(expr, list):
+            return [rewrite(item) for item in expr]
+        if isinstance(expr, dict):
+            return {key: value if key == '$literal' else rewrite(value) for key, value in expr.items()}
+        return expr
+
+    expr = rewrite(expr)
+    if bindings:
+        return {'$let': {'vars': bindings, 'in': expr}}
+    return expr
+
+
+def substitute_spec(spec, kind, first, uses):
+    return {
+        key: value if is_flag(value) else substitute_spec(value, kind, first, uses) if is_spec(value) else substitute(value, kind, first, uses)
+        for key, value in spec.items()
+    }
+
+
+def count_use(uses, value):
+    if not is_cheap(value):
+        key = canonical(value)
+        uses[key] = uses.get(key, 0) + 1
+
+
+def fuse(first, second):
+    # One stage computing what the two adjacent field stages compute, or None
+    # when that would evaluate a costly expression twice
+    a, b = stage_fields(first), stage_fields(second)
+    if a is None or b is None or field_refs(b[1]) is None:
+        return None
+    (kind_a, spec_a), (kind_b, spec_b) = a, b
+    kind = '$project' if '$project' in (kind_a, kind_b) else kind_a
+    fused, uses = {}, {}
+    try:
+        if kind_b != '$project':
+            for field, value in spec_a.items():
+                if field not in spec_b:
+                    fused[field] = value
+                    count_use(uses, value)
+        elif '_id' not in spec_b:
+            spec_b = dict({'_id': True}, **spec_b)
+        for field, value in spec_b.items():
+            if kind_b == '$project' and is_flag(value):
+                if keeps(kind_a, spec_a, field) or not value:
+                    fused[field] = value
+                elif field in spec_a and not is_flag(spec_a[field]):
+                    fused[field] = as_expression(spec_a[field]) if kind_a != kind else spec_a[field]
+                    count_use(uses, spec_a[field])
+                elif field == '_id':
+                    fused[field] = 0
+            elif is_spec(value):
+                if keeps(kind_a, spec_a, field):
+                    fused[field] = substitute_spec(value, kind_a, spec_a, uses)
+                else:
+                    fused[field] = substitute(spec_expression(value), kind_a, spec_a, uses)
+                    if is_spec(fused[field]):
+                        fused[field] = {'$mergeObjects': [fused[field]]}
+            else:
+                if kind_b != kind:
+                    value = as_expression(value)
+                fused[field] = substitute(value, kind_a, spec_a, uses)
+    except Unfusable:
+        return None
+    if any(count > 1 for count in uses.values()):
+        return None
+    if kind == '$project':
+        if fused.get('_id') is True:
+            del fused['_id']
+        if all(is_flag(value) and not value for value in fused.values()):
+            return None
+    return {kind: fused}
+
+
+def fuse_stages(pipeline):
+    fused = []
+    for stage in pipeline:
+        merged = fuse(fused[-1], stage) if fused else None
+        if merged is not None:
+            fused[-1] = merged
+        else:
+            fused.append(stage)
+    return fused
+
+
+def conjuncts(cond):
+    if is_operator(cond) and isinstance(cond.get('$and'), list):
+        return list(cond['$and'])
+    return [cond]
+
+
+def hoist_let(expr):
+    # {$filter: {input: {$let: ...}}} -> {$let: {in: {$filter: ...}}}
+    name, args = next(iter(expr.items()))
+    if name not in ARRAY_INPUTS or not isinstance(args, dict) or not (is_operator(args.get('input')) and '$let' in args['input']):
+        return None
+    let = args['input']['$let']
+    rest = {key: value for key, value in args.items() if key != 'input'}
+    if set(let['vars']) & variables({name: rest}):
+        return None
+    return {'$let': {'vars': let['vars'], 'in': {name: dict(args, input=let['in'])}}}
+
+
+def merge_lets(expr):
+    if '$let' not in expr or not (is_operator(expr['$let']['in']) and '$let' in expr['$let']['in']):
+        return None
+    outer, inner = expr['$let'], expr['$let']['in']['$let']
+    if set(outer['vars']) & (set(inner['vars']) | variables(list(inner['vars'].values()))):
+        return None
+    return {'$let': {'vars': dict(outer['vars'], **inner['vars']), 'in': inner['in']}}
+
+
+def share_bindings(expr):
+    # Variables bound to the same expression become one
+    if '$let' not in expr:
+        return None
+    let = expr['$let']
+    inner = bound(let['in'])
+    seen = {}
+    for name, value in let['vars'].items():
+        first = seen.setdefault(canonical(value), name)
+        if first != name and name not in inner and first not in inner:
+            names = {key: value for key, value in let['vars'].items() if key != name}
+            return {'$let': {'vars': names, 'in': rename(let['in'], name, first)}}
+    return None
+
+
+def merge_filters(expr):
+    # A $filter of a $filter is one $filter on both conditions; $and stops at
+    # the first false one, so the outer conditions still only see elements
+    # the inner ones kept
+    if '$filter' not in expr:
+        return None
+    outer = expr['$filter']
+    if not isinstance(outer, dict) or 'limit' in outer or not (is_operator(outer.get('input')) and '$filter' in outer['input']):
+        return None
+    inner = outer['input']['$filter']
+    if not isinstance(inner, dict) or 'limit' in inner:
+        return None
+    first, second = inner.get('as', 'this'), outer.get('as', 'this')
+    cond = outer['cond']
+    if first != second:
+        if first in variables(cond) or second in bound(cond):
+            return None
+        cond = rename(cond, second, first)
+    return {'$filter': dict(inner, cond={'$and': conjuncts(inner['cond']) + conjuncts(cond)})}
+
+
+def unique_conjuncts(expr):
+    # Nested $and flattened and repeated conditions kept once
+    if not isinstance(expr.get('$and'), list):
+        return None
+    conds, seen = [], set()
+    for each in expr['$and']:
+        for cond in conjuncts(each):
+            if canonical(cond) not in seen:
+                seen.add(canonical(cond))
+                conds.append(cond)
+    if conds == expr['$and']:
+        return None
+    return {'$and': conds}
+
+
+def simplify(expr):
+    if isinstance(expr, list):
+        return [simplify(item) for item in expr]
+    if not isinstance(expr, dict) or '$literal' in expr:
+        return expr
+    expr = {key: simplify(value) for key, value in expr.items()}
+    if is_operator(expr):
+        for rule in (hoist_let, merge_lets, share_bindings, merge_filters, unique_conjuncts):
+            rewritten = rule(expr)
+            if rewritten is not None:
+                return simplify(rewritten)
+    return expr
+
+
+def union(live, fields):
+    if live is None or fields is None:
+        return None
+    return live | fields
+
+
+def query_fields(query):
+    # Top-level fields a $match reads, or None when that is not known
+    fields = set()
+    for key, value in query.items():
+        if key in ('$and', '$or', '$nor'):
+            for clause in value:
+                fields = union(fields, query_fields(clause))
+        elif key == '$expr':
+            fields = union(fields, field_refs(value))
+        elif key.startswith('$'):
+            return None
+        else:
+            fields = union(fields, {key.split('.')[0]})
+        if fields is None:
+            return None
+    return fields
+
+
+def is_exclusion(spec):
+    return any(is_flag(value) and not value for key, value in spec.items() if key != '_id')
+
+
+def prune_stage(stage, live):
+    # The stage without the fields no later stage reads (live, None for all of
+    # them), and the fields it reads itself
+    name = next(iter(stage))
+    spec = stage[name]
+    if name in ('$limit', '$skip', '$sample', '$unset'):
+        return stage, live
+    if name == '$match':
+        return stage, union(live, query_fields(spec))
+    if name == '$sort':
+        return stage, union(live, {key.split('.')[0] for key in spec})
+    if name == '$unwind':
+        path = spec if isinstance(spec, str) else spec['path']
+        return stage, union(live, {path[1:].split('.')[0]})
+    if name in ('$group', '$replaceRoot', '$replaceWith'):
+        return stage, field_refs(spec)
+    if name == '$count':
+        return stage, set()
+    if name == '$project' and not is_exclusion(spec):
+        kept = {key: value for key, value in spec.items() if key == '_id' or live is None or key.split('.')[0] in live}
+        if all(key == '_id' for key in kept):
+            kept = spec
+        reads = set() if '_id' in kept else {'_id'}
+        for key, value in kept.items():
+            if not is_flag(value):
+                reads = union(reads, field_refs(value))
+            if reads is not None and (is_spec(value) or is_flag(value) and value):
+                reads.add(key.split('.')[0])
+        return {name: kept}, reads
+    if name in ('$addFields', '$set'):
+        kept = spec if live is None else {key: value for key, value in spec.items() if key.split('.')[0] in live}
+        if not kept:
+            return None, live
+        reads = None if live is None else {field for field in live if field not in kept or is_spec(kept[field])}
+        for key, value in kept.items():
+            reads = union(reads, field_refs(value))
+            if '.' in key:
+                reads = union(reads, {key.split('.')[0]})
+        return {name: kept}, reads
+    return stage, None
+
+
+def prune(pipeline):
+    live, pruned = None, []
+    for stage in reversed(pipeline):
+        stage, live = prune_stage(stage, live)
+        if stage is not None:
+            pruned.append(stage)
+    return pruned[::-1]
+
+
+def passes(stage, query):
+    # Whether a $match with this query can run before the stage instead
+    fields = query_fields(query)
+    name = next(iter(stage))
+    spec = stage[name]
+    if fields is None:
+        return False
+    if name == '$sort':
+        return True
+    if name == '$project':
+        if is_exclusion(spec):
+            return not any(key.split('.')[0] in fields for key in spec)
+        return all(keeps(name, spec, field) for field in fields)
+    if name in ('$addFields', '$set'):
+        return not any(key.split('.')[0] in fields for key in spec)
+    if name == '$unset':
+        return not any(key.split('.')[0] in fields for key in ([spec] if isinstance(spec, str) else spec))
+    if name == '$unwind':
+        path = spec if isinstance(spec, str) else spec['path']
+        index = None if isinstance(spec, str) else spec.get('includeArrayIndex')
+        return path[1:].split('.')[0] not in fields and index not in fields
+    return False
+
+
+def hoist_matches(pipeline):
+    # $match stages move ahead of the stages that do not change what they
+    # read, never past $limit, $skip or $group; adjacent ones become one
+    pipeline = list(pipeline)
+    for i in range(1, len(pipeline)):
+        j = i
+        while j > 0 and '$match' in pipeline[j] and passes(pipeline[j - 1], pipeline[j]['$match']):
+            pipeline[j - 1], pipeline[j] = pipeline[j], pipeline[j - 1]
+            j -= 1
+    merged = []
+    for stage in pipeline:
+        if merged and '$match' in stage and '$match' in merged[-1]:
+            first, second = merged[-1]['$match'], stage['$match']
+            merged[-1] = {'$match': dict(first, **second) if not set(first) & set(second) else {'$and': [first, second]}}
+        else:
+            merged.append(stage)
+    return merged
+
+
+def optimize(pipeline):
+    # Rewrites until none applies; the result returns the same documents
+    pipeline = copy.deepcopy(pipeline)
+    while True:
+        before = canonical(pipeline)
+        pipeline = fuse_stages(prune(hoist_matches(pipeline)))
+        pipeline = [{name: simplify(spec)} if name in FIELD_STAGES else {name: spec} for stage in pipeline for name, spec in stage.items()]
+        if canonical(pipeline) == before:
+            return pipeline
+
+
+def time_sample(lab, pipeline, sample, collection=None):
+    start = time.perf_counter()
+    docs = list(lab.aggregate([{'$sort': {'_id': 1}}, {'$limit': sample}] + pipeline, collection=collection))
+    return time.perf_counter() - start, sorted(canonical(doc) for doc in docs)
+
+
+def optimize_pipeline(lab, pipeline, facet, sample=0, repeats=2, collection=None):
+    # With a sample, both versions run on the first sample documents by _id
+    # (best of repeats) and the rewritten one is kept only if it returns the
+    # same documents. The verdict is kept per pipeline, sample and collection
+    optimized = optimize(pipeline)
+    if canonical(optimized) == canonical(pipeline):
+        return pipeline
+    if not sample:
+        logger.info('%s %s: %d stages, %d optimized', lab.name, facet, len(pipeline), len(optimized))
+        return optimized
+    key = hashlib.sha256(canonical([lab.collection.name, collection, sample, pipeline]).encode()).hexdigest()
+    if key not in VERDICTS:
+        VERDICTS[key] = check_sample(lab, pipeline, optimized, facet, sample, repeats, collection)
+    return optimized if VERDICTS[key] else pipeline
+
+
+def check_sample(lab, pipeline, optimized, facet, sample, repeats, collection):
+    original_time = optimized_time = float('inf')
+    for _ in range(repeats):
+        elapsed, expected = time_sample(lab, pipeline, sample, collection)
+        original_time = min(original_time, elapsed)
+        try:
+            elapsed, docs = time_sample(lab, optimized, sample, collection)
+        except OperationFailure as error:
+            logger.warning('%s %s: optimized pipeline failed (%s), running it as written', lab.name, facet, error)
+            return False
+        optimized_time = min(optimized_time, elapsed)
+    if docs != expected:
+        logger.warning('%s %s: optimized pipeline differs on %d sample documents, running it as written', lab.name, facet, sample)
+        return False
+    logger.info('%s %s: %d stages, %d optimized, %.2fx faster on %d documents', lab.name, facet, len(pipeline), len(optimized), original_time / max(optimized_time, 1e-6), sample)
+    return True
@@ -0,0 +1,254 @@
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from Preprecessed_UPDATED import ALTLab, ASTLab, AlbuminLab, PreprocessedLabs
+
+LABS = {
+    'alt': ALTLab,
+    'ast': ASTLab,
+    'albumin': AlbuminLab
+}
+
+# step: (lab method, upstream steps of the same lab, output facet)
+STEPS = {
+    'labs': ('run_aggregator_labs', [], 'labs'),
+    'diagnosis': ('run_aggregator_diagnosis', [], 'diagnosis'),
+    'vitals': ('run_aggregator_vitals', [], 'vitals'),
+    'medications': ('run_aggregator_medications', [], 'medications'),
+    'demo': ('run_aggregator_demo', ['labs'], 'demo'),
+    'clean_vitals': ('clean_vitals', ['vitals'], 'vitals_clean'),
+    'clean_demo': ('clean_demo', ['demo'], 'demo_clean'),
+    'targets': ('run_targets', ['labs'], 'targets'),
+    'features': ('build_features', ['targets', 'clean_demo', 'clean_vitals', 'diagnosis', 'medications'], 'features')
+}
+
+# Extraction steps always run: an unchanged source is served from the facet
+# snapshot, and their output fingerprint then decides what runs downstream
+EXTRACTION_STEPS = ['labs', 'diagnosis', 'vitals', 'medications', 'demo']
+
+logger = logging.getLogger('scheduler')
+
+
+def fingerprint(path):
+    # Names, sizes and modification times of the files in an output directory;
+    # snapshot reuse leaves all three untouched
+    if not os.path.isdir(path):
+        return None
+    entries = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in os.scandir(path) if entry.is_file())
+    return hashlib.sha256(json.dumps(entries).encode()).hexdigest() if entries else None
+
+
+def build_graph(labs, steps):
+    # Nodes are '<lab>:<step>'; requested steps pull in everything upstream
+    graph = {}
+
+    def add(lab, step):
+        node = '%s:%s' % (lab, step)
+        if node not in graph:
+            graph[node] = ['%s:%s' % (lab, upstream) for upstream in STEPS[step][1]]
+            for upstream in STEPS[step][1]:
+                add(lab, upstream)
+
+    for lab in labs:
+        for step in steps:
+            add(lab, step)
+    return graph
+
+
+def output_dir(node):
+    lab, step = node.split(':')
+    return LABS[lab]().facet_dir(STEPS[step][2])
+
+
+def lab_instance(lab, options):
+    instance = LABS[lab](
+        sample_fraction=options['sample_fraction'],
+        stratify_by_practice=options['stratify_by_practice'],
+        trend_features=options.get('trend_features')
+    )
+    # Options left unset keep the class defaults
+    for name in ('decoder', 'read_timelines', 'read_preference', 'read_tags', 'max_staleness_seconds', 'analytics_uri', 'cluster_time'):
+        if options.get(name) is not None:
+            setattr(instance, name, options[name])
+    return instance
+
+
+def run_node(node, options):
+    lab, step = node.split(':')
+    instance = lab_instance(lab, options)
+    getattr(instance, STEPS[step][0])()
+    return fingerprint(instance.facet_dir(STEPS[step][2]))
+
+
+class State:
+    # Per node status, output fingerprint and the upstream fingerprints it was
+    # built from; rewritten atomically after every node
+    def __init__(self, path):
+        self.path = path
+        self.nodes = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.nodes = json.load(f)['nodes']
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'nodes': self.nodes}, f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+    def update(self, node, **fields):
+        self.nodes[node] = dict(self.nodes.get(node, {}), **fields)
+        self.save()
+
+    def inputs(self, graph, node):
+        return {upstream: self.nodes.get(upstream, {}).get('output') for upstream in graph[node]}
+
+    def up_to_date(self, graph, node):
+        record = self.nodes.get(node)
+        return (
+            record is not None
+            and record.get('status') == 'done'
+            and node.split(':')[1] not in EXTRACTION_STEPS
+            and record.get('output') is not None
+            and record['output'] == fingerprint(output_dir(node))
+            and record.get('inputs') == self.inputs(graph, node)
+        )
+
+
+def descendants(graph, node):
+    found, frontier = set(), [node]
+    while frontier:
+        current = frontier.pop()
+        for child, upstream in graph.items():
+            if current in upstream and child not in found:
+                found.add(child)
+                frontier.append(child)
+    return found
+
+
+def ancestors(graph, node):
+    found, frontier = set(), list(graph[node])
+    while frontier:
+        current = frontier.pop()
+        if current not in found:
+            found.add(current)
+            frontier += graph[current]
+    return found
+
+
+def run(graph, state, options, workers=None, retries=2, backoff=30, force=()):
+    # Runs every node whose upstream nodes are done, at most `workers` at a
+    # time. Failed nodes are retried with exponential backoff; a node that
+    # keeps failing blocks only its own descendants
+    pending, done, failed = set(graph), set(), set()
+    attempts, ready_at, running = {}, {}, {}
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers or os.cpu_count(), mp_context=context) as pool:
+        while pending or running:
+            ready = True
+            while ready:
+                ready = [
+                    node for node in sorted(pending)
+                    if all(upstream in done for upstream in graph[node]) and ready_at.get(node, 0) <= time.time()
+                ]
+                pending.difference_update(ready)
+                for node in ready:
+                    if node not in force and state.up_to_date(graph, node):
+                        logger.info('%s is up to date', node)
+                        done.add(node)
+                    else:
+                        logger.info('%s started (attempt %d)', node, attempts.get(node, 0) + 1)
+                        state.update(node, status='running', started=time.time())
+                        running[pool.submit(run_node, node, options)] = node
+            if not running:
+                # Only nodes waiting out a retry delay can be left
+                waiting = [ready_at[node] for node in pending if node in ready_at]
+                if not waiting:
+                    break
+                time.sleep(max(0, min(waiting) - time.time()))
+                continue
+            finished, _ = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                try:
+                    output = future.result()
+                except Exception as error:
+                    attempts[node] = attempts.get(node, 0) + 1
+                    if attempts[node] <= retries:
+                        delay = backoff * 2 ** (attempts[node] - 1)
+                        logger.warning('%s failed (%s), retrying in %gs', node, error, delay)
+                        ready_at[node] = time.time() + delay
+                        pending.add(node)
+                    else:
+                        logger.error('%s failed (%s), giving up', node, error)
+                        state.update(node, status='failed', error=repr(error), finished=time.time())
+                        failed.add(node)
+                        blocked = descendants(graph, node) & pending
+                        for child in blocked:
+                            logger.error('%s skipped, %s failed', child, node)
+                        pending -= blocked
+                    continue
+                state.update(node, status='done', output=output, inputs=state.inputs(graph, node), finished=time.time())
+                logger.info('%s done', node)
+                done.add(node)
+    return done, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the lab extraction and feature steps as a dependency graph.')
+    parser.add_argument('--labs', nargs='+', choices=sorted(LABS), default=sorted(LABS))
+    parser.add_argument('--steps', nargs='+', choices=list(STEPS), default=['features'], help='steps to bring up to date; upstream steps are included')
+    parser.add_argument('--workers', type=int, default=None, help='parallel nodes (default: all cores)')
+    parser.add_argument('--retries', type=int, default=2)
+    parser.add_argument('--backoff', type=float, default=30, help='seconds before the first retry, doubled on every further retry')
+    parser.add_argument('--state', default=os.path.join('artifacts', 'scheduler', 'state.json'))
+    parser.add_argument('--force', nargs='*', default=[], help='nodes to rerun even when up to date, e.g. alt:targets')
+    parser.add_argument('--sample-fraction', type=float, default=None)
+    parser.add_argument('--stratify-by-practice', action='store_true')
+    parser.add_argument('--trend-features', action='store_true', default=None, help='keep the lab history before each pair and add trend features')
+    parser.add_argument('--decoder', choices=['python', 'arrow'], default=None, help="'arrow' decodes raw BSON batches into the declared facet columns")
+    parser.add_argument('--read-timelines', action='store_true', default=None, help='read pairs from the lab timelines kept by timelines.py')
+    parser.add_argument('--read-preference', choices=sorted(PreprocessedLabs.read_modes), default=None, help='route extraction reads to secondaries')
+    parser.add_argument('--read-tags', type=json.loads, default=None, help='tag sets as JSON, e.g. \'[{"nodeType": "ANALYTICS"}]\'')
+    parser.add_argument('--max-staleness', type=int, default=None, help='seconds of replication lag allowed on the members read from')
+    parser.add_argument('--analytics-uri', default=None, help='direct connection to a hidden analytics member')
+    parser.add_argument('--consistent', action='store_true', help='read every facet at one majority-committed cluster time')
+    parser.add_argument('--dry-run', action='store_true', help='print the nodes in dependency order and exit')
+    parser.add_argument('--estimate', action='store_true', help='estimate the extraction of every lab on a small sample and exit')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    graph = build_graph(args.labs, args.steps)
+    if args.dry_run:
+        for node in sorted(graph, key=lambda node: (len(ancestors(graph, node)), node)):
+            print(node, '<-', ', '.join(graph[node]) or '-')
+        return 0
+    options = {
+        'sample_fraction': args.sample_fraction,
+        'stratify_by_practice': args.stratify_by_practice,
+        'trend_features': args.trend_features,
+        'decoder': args.decoder,
+        'read_timelines': args.read_timelines,
+        'read_preference': args.read_preference,
+        'read_tags': args.read_tags,
+        'max_staleness_seconds': args.max_staleness,
+        'analytics_uri': args.analytics_uri,
+        'cluster_time': PreprocessedLabs.majority_time() if args.consistent else None
+    }
+    if options['cluster_time'] is not None:
+        logger.info('reading at cluster time %s', options['cluster_time'])
+    if args.estimate:
+        for lab in args.labs:
+            print(json.dumps(lab_instance(lab, options).estimate(), indent=2, default=str))
+        return 0
+    done, failed = run(graph, State(args.state), options, args.workers, args.retries, args.backoff, set(args.force))
+    logger.info('%d nodes done, %d failed, %d not run', len(done), len(failed), len(graph) - len(done) - len(failed))
+    return 1 if len(done) < len(graph) else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,225 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import joblib
+import numpy as np
+import pandas as pd
+from demographics import DemographicsIndex
+from features import VITAL_FEATURES, FeatureSpec
+from streaming_stats import clean_frame, load_cleaning
+from targets import BinEdges
+from trees import compile_model
+
+FACETS = ['labs', 'vitals', 'diagnosis', 'medications']
+
+
+def save_bundle(path, models, spec, target='lab_after.value', weights=None, edges=None):
+    joblib.dump({
+        'models': models,
+        'weights': weights or [1 / len(models)] * len(models),
+        'spec': spec.to_dict(),
+        'target': target,
+        'edges': None if edges is None else {'analyte': edges.analyte, 'method': edges.method, 'version': edges.version}
+    }, path)
+
+
+def facet_pipelines(lab, source):
+    # The extraction pipelines with their first stage (the $limit or sample
+    # match) replaced by the given source stage, so that every requested
+    # patient is scored whether or not the lab class samples. One cursor per
+    # facet: a single $facet document is capped at 16MB
+    return {facet: [source] + getattr(lab, 'get_%s_pipeline' % facet)()[1:] for facet in FACETS}
+
+
+def document_demographics(documents, fields):
+    rows = []
+    for doc in documents:
+        demographics = (doc.get('demographics') or [{}])[0]
+        rows.append(dict({'PatientID': doc.get('PatientID')}, **{field: demographics.get(field) for field in fields}))
+    return pd.DataFrame(rows, columns=['PatientID'] + fields).drop_duplicates('PatientID')
+
+
+def extract_frame(lab, patient_ids=None, documents=None, cleaning=None, demographics=None):
+    # Same pipelines, batch stages and cleaning (the stats and filters saved
+    # with the cleaned vitals and demo outputs, by facet) as the training
+    # data, applied either to stored patients or to raw documents passed in
+    # through $documents. Stored patients' demographics come from the given
+    # DemographicsIndex, or else from the lab's cache
+    cleaning = cleaning or {}
+    if documents is None:
+        pipelines = facet_pipelines(lab, {'$match': {'PatientID': {'$in': patient_ids}}})
+        results = {facet: list(lab.aggregate(pipeline)) for facet, pipeline in pipelines.items()}
+    else:
+        documents = [dict(doc, _id=doc.get('_id', i)) for i, doc in enumerate(documents)]
+        pipelines = facet_pipelines(lab, {'$documents': documents})
+        results = {facet: list(lab.db.aggregate(pipeline)) for facet, pipeline in pipelines.items()}
+    frames = {}
+    for facet in FACETS:
+        df = pd.json_normalize(results[facet])
+        for stage in lab.batch_stages.get(facet, []):
+            df = stage(df)
+        if '_id' in df:
+            df['_id'] = df['_id'].astype(str)
+        if facet in cleaning:
+            df = clean_frame(df, *cleaning[facet])
+        frames[facet] = df
+    frame = frames['labs']
+    if not len(frame):
+        return frame
+    if documents is None and demographics is not None:
+        demographics = demographics.get(frame['PatientID'].unique())
+    elif documents is None:
+        demographics = lab.get_demographics(frame['PatientID'].unique())
+    else:
+        demographics = document_demographics(documents, lab.demographics_fields)
+    frame = lab.join_demographics(frame, demographics)
+    if 'demo' in cleaning:
+        frame = clean_frame(frame, *cleaning['demo'])
+    if len(frames['vitals']):
+        frame = frame.merge(frames['vitals'][['_id'] + [c for c in VITAL_FEATURES if c in frames['vitals']]], on='_id', how='left')
+    for facet in ('diagnosis', 'medications'):
+        if len(frames[facet]):
+            frame = frame.merge(frames[facet][['_id', facet]], on='_id', how='left')
+    return frame
+
+
+class ScoringRequest:
+    def __init__(self, patient_ids, documents):
+        self.patient_ids = list(patient_ids or [])
+        self.documents = list(documents or [])
+        self.future = Future()
+        self.submitted = time.perf_counter()
+
+    @property
+    def size(self):
+        return len(self.patient_ids) + len(self.documents)
+
+
+class ScoringService:
+    # Loads the ensemble, feature transforms and demographics once; a
+    # background thread merges queued requests into micro-batches of up to
+    # max_batch patients, waiting at most max_wait seconds for a batch to
+    # fill. Tree ensembles are compiled to flat arrays, which predict the same
+    # values without the library's per-call overhead
+    def __init__(self, lab, bundle_path, max_batch=1000, max_wait=0.005, compiled=True):
+        bundle = joblib.load(bundle_path)
+        self.lab = lab
+        self.models = [compile_model(model) for model in bundle['models']] if compiled else bundle['models']
+        self.weights = np.asarray(bundle['weights'], dtype=float)
+        self.spec = FeatureSpec(**bundle['spec'])
+        self.target = bundle['target']
+        self.edges = BinEdges.load(**bundle['edges']) if bundle['edges'] else None
+        # Cleaning of the training data, when the features were built from it
+        self.cleaning = {}
+        for facet in ('vitals', 'demo'):
+            cleaning = load_cleaning(lab.facet_dir(facet + '_clean'))
+            if cleaning is not None:
+                self.cleaning[facet] = cleaning
+        self.demographics = DemographicsIndex(lab.demographics_cache(), lab.fetch_demographics)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=100000)
+        self.batch_sizes = deque(maxlen=100000)
+        self.patients = 0
+        self.started = time.perf_counter()
+        self.worker = threading.Thread(target=self.serve, daemon=True)
+        self.worker.start()
+
+    def submit(self, patient_ids=None, documents=None):
+        request = ScoringRequest(patient_ids, documents)
+        self.requests.put(request)
+        return request.future
+
+    def score(self, patient_ids=None, documents=None, timeout=None):
+        return self.submit(patient_ids, documents).result(timeout)
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+    def serve(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            batch, size = [request], request.size
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    request = self.requests.get(timeout=max(0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.requests.put(None)
+                    break
+                batch.append(request)
+                size += request.size
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        try:
+            frames = []
+            patient_ids = [patient_id for request in batch for patient_id in request.patient_ids]
+            documents = [doc for request in batch for doc in request.documents]
+            if patient_ids:
+                frames.append(extract_frame(self.lab, patient_ids=patient_ids, cleaning=self.cleaning, demographics=self.demographics))
+            if documents:
+                frames.append(extract_frame(self.lab, documents=documents, cleaning=self.cleaning))
+            frame = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+            scored = self.predict(frame) if len(frame) else {}
+            for request in batch:
+                keys = request.patient_ids + [doc.get('PatientID') for doc in request.documents]
+                request.future.set_result([scored.get(key) for key in keys])
+        except Exception as error:
+            for request in batch:
+                request.future.set_exception(error)
+        finished = time.perf_counter()
+        self.batch_sizes.append(sum(request.size for request in batch))
+        for request in batch:
+            self.latencies.append(finished - request.submitted)
+            self.patients += request.size
+
+    def predict(self, frame):
+        X = self.spec.transform(frame)
+        prediction = sum(weight * model.predict(X) for weight, model in zip(self.weights, self.models))
+        bins = np.digitize(prediction, self.edges.edges[self.target]) if self.edges and self.target in self.edges.edges else None
+        scored = {}
+        for i, patient_id in enumerate(frame['PatientID']):
+            scored[patient_id] = {
+                'PatientID': patient_id,
+                'lab_before.date': frame['lab_before.date'].iloc[i],
+                'lab_before.value': frame['lab_before.value'].iloc[i],
+                'prediction': float(prediction[i]),
+                'bin': None if bins is None else int(bins[i])
+            }
+        return scored
+
+    def metrics(self):
+        latencies = np.asarray(self.latencies) * 1000
+        return {
+            'patients': self.patients,
+            'batches': len(self.batch_sizes),
+            'mean_batch': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'patients_per_second': self.patients / (time.perf_counter() - self.started)
+        }
+
+
+def benchmark(service, patient_ids, request_size=1, concurrency=64):
+    # Throughput of a running service: patient_ids are sent as requests of
+    # request_size patients with at most concurrency requests in flight
+    started, patients = time.perf_counter(), 0
+    pending = deque()
+    for i in range(0, len(patient_ids), request_size):
+        if len(pending) == concurrency:
+            pending.popleft().result()
+        pending.append(service.submit(patient_ids[i:i + request_size]))
+        patients += len(patient_ids[i:i + request_size])
+    while pending:
+        pending.popleft().result()
+    elapsed = time.perf_counter() - started
+    return dict(service.metrics(), benchmark_patients=patients, benchmark_seconds=elapsed, benchmark_patients_per_second=patients / max(elapsed, 1e-9))
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+from sklearn.impute import SimpleImputer
+from sklearn.model_selection import ParameterGrid
+from sklearn.pipeline import make_pipeline
+
+
+def make_model(model, params, budget):
+    # The budget is the number of trees / boosting rounds
+    if model == 'rf':
+        return RandomForestRegressor(n_estimators=budget, n_jobs=1, random_state=0, **params)
+    if model == 'gb':
+        return make_pipeline(SimpleImputer(strategy='median'), GradientBoostingRegressor(n_estimators=budget, random_state=0, **params))
+    if model == 'xgb':
+        # xgboost is only needed when it is searched over
+        from xgboost import XGBRegressor
+        return XGBRegressor(n_estimators=budget, n_jobs=1, random_state=0, **params)
+    raise ValueError('Unknown model %r' % model)
+
+
+def fold_arrays(folds):
+    # All folds as one index array plus (train start, test start, end) bounds
+    indices, bounds, start = [], [], 0
+    for train, test in folds:
+        indices += [np.asarray(train, dtype=np.int64), np.asarray(test, dtype=np.int64)]
+        bounds.append((start, start + len(train), start + len(train) + len(test)))
+        start += len(train) + len(test)
+    return np.concatenate(indices), np.asarray(bounds, dtype=np.int64)
+
+
+class SharedArrays:
+    # Copies arrays into shared memory once; workers attach by name instead of
+    # receiving pickled copies
+    def __init__(self, arrays):
+        self.blocks = []
+        self.specs = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+            self.blocks.append(block)
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+
+worker_arrays = {}
+worker_blocks = []
+
+
+def attach(specs):
+    for name, (block_name, shape, dtype) in specs.items():
+        # Pool workers share the parent's resource tracker, so attaching does
+        # not take ownership; the parent unlinks the block when it is done
+        block = shared_memory.SharedMemory(name=block_name)
+        worker_blocks.append(block)
+        worker_arrays[name] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+
+
+def evaluate(model, params, budget, fold):
+    X, y = worker_arrays['X'], worker_arrays['y']
+    start, middle, end = worker_arrays['bounds'][fold]
+    train = worker_arrays['indices'][start:middle]
+    test = worker_arrays['indices'][middle:end]
+    started = time.perf_counter()
+    estimator = make_model(model, params, budget).fit(X[train], y[train])
+    error = estimator.predict(X[test]) - y[test]
+    return {
+        'rmse': float(np.sqrt(np.mean(error ** 2))),
+        'mae': float(np.mean(np.abs(error))),
+        'seconds': time.perf_counter() - started
+    }
+
+
+class ResultCache:
+    # One JSON file per (matrix, folds, model, params, budget, fold)
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(**fields):
+        return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.path, key + '.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+
+    def put(self, key, result):
+        path = os.path.join(self.path, key + '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(result, f)
+        os.replace(path + '.tmp', path)
+
+
+def successive_halving(matrix, folds, model, grid, min_budget=50, max_budget=800, eta=3, max_workers=None, cache_dir=os.path.join('artifacts', 'search')):
+    # Every configuration starts on the smallest budget; each round keeps the
+    # best 1/eta and multiplies the budget by eta until max_budget
+    indices, bounds = fold_arrays(folds)
+    folds_hash = hashlib.sha256(indices.tobytes() + bounds.tobytes()).hexdigest()
+    cache = ResultCache(os.path.join(cache_dir, matrix.version, model))
+    configs = list(ParameterGrid(grid))
+    budget = min_budget
+    history = []
+    with SharedArrays({'X': matrix.X, 'y': matrix.y, 'indices': indices, 'bounds': bounds}) as shared:
+        with ProcessPoolExecutor(max_workers, initializer=attach, initargs=(shared.specs,)) as pool:
+            while True:
+                pending, results = {}, {}
+                for i, params in enumerate(configs):
+                    for fold in range(len(bounds)):
+                        key = cache.key(matrix=matrix.version, folds=folds_hash, model=model, params=params, budget=budget, fold=fold)
+                        cached = cache.get(key)
+                        if cached is None:
+                            pending[key] = (i, pool.submit(evaluate, model, params, budget, fold))
+                        else:
+                            results.setdefault(i, []).append(cached)
+                for key, (i, future) in pending.items():
+                    result = future.result()
+                    cache.put(key, result)
+                    results.setdefault(i, []).append(result)
+                ranked = sorted(
+                    ({
+                        'params': configs[i],
+                        'budget': budget,
+                        'rmse': float(np.mean([r['rmse'] for r in fold_results])),
+                        'mae': float(np.mean([r['mae'] for r in fold_results]))
+                    } for i, fold_results in results.items()),
+                    key=lambda record: record['rmse']
+                )
+                history += ranked
+                if budget >= max_budget or len(configs) <= 1:
+                    break
+                configs = [record['params'] for record in ranked[:max(1, len(ranked) // eta)]]
+                budget = min(budget * eta, max_budget)
+    return ranked[0], history
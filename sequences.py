@@ -0,0 +1,307 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from analytes import lab_tests
+from normalization import VITAL_ALIASES, clean_strings, compile_lookup, explode_records, normalize_values
+
+# Event arrays of the store; the events of patient i are the rows
+# offsets[i]:offsets[i + 1], in time order
+EVENT_ARRAYS = {
+    'timestamps': np.dtype('datetime64[ms]'),
+    'codes': np.dtype(np.int32),
+    'values': np.dtype(np.float32)
+}
+
+# Fill of the padded positions of a mini-batch
+PADDING = {
+    'timestamps': np.datetime64('NaT', 'ms'),
+    'codes': -1,
+    'values': 0
+}
+
+
+def sequence_pipeline(tests, sample_stage=None):
+    # A medication's value is the dose of the whole prescription, dose_g x
+    # frequency x days from sig_parsed, as the medications facet computes it.
+    # Documents are read in PatientID order, sorted first so that an index on
+    # PatientID (assumed; it is not created here) serves the sort without a
+    # blocking sort of the projected documents
+    return ([sample_stage] if sample_stage else []) + [
+        {
+            '$sort': {
+                'PatientID': 1
+            }
+        }, {
+            '$project': {
+                'PatientID': 1, 
+                'lab_results': {
+                    '$map': {
+                        'input': {
+                            '$filter': {
+                                'input': '$lab_results', 
+                                'as': 'lab', 
+                                'cond': {
+                                    '$in': [
+                                        '$$lab.api_test_name', list(tests)
+                                    ]
+                                }
+                            }
+                        }, 
+                        'as': 'lab', 
+                        'in': {
+                            'date': '$$lab.date', 
+                            'name': '$$lab.api_test_name', 
+                            'result': '$$lab.result', 
+                            'unit': '$$lab.unit'
+                        }
+                    }
+                }, 
+                'vitals': {
+                    '$map': {
+                        'input': '$vitals', 
+                        'as': 'vital', 
+                        'in': {
+                            'date': '$$vital.date', 
+                            'name': '$$vital.name', 
+                            'result': '$$vital.result', 
+                            'unit': '$$vital.unit'
+                        }
+                    }
+                }, 
+                'medications': {
+                    '$map': {
+                        'input': '$medications', 
+                        'as': 'med', 
+                        'in': {
+                            'date': '$$med.date', 
+                            'gpi': '$$med.gpi', 
+                            'dosage': {
+                                '$multiply': [
+                                    '$$med.sig_parsed.dose_g', '$$med.sig_parsed.frequency', '$$med.sig_parsed.days'
+                                ]
+                            }
+                        }
+                    }
+                }, 
+                'diagnosis': {
+                    '$map': {
+                        'input': {
+                            '$filter': {
+                                'input': '$diagnosis', 
+                                'as': 'diag', 
+                                'cond': {
+                                    '$eq': [
+                                        '$$diag.status', 'Active'
+                                    ]
+                                }
+                            }
+                        }, 
+                        'as': 'diag', 
+                        'in': {
+                            'date': '$$diag.date', 
+                            'icd_10': '$$diag.icd_10'
+                        }
+                    }
+                }
+            }
+        }
+    ]
+
+
+def records(docs, field, columns):
+    if field not in docs.columns:
+        return pd.DataFrame(columns=columns)
+    return explode_records(docs[field]).reindex(columns=columns)
+
+
+def event_frame(rows, dates, prefix, names, values, dropna=True):
+    events = pd.DataFrame({
+        'row': np.asarray(rows, dtype=np.int64),
+        'timestamps': pd.to_datetime(pd.Series(np.asarray(dates, dtype=object)), errors='coerce').to_numpy(dtype='datetime64[ms]'),
+        'event': prefix + pd.Series(np.asarray(names, dtype=object)).astype('string'),
+        'values': np.asarray(values, dtype=np.float32)
+    })
+    keep = events['event'].notna() & events['timestamps'].notna()
+    if dropna:
+        keep &= events['values'].notna()
+    return events[keep.to_numpy(dtype=bool)]
+
+
+def batch_events(docs, tests, vocabulary):
+    # Every event of a batch of patient documents, normalized in one pass per
+    # kind: labs and vitals in target units (unparseable readings dropped),
+    # medications by GPI drug group with their dosage, diagnoses by ICD-10
+    # category with value 1. New event names are added to the vocabulary
+    labs = records(docs, 'lab_results', ['date', 'name', 'result', 'unit'])
+    analyte = compile_lookup(labs['name'], tests)
+    lab_values, _, _, _ = normalize_values(analyte, labs['result'], labs['unit'])
+    vitals = records(docs, 'vitals', ['date', 'name', 'result', 'unit'])
+    vital = compile_lookup(clean_strings(vitals['name']).str.lower(), VITAL_ALIASES)
+    vital_values, _, _, _ = normalize_values(vital, vitals['result'], vitals['unit'])
+    meds = records(docs, 'medications', ['date', 'gpi', 'dosage'])
+    diagnosis = records(docs, 'diagnosis', ['date', 'icd_10'])
+    events = pd.concat([
+        event_frame(labs.index, labs['date'], 'lab:', analyte, lab_values),
+        event_frame(vitals.index, vitals['date'], 'vital:', vital, vital_values),
+        event_frame(meds.index, meds['date'], 'gpi:', clean_strings(meds['gpi']).str[:2], pd.to_numeric(meds['dosage'], errors='coerce'), dropna=False),
+        event_frame(diagnosis.index, diagnosis['date'], 'icd_10:', clean_strings(diagnosis['icd_10']).str.split('.').str[0], np.ones(len(diagnosis)))
+    ], ignore_index=True)
+    codes, names = pd.factorize(events.pop('event'))
+    ids = np.array([vocabulary.setdefault(name, len(vocabulary)) for name in names], dtype=np.int32)
+    events['codes'] = ids[codes]
+    return events
+
+
+class SequenceWriter:
+    # Appends the events of consecutive patients to raw spill files; finish()
+    # prefixes each with a .npy header so np.load can memory-map it
+    def __init__(self, path):
+        self.path = path
+        self.staging = path + '.tmp'
+        shutil.rmtree(self.staging, ignore_errors=True)
+        os.makedirs(self.staging)
+        self.files = {name: open(os.path.join(self.staging, name + '.bin'), 'wb') for name in EVENT_ARRAYS}
+        self.patient_ids = []
+        self.offsets = [0]
+
+    def append(self, patient_ids, counts, events):
+        for name, dtype in EVENT_ARRAYS.items():
+            self.files[name].write(np.ascontiguousarray(events[name].to_numpy(), dtype=dtype).tobytes())
+        self.patient_ids.extend(patient_ids)
+        self.offsets.extend((self.offsets[-1] + np.cumsum(counts)).tolist())
+
+    def finish(self, meta):
+        for name, dtype in EVENT_ARRAYS.items():
+            self.files[name].close()
+            raw = os.path.join(self.staging, name + '.bin')
+            with open(os.path.join(self.staging, name + '.npy'), 'wb') as f:
+                np.lib.format.write_array_header_1_0(f, {
+                    'descr': np.lib.format.dtype_to_descr(dtype),
+                    'fortran_order': False,
+                    'shape': (self.offsets[-1],)
+                })
+                with open(raw, 'rb') as source:
+                    shutil.copyfileobj(source, f, 1 << 24)
+            os.remove(raw)
+        np.save(os.path.join(self.staging, 'offsets.npy'), np.asarray(self.offsets, dtype=np.int64))
+        np.save(os.path.join(self.staging, 'patient_ids.npy'), np.asarray(self.patient_ids, dtype=str))
+        with open(os.path.join(self.staging, 'meta.json'), 'w') as f:
+            json.dump(dict(meta, patients=len(self.patient_ids), events=self.offsets[-1]), f, indent=2)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.staging, self.path)
+
+
+def write_patients(writer, docs, tests, vocabulary, carry, final):
+    # Documents arrive in PatientID order. The last patient of a batch may
+    # continue in the next one, so its events are carried over unless final
+    events = batch_events(docs, tests, vocabulary)
+    patients = docs['PatientID'].astype(str).to_numpy()
+    events['patient'] = patients[events.pop('row').to_numpy()]
+    if carry is not None:
+        patients = np.concatenate([[carry[0]], patients])
+        events = pd.concat([carry[1], events], ignore_index=True)
+    patients = pd.unique(patients)
+    position = pd.Index(patients).get_indexer(events['patient'])
+    order = np.lexsort((events['codes'].to_numpy(), events['timestamps'].to_numpy(), position))
+    events, position = events.iloc[order], position[order]
+    counts = np.bincount(position, minlength=len(patients))
+    if final:
+        writer.append(patients, counts, events)
+        return None
+    last = len(patients) - 1
+    writer.append(patients[:last], counts[:last], events[position < last])
+    return patients[last], events[position == last]
+
+
+def export_sequences(labs, path=None, sample_fraction=None, stratify_by_practice=False):
+    # Writes the time-ordered events of every patient from one pass over the
+    # collection. Labs are those of the given lab classes; reads go through
+    # the routing of the first one
+    lab = labs[0]
+    tests = {}
+    for each in labs:
+        tests.update(lab_tests(each))
+    path = path or os.path.join(lab.output_dir, 'sequences')
+    sample_stage = lab.get_sample_stage(sample_fraction, stratify_by_practice) if sample_fraction is not None else None
+    writer = SequenceWriter(path)
+    vocabulary, batch, carry = {}, [], None
+    for doc in lab.aggregate(sequence_pipeline(tests, sample_stage)):
+        batch.append(doc)
+        if len(batch) == lab.batch_size:
+            carry = write_patients(writer, pd.DataFrame(batch), tests, vocabulary, carry, final=False)
+            batch = []
+    if batch or carry is not None:
+        write_patients(writer, pd.DataFrame(batch or {'PatientID': []}), tests, vocabulary, carry, final=True)
+    writer.finish({
+        'labs': sorted(set(tests.values())),
+        'sample_fraction': sample_fraction,
+        'vocabulary': sorted(vocabulary, key=vocabulary.get)
+    })
+    return SequenceStore(path)
+
+
+class SequenceStore:
+    # Ragged per-patient event sequences, memory-mapped. Random access by
+    # patient reads only that patient's rows, and mini-batches are padded to
+    # their own longest sequence as they are drawn
+    arrays = ['offsets', 'patient_ids'] + list(EVENT_ARRAYS)
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        for name in self.arrays:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.vocabulary = self.meta['vocabulary']
+        self.lengths = np.diff(self.offsets)
+        self.order = None
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def index(self, patient_id):
+        # PatientIDs follow the server's sort order, which for numeric ids is
+        # not the order of their strings
+        if self.order is None:
+            self.order = np.argsort(self.patient_ids, kind='stable')
+        i = np.searchsorted(self.patient_ids[self.order], str(patient_id))
+        if i == len(self) or self.patient_ids[self.order[i]] != str(patient_id):
+            raise KeyError(patient_id)
+        return int(self.order[i])
+
+    def sequence(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return {name: getattr(self, name)[start:end] for name in EVENT_ARRAYS}
+
+    def get(self, patient_id):
+        return self.sequence(self.index(patient_id))
+
+    def batch(self, rows, max_length=None):
+        # The latest max_length events of each patient, left-aligned and padded
+        rows = np.asarray(rows, dtype=np.int64)
+        lengths = self.lengths[rows]
+        if max_length is not None:
+            lengths = np.minimum(lengths, max_length)
+        width = int(lengths.max()) if len(rows) else 0
+        mask = np.arange(width) < lengths[:, None]
+        index = (self.offsets[rows + 1] - lengths)[:, None] + np.arange(width)
+        batch = {'rows': rows, 'patient_ids': self.patient_ids[rows], 'lengths': lengths, 'mask': mask}
+        for name, dtype in EVENT_ARRAYS.items():
+            padded = np.full(mask.shape, PADDING[name], dtype=dtype)
+            padded[mask] = getattr(self, name)[index[mask]]
+            batch[name] = padded
+        return batch
+
+    def batches(self, batch_size=64, max_length=None, shuffle=True, seed=0, pool=50):
+        # Rows are shuffled, then sorted by length within pools of `pool`
+        # batches so that a batch pads to similar lengths
+        rng = np.random.default_rng(seed)
+        order = rng.permutation(len(self)) if shuffle else np.arange(len(self))
+        for start in range(0, len(order), batch_size * pool):
+            chunk = order[start:start + batch_size * pool]
+            chunk = chunk[np.argsort(self.lengths[chunk], kind='stable')]
+            bounds = np.arange(0, len(chunk), batch_size)
+            for i in (rng.permutation(bounds) if shuffle else bounds):
+                yield self.batch(chunk[i:i + batch_size], max_length)
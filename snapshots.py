@@ -0,0 +1,141 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import stat
+import sys
+import time
+from streaming_stats import part_paths
+
+
+def digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def repo_modules(module, found=None):
+    # The module and the modules of this repository it imports, transitively;
+    # a stage's helpers and tables (unit factors, ranges) live there
+    found = {} if found is None else found
+    root = os.path.dirname(os.path.abspath(__file__))
+    path = getattr(module, '__file__', None)
+    if path is None or os.path.dirname(os.path.abspath(path)) != root or module.__name__ in found:
+        return found
+    found[module.__name__] = module
+    for value in list(vars(module).values()):
+        imported = value if inspect.ismodule(value) else inspect.getmodule(value)
+        if imported is not None:
+            repo_modules(imported, found)
+    return found
+
+
+def code_digest(function):
+    # Batch stages are part of a facet's definition, so the source of the
+    # stage and of every repository module it can reach is hashed
+    modules = repo_modules(sys.modules[function.__module__])
+    return digest({
+        'function': inspect.getsource(function),
+        'modules': {name: inspect.getsource(module) for name, module in sorted(modules.items())}
+    })
+
+
+def file_checksum(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def dataset_checksums(path):
+    return {os.path.basename(part): file_checksum(part) for part in part_paths(path)}
+
+
+def source_version(collection):
+    # The collection has no version field; its size and newest _id change on
+    # every load. In-place updates are not visible here, so a refreshed source
+    # should be named explicitly through PreprocessedLabs.source_version
+    last = next(iter(collection.find({}, {'_id': 1}).sort('_id', -1).limit(1)), None)
+    return {
+        'database': collection.database.name,
+        'collection': collection.name,
+        'count': collection.estimated_document_count(),
+        'last_id': None if last is None else str(last['_id'])
+    }
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class Snapshot:
+    # Immutable facet outputs under <snapshot_dir>/<lab>/<facet>/<key>, where
+    # the key is the hash of everything that determines the output. The
+    # manifest is written last, so a directory without one is incomplete
+    snapshot_dir = os.path.join('artifacts', 'snapshots')
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+
+    @classmethod
+    def location(cls, lab, facet, inputs):
+        return os.path.join(cls.snapshot_dir, lab, facet, digest(inputs)[:16])
+
+    @classmethod
+    def find(cls, lab, facet, inputs):
+        path = cls.location(lab, facet, inputs)
+        if not os.path.exists(os.path.join(path, 'manifest.json')):
+            return None
+        with open(os.path.join(path, 'manifest.json')) as f:
+            return cls(path, json.load(f))
+
+    @classmethod
+    def create(cls, lab, facet, inputs, source):
+        path = cls.location(lab, facet, inputs)
+        staging = path + '.tmp'
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        for part in part_paths(source):
+            link_or_copy(part, os.path.join(staging, os.path.basename(part)))
+        files = dataset_checksums(staging)
+        manifest = {
+            'lab': lab,
+            'facet': facet,
+            'key': os.path.basename(path),
+            'inputs': inputs,
+            'files': files,
+            'digest': digest(files),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        }
+        with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        for name in os.listdir(staging):
+            os.chmod(os.path.join(staging, name), stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        if os.path.exists(path):
+            # Another run finished the same snapshot first
+            shutil.rmtree(staging)
+            return cls.find(lab, facet, inputs)
+        os.replace(staging, path)
+        return cls(path, manifest)
+
+    @property
+    def digest(self):
+        return self.manifest['digest']
+
+    def verify(self):
+        return dataset_checksums(self.path) == self.manifest['files']
+
+    def materialize(self, destination):
+        # Nothing to do when the destination already links these files
+        present = {os.path.basename(part): part for part in part_paths(destination)}
+        if sorted(present) == sorted(self.manifest['files']) and all(os.path.samefile(present[name], os.path.join(self.path, name)) for name in present):
+            return
+        os.makedirs(destination, exist_ok=True)
+        for part in part_paths(destination):
+            os.remove(part)
+        for name in self.manifest['files']:
+            link_or_copy(os.path.join(self.path, name), os.path.join(destination, name))
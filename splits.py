@@ -0,0 +1,92 @@
+import json
+import os
+import numpy as np
+
+
+def group_codes(values):
+    return np.unique(np.asarray(values), return_inverse=True)[1]
+
+
+def assign_folds(codes, n_splits, seed=0):
+    # Shuffles whole groups and cuts the running row count into n_splits
+    # nearly equal ranges, so fold sizes differ by at most one group
+    sizes = np.bincount(codes)
+    order = np.random.default_rng(seed).permutation(len(sizes))
+    before = np.cumsum(sizes[order]) - sizes[order]
+    group_fold = np.empty(len(sizes), dtype=np.int64)
+    group_fold[order] = before * n_splits // max(sizes.sum(), 1)
+    return group_fold[codes]
+
+
+def temporal_holdout(dates, codes, cutoff=None, fraction=0.2):
+    # Rows on or after the cutoff are held out; patients (codes) with any
+    # held-out row are purged from training so none appears on both sides
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+    if cutoff is None:
+        cutoff = np.sort(dates)[int(len(dates) * (1 - fraction))] if len(dates) else None
+    holdout = dates >= np.datetime64(cutoff, 'ns')
+    leaked = np.zeros(codes.max() + 1 if len(codes) else 0, dtype=bool)
+    leaked[codes[holdout]] = True
+    return np.flatnonzero(~leaked[codes]), np.flatnonzero(holdout), np.datetime64(cutoff, 'ns')
+
+
+class SplitPlan:
+    # Index arrays only; rows are read from the (memory-mapped) matrix by the
+    # consumer, so building a plan never copies the feature matrix
+    def __init__(self, train, holdout, folds, meta):
+        self.train = train
+        self.holdout = holdout
+        self.folds = folds
+        self.meta = meta
+
+    @classmethod
+    def build(cls, matrix, group_by='patient', n_splits=5, cutoff=None, holdout_fraction=0.2, seed=0):
+        # The holdout is purged by patient whatever the grouping: nearly every
+        # practice has a row after the cutoff, so purging by practice would
+        # leave no training rows. Folds keep whole groups of group_by
+        groups = matrix.patient_ids if group_by == 'patient' else matrix.practices
+        codes = group_codes(groups)
+        if cutoff is None and not holdout_fraction:
+            train, holdout = np.arange(len(codes)), np.empty(0, dtype=np.int64)
+        else:
+            train, holdout, cutoff = temporal_holdout(matrix.dates, group_codes(matrix.patient_ids), cutoff, holdout_fraction)
+        fold_of_row = assign_folds(codes[train], n_splits, seed)
+        folds = [(train[fold_of_row != k], train[fold_of_row == k]) for k in range(n_splits)]
+        meta = {
+            'matrix': matrix.version,
+            'group_by': group_by,
+            'n_splits': n_splits,
+            'cutoff': None if cutoff is None else str(cutoff),
+            'seed': seed
+        }
+        return cls(train, holdout, folds, meta)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'train.npy'), self.train)
+        np.save(os.path.join(path, 'holdout.npy'), self.holdout)
+        for k, (fold_train, fold_test) in enumerate(self.folds):
+            np.save(os.path.join(path, 'fold-%02d-train.npy' % k), fold_train)
+            np.save(os.path.join(path, 'fold-%02d-test.npy' % k), fold_test)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode=mmap_mode)
+        folds = [(load('fold-%02d-train.npy' % k), load('fold-%02d-test.npy' % k)) for k in range(meta['n_splits'])]
+        return cls(load('train.npy'), load('holdout.npy'), folds, meta)
+
+    @classmethod
+    def for_matrix(cls, matrix, **options):
+        # Cached next to the matrix so every model family reuses the same folds
+        path = os.path.join(matrix.path, 'splits', '-'.join('%s=%s' % item for item in sorted(options.items())) or 'default')
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            plan = cls.load(path)
+            if plan.meta['matrix'] == matrix.version:
+                return plan
+        plan = cls.build(matrix, **options)
+        plan.save(path)
+        return plan
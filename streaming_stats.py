@@ -0,0 +1,235 @@
+import glob
+import json
+import os
+from collections import Counter
+import numpy as np
+import pandas as pd
+
+# Written next to the cleaned parts, so scoring can clean new rows the same
+# way; the leading underscore keeps it out of parquet directory reads
+CLEANING_FILE = '_cleaning.json'
+
+
+class QuantileSketch:
+    # KLL-style mergeable sketch: level h holds items of weight 2**h and each
+    # level is bounded, so memory stays O(k log n) however many values arrive.
+    # Compaction alternates its offset instead of flipping a coin, which keeps
+    # results reproducible across runs.
+    def __init__(self, k=200):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.offsets = [0]
+        self.count = 0
+
+    def capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+        return self
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+            self.offsets.append(0)
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.count += other.count
+        self.compress()
+        return self
+
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                    self.offsets.append(0)
+                items = np.sort(items)
+                # An odd item out stays behind so total weight is preserved
+                kept, items = items[:len(items) % 2], items[len(items) % 2:]
+                promoted = items[self.offsets[level]::2]
+                self.offsets[level] ^= 1
+                self.levels[level] = kept
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def quantile(self, q):
+        if not self.count:
+            return np.nan
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level_items), 2 ** level) for level, level_items in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        cumulative = np.cumsum(weights[order])
+        index = np.searchsorted(cumulative, q * cumulative[-1], side='left')
+        return float(items[order][min(index, len(items) - 1)])
+
+    def quantiles(self, qs):
+        return [self.quantile(q) for q in qs]
+
+    def to_dict(self):
+        return {
+            'k': self.k,
+            'count': self.count,
+            'offsets': list(self.offsets),
+            'levels': [items.tolist() for items in self.levels]
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state['k'])
+        sketch.count = state['count']
+        sketch.offsets = list(state['offsets'])
+        sketch.levels = [np.asarray(items, dtype=float) for items in state['levels']]
+        return sketch
+
+
+class StreamingStats:
+    # Quantile sketches for numeric columns and frequency counters for
+    # categorical columns, kept per group (e.g. Practice) and mergeable across
+    # output partitions
+    def __init__(self, numeric_columns, categorical_columns, group_by=None, k=200):
+        self.numeric_columns = list(numeric_columns)
+        self.categorical_columns = list(categorical_columns)
+        self.group_by = group_by
+        self.k = k
+        self.sketches = {}
+        self.counters = {}
+
+    def groups(self, df):
+        if self.group_by is None:
+            return [(None, df)]
+        return df.groupby(self.group_by, dropna=False, sort=False)
+
+    def update(self, df):
+        for group, rows in self.groups(df):
+            for column in self.numeric_columns:
+                if column in rows:
+                    self.sketches.setdefault((group, column), QuantileSketch(self.k)).update(rows[column].to_numpy(dtype=float))
+            for column in self.categorical_columns:
+                if column in rows:
+                    self.counters.setdefault((group, column), Counter()).update(rows[column].dropna().value_counts().to_dict())
+        return self
+
+    def merge(self, other):
+        for key, sketch in other.sketches.items():
+            if key in self.sketches:
+                self.sketches[key].merge(sketch)
+            else:
+                self.sketches[key] = sketch
+        for key, counter in other.counters.items():
+            self.counters.setdefault(key, Counter()).update(counter)
+        return self
+
+    def overall_sketch(self, column):
+        sketch = QuantileSketch(self.k)
+        for (_, name), part in self.sketches.items():
+            if name == column:
+                sketch.merge(part)
+        return sketch
+
+    def overall_counter(self, column):
+        counter = Counter()
+        for (_, name), part in self.counters.items():
+            if name == column:
+                counter.update(part)
+        return counter
+
+    def medians(self, column):
+        # Per-group medians, with the overall median for groups without data
+        overall = self.overall_sketch(column).quantile(0.5)
+        medians = {group: sketch.quantile(0.5) for (group, name), sketch in self.sketches.items() if name == column and sketch.count}
+        return medians, overall
+
+    def modes(self, column):
+        overall = self.overall_counter(column).most_common(1)
+        modes = {group: counter.most_common(1)[0][0] for (group, name), counter in self.counters.items() if name == column and counter}
+        return modes, overall[0][0] if overall else None
+
+    def to_dict(self):
+        return {
+            'numeric_columns': self.numeric_columns,
+            'categorical_columns': self.categorical_columns,
+            'group_by': self.group_by,
+            'k': self.k,
+            'sketches': [[group, column, sketch.to_dict()] for (group, column), sketch in self.sketches.items()],
+            'counters': [[group, column, dict(counter)] for (group, column), counter in self.counters.items()]
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        stats = cls(state['numeric_columns'], state['categorical_columns'], state['group_by'], state['k'])
+        stats.sketches = {(group, column): QuantileSketch.from_dict(sketch) for group, column, sketch in state['sketches']}
+        stats.counters = {(group, column): Counter(counter) for group, column, counter in state['counters']}
+        return stats
+
+
+def part_paths(path):
+    return sorted(glob.glob(os.path.join(path, 'part-*.parquet')))
+
+
+def collect_stats(path, numeric_columns, categorical_columns, group_by=None):
+    # First pass: one small stats object per part file, merged together
+    stats = StreamingStats(numeric_columns, categorical_columns, group_by)
+    for part in part_paths(path):
+        stats.merge(StreamingStats(numeric_columns, categorical_columns, group_by).update(pd.read_parquet(part)))
+    return stats
+
+
+def fill_by_group(df, column, values, default, group_by):
+    if group_by is None:
+        fill = default
+    else:
+        fill = df[group_by].map(values).fillna(default) if values else default
+    df[column] = df[column].fillna(fill)
+
+
+def clean_frame(df, stats, filters=()):
+    # Imputes from the collected stats and drops the rows outside a filter
+    for column in stats.numeric_columns:
+        if column in df:
+            medians, overall = stats.medians(column)
+            fill_by_group(df, column, medians, overall, stats.group_by)
+    for column in stats.categorical_columns:
+        if column in df:
+            modes, overall = stats.modes(column)
+            fill_by_group(df, column, modes, overall, stats.group_by)
+    mask = np.ones(len(df), dtype=bool)
+    for column, low, high in filters:
+        if column in df:
+            mask &= df[column].between(low, high).to_numpy()
+    return df[mask]
+
+
+def clean_parts(source, destination, stats, filters=()):
+    # Second pass: impute and filter, rewriting one part file at a time. The
+    # stats and filters are saved with the parts
+    os.makedirs(destination, exist_ok=True)
+    for old in part_paths(destination):
+        os.remove(old)
+    kept = dropped = 0
+    for part in part_paths(source):
+        df = pd.read_parquet(part)
+        cleaned = clean_frame(df, stats, filters)
+        kept += len(cleaned)
+        dropped += len(df) - len(cleaned)
+        cleaned.to_parquet(os.path.join(destination, os.path.basename(part)), index=False)
+    with open(os.path.join(destination, CLEANING_FILE), 'w') as f:
+        json.dump({'stats': stats.to_dict(), 'filters': [list(item) for item in filters]}, f)
+    return kept, dropped
+
+
+def load_cleaning(path):
+    # The stats and filters a cleaned output was produced with, or None
+    path = os.path.join(path, CLEANING_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        state = json.load(f)
+    return StreamingStats.from_dict(state['stats']), [tuple(item) for item in state['filters']]
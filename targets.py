@@ -0,0 +1,131 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+from streaming_stats import QuantileSketch, part_paths
+
+# Clinical bin edges per analyte in normalized units (U/L for ALT and AST, g/dL
+# for albumin); the outer bins are open so every value falls in a class
+CLINICAL_EDGES = {
+    'alanine_aminotransferase': [10, 20, 30, 40, 50, 60, 80, 100, 120],
+    'aspartate_aminotransferase': [10, 20, 30, 40, 50, 60, 80, 100, 120],
+    'albumin': [2.5, 3.0, 3.5, 3.8, 4.0, 4.2, 4.5, 5.0, 5.5]
+}
+
+TARGET_COLUMNS = ['lab_after.value', 'delta']
+PAIR_COLUMNS = {
+    'lab_before.value': 'float64',
+    'lab_after.value': 'float64',
+    'lab_before.date': 'datetime64[ns]',
+    'lab_after.date': 'datetime64[ns]'
+}
+
+
+def compute_targets(df):
+    # An empty part may have been written without columns
+    if df.empty:
+        df = df.assign(**{column: pd.Series(dtype=dtype) for column, dtype in PAIR_COLUMNS.items()})
+    before = df['lab_before.value'].to_numpy(dtype=float)
+    after = df['lab_after.value'].to_numpy(dtype=float)
+    df['delta'] = after - before
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['ratio'] = np.where(before > 0, after / before, np.nan)
+    df['days_between'] = (df['lab_after.date'] - df['lab_before.date']).dt.days
+    return df
+
+
+def apply_bins(df, edges):
+    for column, inner in edges.items():
+        values = df[column].to_numpy(dtype=float)
+        bins = np.digitize(values, inner).astype(np.int8)
+        bins[np.isnan(values)] = -1
+        df[column + '.bin'] = bins
+    return df
+
+
+class BinEdges:
+    # Versioned bin edge artifacts: <artifact_dir>/<analyte>/<method>-vNNNN.json
+    artifact_dir = os.path.join('artifacts', 'bin_edges')
+
+    def __init__(self, analyte, method, edges, version=None, rows=None):
+        self.analyte = analyte
+        self.method = method
+        self.edges = edges
+        self.version = version
+        self.rows = rows
+
+    @property
+    def fingerprint(self):
+        return hashlib.sha256(json.dumps(self.edges, sort_keys=True).encode()).hexdigest()
+
+    @classmethod
+    def versions(cls, analyte, method):
+        pattern = os.path.join(cls.artifact_dir, analyte, '%s-v*.json' % method)
+        return sorted(int(re.search(r'-v(\d+)\.json$', path).group(1)) for path in glob.glob(pattern))
+
+    @classmethod
+    def path(cls, analyte, method, version):
+        return os.path.join(cls.artifact_dir, analyte, '%s-v%04d.json' % (method, version))
+
+    def save(self):
+        versions = self.versions(self.analyte, self.method)
+        # Identical edges are not re-versioned
+        if versions:
+            latest = self.load(self.analyte, self.method, versions[-1])
+            if latest.fingerprint == self.fingerprint:
+                return latest
+        self.version = (versions[-1] if versions else 0) + 1
+        path = self.path(self.analyte, self.method, self.version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({
+                'analyte': self.analyte,
+                'method': self.method,
+                'version': self.version,
+                'rows': self.rows,
+                'fingerprint': self.fingerprint,
+                'edges': self.edges
+            }, f, indent=2)
+        return self
+
+    @classmethod
+    def load(cls, analyte, method, version=None):
+        if version is None:
+            versions = cls.versions(analyte, method)
+            if not versions:
+                return None
+            version = versions[-1]
+        with open(cls.path(analyte, method, version)) as f:
+            state = json.load(f)
+        return cls(state['analyte'], state['method'], state['edges'], state['version'], state['rows'])
+
+
+def fit_edges(path, analyte, method='quantile', n_bins=10, columns=TARGET_COLUMNS):
+    # One streaming pass over the labs facet; clinical edges need no pass
+    if method == 'clinical':
+        return BinEdges(analyte, method, {'lab_after.value': CLINICAL_EDGES[analyte]}).save()
+    sketches = {column: QuantileSketch() for column in columns}
+    rows = 0
+    for part in part_paths(path):
+        df = compute_targets(pd.read_parquet(part))
+        rows += len(df)
+        for column in columns:
+            sketches[column].update(df[column].to_numpy(dtype=float))
+    edges = {
+        column: sorted(set(q for q in sketch.quantiles(np.arange(1, n_bins) / n_bins) if not np.isnan(q)))
+        for column, sketch in sketches.items()
+    }
+    return BinEdges(analyte, method, edges, rows=rows).save()
+
+
+def build_targets(path, destination, edges):
+    os.makedirs(destination, exist_ok=True)
+    for old in part_paths(destination):
+        os.remove(old)
+    for part in part_paths(path):
+        df = apply_bins(compute_targets(pd.read_parquet(part)), edges.edges)
+        df['bin_edges.version'] = edges.version
+        df.to_parquet(os.path.join(destination, os.path.basename(part)), index=False)
@@ -0,0 +1,28 @@
+import os
+import sys
+import pytest
+
+# The modules live flat at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def mongo_client():
+    # A server at MONGODB_URI (default localhost); tests that need one are
+    # skipped without it
+    from pymongo import MongoClient
+    from pymongo.errors import PyMongoError
+    client = MongoClient(os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/'), serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command('ping')
+    except PyMongoError as error:
+        pytest.skip('no MongoDB server (%s)' % type(error).__name__)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def mongo_db(mongo_client):
+    db = mongo_client['test_%s' % os.getpid()]
+    yield db
+    mongo_client.drop_database(db.name)
@@ -0,0 +1,470 @@
+import copy
+import datetime
+import functools
+import re
+
+# A small in-memory evaluator for the aggregation stages and expressions the
+# lab pipelines use, enough to run a pipeline and its optimized form over the
+# same fixture documents. Field values follow the server's comparison order
+MISSING = object()
+
+TYPE_ORDER = [
+    (type(None), 0, 'null'),
+    (bool, 5, 'bool'),
+    ((int, float), 1, 'double'),
+    (str, 2, 'string'),
+    (dict, 3, 'object'),
+    (list, 4, 'array'),
+    (datetime.datetime, 6, 'date')
+]
+
+
+def type_of(value):
+    if value is MISSING:
+        return 0, 'missing'
+    for types, order, name in TYPE_ORDER:
+        if isinstance(value, types):
+            return order, name
+    return 7, 'objectId'
+
+
+def compare(a, b):
+    (ta, _), (tb, _) = type_of(a), type_of(b)
+    if ta != tb:
+        return (ta > tb) - (ta < tb)
+    if ta == 0:
+        return 0
+    if ta == 3:
+        a, b = str(sorted(a.items())), str(sorted(b.items()))
+    if ta == 4:
+        for x, y in zip(a, b):
+            c = compare(x, y)
+            if c:
+                return c
+        return (len(a) > len(b)) - (len(a) < len(b))
+    return (a > b) - (a < b)
+
+
+def sort_key(path):
+    parts = path.split('.')
+    return functools.cmp_to_key(lambda x, y: compare(get_path(x, parts), get_path(y, parts)))
+
+
+def get_path(value, parts):
+    for i, part in enumerate(parts):
+        if isinstance(value, list):
+            found = [get_path(item, parts[i:]) for item in value]
+            return [item for item in found if item is not MISSING]
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def null(value):
+    return None if value is MISSING else value
+
+
+def truthy(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value != 0
+    return not (value is MISSING or value is None or value is False)
+
+
+def evaluate(expression, doc, variables):
+    if isinstance(expression, str):
+        if expression.startswith('$$'):
+            name, *parts = expression[2:].split('.')
+            if name == 'REMOVE':
+                return MISSING
+            base = doc if name in ('ROOT', 'CURRENT') else variables[name]
+            return get_path(base, parts)
+        if expression.startswith('$'):
+            return get_path(doc, expression[1:].split('.'))
+        return expression
+    if isinstance(expression, list):
+        return [null(evaluate(item, doc, variables)) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) == 1 and next(iter(expression)).startswith('$'):
+        (op, argument), = expression.items()
+        return OPERATORS[op](argument, doc, variables)
+    out = {}
+    for key, value in expression.items():
+        value = evaluate(value, doc, variables)
+        if value is not MISSING:
+            out[key] = value
+    return out
+
+
+def arguments(argument, doc, variables):
+    return [evaluate(item, doc, variables) for item in (argument if isinstance(argument, list) else [argument])]
+
+
+def array_operator(fn):
+    def operator(argument, doc, variables):
+        values = evaluate(argument['input'], doc, variables)
+        if values is MISSING or values is None:
+            return None
+        return fn(values, argument, doc, variables)
+    return operator
+
+
+@array_operator
+def op_map(values, argument, doc, variables):
+    name = argument.get('as', 'this')
+    return [null(evaluate(argument['in'], doc, dict(variables, **{name: value}))) for value in values]
+
+
+@array_operator
+def op_filter(values, argument, doc, variables):
+    name = argument.get('as', 'this')
+    return [value for value in values if truthy(evaluate(argument['cond'], doc, dict(variables, **{name: value})))]
+
+
+@array_operator
+def op_reduce(values, argument, doc, variables):
+    accumulated = evaluate(argument['initialValue'], doc, variables)
+    for value in values:
+        accumulated = evaluate(argument['in'], doc, dict(variables, this=value, value=accumulated))
+    return accumulated
+
+
+@array_operator
+def op_sort_array(values, argument, doc, variables):
+    (path, direction), = argument['sortBy'].items()
+    return sorted(values, key=sort_key(path), reverse=direction < 0)
+
+
+def op_let(argument, doc, variables):
+    inner = dict(variables, **{name: evaluate(value, doc, variables) for name, value in argument['vars'].items()})
+    return evaluate(argument['in'], doc, inner)
+
+
+def op_cond(argument, doc, variables):
+    if isinstance(argument, list):
+        condition, then, otherwise = argument
+    else:
+        condition, then, otherwise = argument['if'], argument['then'], argument['else']
+    return evaluate(then if truthy(evaluate(condition, doc, variables)) else otherwise, doc, variables)
+
+
+def op_switch(argument, doc, variables):
+    for branch in argument['branches']:
+        if truthy(evaluate(branch['case'], doc, variables)):
+            return evaluate(branch['then'], doc, variables)
+    return evaluate(argument['default'], doc, variables)
+
+
+def op_and(argument, doc, variables):
+    return all(truthy(evaluate(item, doc, variables)) for item in argument)
+
+
+def comparison(test):
+    def operator(argument, doc, variables):
+        a, b = arguments(argument, doc, variables)
+        return test(compare(null(a), null(b)))
+    return operator
+
+
+def op_in(argument, doc, variables):
+    value, values = arguments(argument, doc, variables)
+    return any(compare(null(value), item) == 0 for item in values)
+
+
+def op_array_elem_at(argument, doc, variables):
+    values, index = arguments(argument, doc, variables)
+    if values is MISSING or values is None:
+        return None
+    if index < 0:
+        index += len(values)
+    return values[index] if 0 <= index < len(values) else MISSING
+
+
+def op_merge_objects(argument, doc, variables):
+    out = {}
+    for value in arguments(argument, doc, variables):
+        if isinstance(value, dict):
+            out.update(value)
+    return out
+
+
+def op_concat_arrays(argument, doc, variables):
+    out = []
+    for value in arguments(argument, doc, variables):
+        if value is None or value is MISSING:
+            return None
+        out.extend(value)
+    return out
+
+
+def op_date_diff(argument, doc, variables):
+    start, end = evaluate(argument['startDate'], doc, variables), evaluate(argument['endDate'], doc, variables)
+    if not isinstance(start, datetime.datetime) or not isinstance(end, datetime.datetime):
+        return None
+    return (end.date() - start.date()).days
+
+
+def op_date_subtract(argument, doc, variables):
+    start = evaluate(argument['startDate'], doc, variables)
+    if not isinstance(start, datetime.datetime):
+        return None
+    amount = evaluate(argument['amount'], doc, variables)
+    if argument['unit'] == 'day':
+        return start - datetime.timedelta(days=amount)
+    try:
+        return start.replace(year=start.year - amount)
+    except ValueError:
+        return start.replace(year=start.year - amount, day=28)
+
+
+def op_split(argument, doc, variables):
+    value, delimiter = arguments(argument, doc, variables)
+    return value.split(delimiter) if isinstance(value, str) else None
+
+
+def op_get_field(argument, doc, variables):
+    value = evaluate(argument['input'], doc, variables)
+    return value.get(argument['field'], MISSING) if isinstance(value, dict) else MISSING
+
+
+def op_if_null(argument, doc, variables):
+    for value in arguments(argument, doc, variables):
+        if value is not MISSING and value is not None:
+            return value
+    return None
+
+
+def op_object_to_array(argument, doc, variables):
+    value = evaluate(argument, doc, variables)
+    return [{'k': key, 'v': item} for key, item in value.items()] if isinstance(value, dict) else None
+
+
+def op_regex_match(argument, doc, variables):
+    value = evaluate(argument['input'], doc, variables)
+    return isinstance(value, str) and re.search(argument['regex'], value) is not None
+
+
+def to_string(value):
+    if value is MISSING or value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (value.microsecond // 1000)
+    return str(value)
+
+
+def op_convert(argument, doc, variables):
+    # Conversion to double only
+    assert argument['to'] == 'double'
+    value = evaluate(argument['input'], doc, variables)
+    if value is MISSING or value is None:
+        return evaluate(argument.get('onNull'), doc, variables)
+    try:
+        if isinstance(value, datetime.datetime):
+            return float(int(value.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000))
+        if isinstance(value, str) and not re.fullmatch(r'\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*', value):
+            raise ValueError(value)
+        return float(value)
+    except (TypeError, ValueError):
+        return evaluate(argument.get('onError'), doc, variables)
+
+
+def arithmetic(fn):
+    def operator(argument, doc, variables):
+        values = arguments(argument, doc, variables)
+        if any(value is None or value is MISSING for value in values):
+            return None
+        return fn(*values)
+    return operator
+
+
+def add(*values):
+    dates = [value for value in values if isinstance(value, datetime.datetime)]
+    total = sum(value for value in values if not isinstance(value, datetime.datetime))
+    return dates[0] + datetime.timedelta(milliseconds=total) if dates else total
+
+
+def subtract(a, b):
+    if isinstance(a, datetime.datetime) and isinstance(b, datetime.datetime):
+        return int((a - b).total_seconds() * 1000)
+    if isinstance(a, datetime.datetime):
+        return a - datetime.timedelta(milliseconds=b)
+    return a - b
+
+
+def multiply(*values):
+    return functools.reduce(lambda a, b: a * b, values, 1)
+
+
+OPERATORS = {
+    '$map': op_map,
+    '$filter': op_filter,
+    '$reduce': op_reduce,
+    '$sortArray': op_sort_array,
+    '$let': op_let,
+    '$cond': op_cond,
+    '$switch': op_switch,
+    '$and': op_and,
+    '$eq': comparison(lambda c: c == 0),
+    '$ne': comparison(lambda c: c != 0),
+    '$lt': comparison(lambda c: c < 0),
+    '$lte': comparison(lambda c: c <= 0),
+    '$gt': comparison(lambda c: c > 0),
+    '$gte': comparison(lambda c: c >= 0),
+    '$in': op_in,
+    '$arrayElemAt': op_array_elem_at,
+    '$mergeObjects': op_merge_objects,
+    '$concatArrays': op_concat_arrays,
+    '$dateDiff': op_date_diff,
+    '$dateSubtract': op_date_subtract,
+    '$type': lambda argument, doc, variables: type_of(evaluate(argument, doc, variables))[1],
+    '$split': op_split,
+    '$ifNull': op_if_null,
+    '$getField': op_get_field,
+    '$objectToArray': op_object_to_array,
+    '$regexMatch': op_regex_match,
+    '$anyElementTrue': lambda argument, doc, variables: any(truthy(value) for value in arguments(argument, doc, variables)[0]),
+    '$size': lambda argument, doc, variables: len(evaluate(argument, doc, variables)),
+    '$range': lambda argument, doc, variables: list(range(*arguments(argument, doc, variables))),
+    '$add': arithmetic(add),
+    '$subtract': arithmetic(subtract),
+    '$multiply': arithmetic(multiply),
+    '$divide': arithmetic(lambda a, b: a / b),
+    '$abs': arithmetic(abs),
+    '$literal': lambda argument, doc, variables: argument,
+    '$toString': lambda argument, doc, variables: to_string(arguments(argument, doc, variables)[0]),
+    '$convert': op_convert
+}
+
+
+def is_flag(value):
+    return isinstance(value, (bool, int, float))
+
+
+def project(spec, doc, root, top=True):
+    out = {}
+    if top and '_id' in doc and is_flag(spec.get('_id', 1)) and spec.get('_id', 1):
+        out['_id'] = doc['_id']
+    for key, value in spec.items():
+        if key == '_id' and is_flag(value):
+            continue
+        if is_flag(value):
+            if value and isinstance(doc, dict) and key in doc:
+                out[key] = doc[key]
+        elif isinstance(value, dict) and not next(iter(value)).startswith('$'):
+            inner = doc.get(key, MISSING) if isinstance(doc, dict) else MISSING
+            if isinstance(inner, list):
+                out[key] = [project(value, item if isinstance(item, dict) else {}, root, False) for item in inner]
+            else:
+                out[key] = project(value, inner if isinstance(inner, dict) else {}, root, False)
+        else:
+            value = evaluate(value, root, {})
+            if value is not MISSING:
+                out[key] = value
+    return out
+
+
+QUERY_COMPARISONS = {
+    '$lt': lambda c: c < 0,
+    '$lte': lambda c: c <= 0,
+    '$gt': lambda c: c > 0,
+    '$gte': lambda c: c >= 0
+}
+
+
+def match_field(condition, value):
+    values = value if isinstance(value, list) else [value]
+    if not (isinstance(condition, dict) and condition and next(iter(condition)).startswith('$')):
+        return any(compare(null(item), condition) == 0 for item in values)
+    for op, argument in condition.items():
+        if op == '$in':
+            ok = any(compare(null(item), each) == 0 for item in values for each in argument)
+        elif op == '$size':
+            ok = isinstance(value, list) and len(value) == argument
+        elif op == '$exists':
+            ok = (value is not MISSING) == argument
+        elif op in QUERY_COMPARISONS:
+            test = QUERY_COMPARISONS[op]
+            ok = any(type_of(item)[0] == type_of(argument)[0] and test(compare(item, argument)) for item in values)
+        else:
+            raise NotImplementedError(op)
+        if not ok:
+            return False
+    return True
+
+
+def match(query, doc):
+    for key, condition in query.items():
+        if key == '$and':
+            ok = all(match(each, doc) for each in condition)
+        elif key == '$or':
+            ok = any(match(each, doc) for each in condition)
+        elif key == '$expr':
+            ok = truthy(evaluate(condition, doc, {}))
+        else:
+            ok = match_field(condition, get_path(doc, key.split('.')))
+        if not ok:
+            return False
+    return True
+
+
+def set_fields(spec, doc):
+    out = copy.deepcopy(doc)
+    for key, expression in spec.items():
+        *parents, last = key.split('.')
+        value = evaluate(expression, doc, {})
+        target = out
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        if value is MISSING:
+            target.pop(last, None)
+        else:
+            target[last] = value
+    return out
+
+
+def unwind(spec, docs):
+    field = (spec if isinstance(spec, str) else spec['path'])[1:]
+    return [dict(doc, **{field: item}) for doc in docs for item in doc.get(field) or []]
+
+
+def lookup(spec, docs, collections):
+    # Equality lookups, with an optional pipeline on the matched documents
+    foreign = collections[spec['from']]
+    out = []
+    for doc in docs:
+        value = null(get_path(doc, spec['localField'].split('.')))
+        found = [other for other in foreign if compare(null(get_path(other, spec['foreignField'].split('.'))), value) == 0]
+        out.append(dict(doc, **{spec['as']: run(spec.get('pipeline', []), found, collections)}))
+    return out
+
+
+def run(pipeline, docs, collections=None):
+    # collections maps the names $lookup reads to their documents
+    docs = copy.deepcopy(docs)
+    for stage in pipeline:
+        (op, spec), = stage.items()
+        if op == '$limit':
+            docs = docs[:spec]
+        elif op == '$match':
+            docs = [doc for doc in docs if match(spec, doc)]
+        elif op == '$project':
+            docs = [project(spec, doc, doc) for doc in docs]
+        elif op in ('$set', '$addFields'):
+            docs = [set_fields(spec, doc) for doc in docs]
+        elif op == '$sort':
+            (path, direction), = spec.items()
+            docs = sorted(docs, key=sort_key(path), reverse=direction < 0)
+        elif op == '$unwind':
+            docs = unwind(spec, docs)
+        elif op == '$lookup':
+            docs = lookup(spec, docs, collections or {})
+        elif op == '$replaceWith':
+            docs = [evaluate(spec, doc, {}) for doc in docs]
+        else:
+            raise NotImplementedError(op)
+    return docs
@@ -0,0 +1,36 @@
+import datetime
+import pyarrow as pa
+import pytest
+from bson import ObjectId, encode
+from bson_arrow import FACET_SCHEMAS, FACET_STAGES, arrow_pipeline, decode_batch
+
+
+@pytest.mark.parametrize('facet', sorted(FACET_SCHEMAS))
+def test_top_level_strings_are_converted_on_the_server(facet):
+    # Every top-level string column reaches the decoder as a string, so a
+    # numeric PatientID is not nulled
+    converted = FACET_STAGES[facet][0]['$set']
+    for field, kind in FACET_SCHEMAS[facet].items():
+        if pa.types.is_string(kind):
+            assert converted[field] == {'$toString': '$' + field}
+    assert arrow_pipeline([], facet)[-1] == {'$project': {field: 1 for field in FACET_SCHEMAS[facet]}}
+
+
+def test_decode_batch():
+    pytest.importorskip('pymongoarrow')
+    date = datetime.datetime(2020, 1, 2)
+    docs = [{
+        '_id': str(ObjectId()),
+        'PatientID': '123',
+        'Practice': '7',
+        'diagnosis': [{'icd_10': 'K70.1', 'date': date}, {'icd_10': None}]
+    }, {
+        '_id': str(ObjectId()),
+        'PatientID': 123,
+        'Practice': None
+    }]
+    df = decode_batch(b''.join(encode(doc) for doc in docs), 'diagnosis')
+    assert df['PatientID'].tolist()[0] == '123'
+    # What the $toString stage prevents
+    assert df['PatientID'].isna().tolist()[1]
+    assert df['diagnosis'].tolist()[0] == [{'icd_10': 'K70.1'}, {'icd_10': None}]
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from cadence import GapHistogram, bucket_matches, gap_pipeline
+
+
+def rows(entries):
+    return [{'_id': {'analyte': a, 'practice': p, 'days': d}, 'count': c} for a, p, d, c in entries]
+
+
+def test_update_bins_and_overflow():
+    histogram = GapHistogram(bin_days=7, max_days=70).update(rows([
+        ('alt', 'a', 0, 2), ('alt', 'a', 6, 1), ('alt', 'a', 7, 3), ('alt', 'a', 69, 1), ('alt', 'a', 70, 1), ('alt', 'a', 900, 4),
+        ('alt', None, 14, 5), ('ast', 'a', 90, 1)
+    ]))
+    assert histogram.bins == 11
+    counts = histogram.counts['alt', 'a']
+    assert counts[0] == 3 and counts[1] == 3 and counts[9] == 1 and counts[10] == 5 and counts.sum() == 12
+    assert histogram.counts['alt', None][2] == 5
+    assert histogram.total('alt').sum() == 17 and histogram.total('alt', 'a').sum() == 12
+    assert histogram.share('alt', 0, 14) == pytest.approx(6 / 17)
+    assert histogram.quantiles('ast', [0.5]) == [70]
+    assert np.isnan(histogram.quantiles('missing', [0.5])[0])
+
+
+def test_merge_equals_one_pass(tmp_path):
+    entries = [('alt', 'a', d, 1) for d in (80, 85, 90, 95, 100, 101)] + [('albumin', 'b', d, 2) for d in (1, 80, 400, 800)]
+    whole = GapHistogram().update(rows(entries))
+    parts = GapHistogram().update(rows(entries[:5])).merge(GapHistogram().update(rows(entries[5:])))
+    assert whole.to_frame().equals(parts.to_frame())
+    assert whole.share('alt', 80, 101) == pytest.approx(5 / 6)
+    whole.save(str(tmp_path / 'gaps.json'))
+    assert GapHistogram.load(str(tmp_path / 'gaps.json')).to_frame().equals(whole.to_frame())
+    with pytest.raises(ValueError):
+        whole.merge(GapHistogram(bin_days=7))
+
+
+def test_bucket_matches_cover_the_sample():
+    lab = SimpleNamespace(sample_buckets=10000)
+    assert bucket_matches(lab, 1) == [None]
+    for fraction, limit in ((None, 10000), (0.25, 2500)):
+        matches = bucket_matches(lab, 4, fraction)
+        bounds = [(m['$match']['sample_bucket']['$gte'], m['$match']['sample_bucket']['$lt']) for m in matches]
+        assert bounds[0][0] == 0 and bounds[-1][1] == limit
+        assert all(high == low for (_, high), (low, _) in zip(bounds, bounds[1:]))
+
+
+def test_gap_pipeline_matches_the_tests():
+    tests = {'ALT': 'alt', 'AST test': 'ast', 'AST': 'ast'}
+    match = {'$match': {'sample_bucket': {'$gte': 0, '$lt': 10}}}
+    pipeline = gap_pipeline(tests, match)
+    assert pipeline[0] == match
+    assert pipeline[1] == {'$match': {'lab_results.api_test_name': {'$in': list(tests)}}}
+    branches = pipeline[2]['$project']['labs']['$sortArray']['input']['$map']['in']['analyte']['$switch']['branches']
+    assert [(b['then'], sorted(b['case']['$in'][1])) for b in branches] == [('alt', ['ALT']), ('ast', ['AST', 'AST test'])]
+    assert '$group' in pipeline[-1]
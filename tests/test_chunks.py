@@ -0,0 +1,118 @@
+import os
+import pandas as pd
+import pytest
+from bson import ObjectId
+from pymongo.errors import AutoReconnect, OperationFailure
+from Preprecessed_UPDATED import ALTLab
+from streaming_stats import part_paths
+from mongo_eval import run
+
+PIPELINE = [{'$limit': 400000}, {'$project': {'PatientID': 1}}]
+
+
+class Lab(ALTLab):
+    # Serves the documents in memory; failures maps the number of a chunk
+    # aggregation to the error it raises after yielding `after` documents
+    chunk_size = 3
+    batch_size = 2
+    retry_backoff = (0, 0)
+    use_snapshots = False
+
+    def __init__(self, output_dir, docs, failures=None, after=0):
+        super().__init__()
+        self.output_dir = output_dir
+        self.docs = docs
+        self.failures = dict(failures or {})
+        self.after = after
+        self.pipelines = []
+
+    def aggregate(self, pipeline, raw=False, collection=None):
+        self.pipelines.append(pipeline)
+        results = run(pipeline, self.docs)
+        if '$sort' in pipeline[0]:
+            return iter(results)
+        return self.chunk(results, self.failures.pop(len(self.chunks()), None))
+
+    def chunk(self, results, error):
+        for i, doc in enumerate(results):
+            if error is not None and i == self.after:
+                raise error
+            yield doc
+        if error is not None:
+            raise error
+
+    def chunks(self):
+        return [pipeline for pipeline in self.pipelines if '$sort' not in pipeline[0]]
+
+    def rows(self):
+        parts = part_paths(self.facet_dir('rows'))
+        return pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True)['PatientID'].tolist()
+
+
+def patients(n):
+    return [{'_id': ObjectId(), 'PatientID': 'p%d' % i} for i in range(n)]
+
+
+def test_limit_becomes_an_id_bound(tmp_path):
+    docs = patients(10)
+    lab = Lab(str(tmp_path), docs)
+    lab.run_chunks([{'$limit': 7}] + PIPELINE[1:], 'rows')
+    assert lab.rows() == ['p%d' % i for i in range(7)]
+    # Three chunks over the first seven _ids, the last one closed
+    assert [pipeline[0]['$match']['_id'] for pipeline in lab.chunks()] == [
+        {'$gte': docs[0]['_id'], '$lt': docs[3]['_id']},
+        {'$gte': docs[3]['_id'], '$lt': docs[6]['_id']},
+        {'$gte': docs[6]['_id'], '$lte': docs[6]['_id']}
+    ]
+    assert all(pipeline[1:] == PIPELINE[1:] for pipeline in lab.chunks())
+    assert not os.path.exists(lab.checkpoint_path('rows'))
+
+
+def test_runs_resume_from_the_checkpoint(tmp_path):
+    docs = patients(10)
+    failing = Lab(str(tmp_path), docs, {3: OperationFailure('bad', code=2)})
+    with pytest.raises(OperationFailure):
+        failing.run_chunks(PIPELINE, 'rows')
+    assert failing.rows() == ['p%d' % i for i in range(6)]
+    resumed = Lab(str(tmp_path), docs + patients(2))
+    resumed.run_chunks(PIPELINE, 'rows')
+    # The _id ranges are those of the first run, and done chunks are not rerun
+    assert not [pipeline for pipeline in resumed.pipelines if '$sort' in pipeline[0]]
+    assert len(resumed.chunks()) == 2
+    assert resumed.rows() == ['p%d' % i for i in range(10)]
+    assert not os.path.exists(resumed.checkpoint_path('rows'))
+
+
+@pytest.mark.parametrize('change', [
+    {'batch_size': 1},
+    {'chunk_size': 4},
+    {'batch_stages': {'rows': [lambda df: df]}}
+])
+def test_checkpoints_of_other_settings_start_over(tmp_path, change):
+    docs = patients(10)
+    with pytest.raises(OperationFailure):
+        Lab(str(tmp_path), docs, {3: OperationFailure('bad', code=2)}).run_chunks(PIPELINE, 'rows')
+    lab = Lab(str(tmp_path), docs)
+    for name, value in change.items():
+        setattr(lab, name, value)
+    lab.run_chunks(PIPELINE, 'rows')
+    assert '$sort' in lab.pipelines[0][0] and lab.rows() == ['p%d' % i for i in range(10)]
+
+
+def test_checkpoint_key_follows_the_decoder(tmp_path):
+    lab = Lab(str(tmp_path), [])
+    key = lab.checkpoint_key(PIPELINE[1:], 'labs', 7)
+    assert lab.checkpoint_key(PIPELINE[1:], 'labs', 8) != key
+    lab.decoder = 'arrow'
+    assert lab.checkpoint_key(PIPELINE[1:], 'labs', 7) != key
+    # Facets without an arrow schema decode in Python whatever the setting
+    assert lab.checkpoint_key(PIPELINE[1:], 'rows', 7) == Lab(str(tmp_path), []).checkpoint_key(PIPELINE[1:], 'rows', 7)
+
+
+def test_retries_remove_the_parts_of_the_failed_attempt(tmp_path):
+    lab = Lab(str(tmp_path), patients(10), {1: AutoReconnect('stepdown')}, after=2)
+    lab.batch_size = 1
+    lab.run_chunks(PIPELINE, 'rows')
+    assert len(lab.chunks()) == 5
+    assert lab.rows() == ['p%d' % i for i in range(10)]
+    assert len(part_paths(lab.facet_dir('rows'))) == 10
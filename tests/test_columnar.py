@@ -0,0 +1,125 @@
+import datetime
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from bson import encode
+from bson_arrow import FACET_SCHEMAS
+from columnar import RUNS, TABLES, ColumnarStore, export_schema, export_tables, split_documents
+from equivalence import FACETS, compare_outputs
+from optimizer import canonical
+from Preprecessed_UPDATED import ALTLab, AlbuminLab, PreprocessedLabs
+from test_optimizer import patients
+from mongo_eval import run
+
+
+def documents():
+    schema = pa.schema(list(export_schema(['gender']).items()))
+    return pa.Table.from_pylist([
+        {
+            '_id': 'x1',
+            'PatientID': 'a',
+            'Practice': 'p',
+            'sample_bucket': 1,
+            'demographics': {'gender': 'F'},
+            'lab_results': [{'api_test_name': 'ALT', 'date': datetime.datetime(2020, 1, 1), 'result': '30'}],
+            'vitals': [],
+            'medications': None,
+            'diagnosis': []
+        }
+    ], schema=schema)
+
+
+def test_split_documents_keeps_array_lengths():
+    tables = split_documents(documents(), 10)
+    assert sorted(tables) == sorted(TABLES)
+    patients = tables['patients'].to_pylist()[0]
+    assert patients['row'] == 10 and patients['gender'] == 'F'
+    assert (patients['lab_results_count'], patients['vitals_count'], patients['medications_count']) == (1, 0, None)
+    assert tables['labs'].column('row').to_pylist() == [10]
+
+
+def test_store_loads_paths_with_quotes(tmp_path):
+    pytest.importorskip('duckdb')
+    path = str(tmp_path / "o'neil")
+    for table, data in split_documents(documents(), 0).items():
+        os.makedirs(os.path.join(path, table))
+        pq.write_table(data, os.path.join(path, table, 'part-00000.parquet'))
+    store = ColumnarStore(path, threads=1)
+    assert store.connection.execute('SELECT PatientID FROM patients').fetchall() == [('a',)]
+    assert store.connection.execute('SELECT count(*) FROM labs').fetchone()[0] == 1
+
+
+class Served:
+    # A lab reading the given documents through mongo_eval, raw batches
+    # included, as the Mongo path of columnar.benchmark does
+    use_snapshots = False
+    decoder = 'arrow'
+    arrow_facets = list(FACET_SCHEMAS)
+
+    def aggregate(self, pipeline, raw=False, collection=None):
+        docs = run(pipeline, self.docs)
+        if raw:
+            return iter([b''.join(encode(doc) for doc in docs)] if docs else [])
+        return iter(docs)
+
+
+def served(cls, docs, output_dir, **options):
+    lab = type(cls.__name__, (Served, cls), {})(**options)
+    lab.docs = docs
+    lab.output_dir = output_dir
+    lab.batch_size = 37
+    return lab
+
+
+def store_documents(seed):
+    # The optimizer fixture, with demographics in the array of the collection
+    docs = patients(240, seed)
+    for i, doc in enumerate(docs):
+        if i % 7:
+            doc['demographics'] = [{'gender': doc['demographics']['gender'], 'date_of_birth': datetime.datetime(1950 + i % 40, 1, 1)}]
+        else:
+            del doc['demographics']
+    return docs
+
+
+@pytest.mark.parametrize('cls, first_stage, trend_features', [
+    (ALTLab, 'limit', False),
+    (AlbuminLab, 'limit', True),
+    (AlbuminLab, 'sample', False),
+    (ALTLab, 'stratified', True)
+])
+def test_store_facets_match_the_pipelines(tmp_path, monkeypatch, cls, first_stage, trend_features):
+    pytest.importorskip('duckdb')
+    pytest.importorskip('pymongoarrow')
+    docs = store_documents(1)
+    # Grouped counts for the stratified thresholds of PreprocessedLabs
+    counts = Counter((doc.get('Practice'), doc['sample_bucket']) for doc in docs)
+    monkeypatch.setattr(PreprocessedLabs, 'collection', SimpleNamespace(name='patients', aggregate=lambda pipeline, **options: iter([{'_id': {'practice': practice, 'bucket': bucket}, 'count': count} for (practice, bucket), count in counts.items()])))
+    options = {
+        'limit': {},
+        'sample': {'sample_fraction': 0.4},
+        'stratified': {'sample_fraction': 0.4, 'stratify_by_practice': True}
+    }[first_stage]
+    mongo = served(cls, docs, str(tmp_path / 'mongo'), trend_features=trend_features, **options)
+    if first_stage == 'limit':
+        mongo.base_pipeline[0] = {'$limit': 150}
+    export_tables(mongo, str(tmp_path / 'export'))
+    store = ColumnarStore(str(tmp_path / 'export'), threads=2)
+    stage = store.sample_stage(mongo, **options) if options else mongo.base_pipeline[0]
+    if options:
+        # The same thresholds, in whatever order the practices came
+        expected = mongo.base_pipeline[0]
+        assert sorted(map(canonical, stage['$match'].get('$or', [stage]))) == sorted(map(canonical, expected['$match'].get('$or', [expected])))
+    columnar = served(cls, docs, str(tmp_path / 'columnar'), trend_features=trend_features, **options)
+    pairs = store.select_pairs(columnar, stage)
+    assert pairs == len(run(mongo.base_pipeline, docs)) > 0
+    with ThreadPoolExecutor(2) as pool:
+        for facet in FACETS:
+            getattr(mongo, RUNS[facet])()
+            store.run_facet(columnar, facet, pool, 2)
+            differences, summary = compare_outputs(mongo.facet_dir(facet), columnar.facet_dir(facet), work_dir=str(tmp_path))
+            assert summary['equal'], (facet, differences.head().to_dict('records'))
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from comeasure import join_draws
+
+ALT, AST, ALBUMIN = 'alanine_aminotransferase', 'aspartate_aminotransferase', 'albumin'
+
+
+def lab(analyte, date, result, unit='U/L'):
+    return {'analyte': analyte, 'date': pd.Timestamp(date), 'result': result, 'unit': unit}
+
+
+def pairs(rows):
+    # Normalized pairs anchored on ALT, as join_draws receives them
+    df = pd.DataFrame([{
+        'lab_before.api_test_name': ALT,
+        'lab_before.date': pd.Timestamp(before) if before else pd.NaT,
+        'lab_before.value': 30.0,
+        'lab_before.censored': 0.0,
+        'lab_after.api_test_name': ALT,
+        'lab_after.date': pd.Timestamp('2020-06-01 08:00'),
+        'lab_after.value': 40.0,
+        'lab_after.censored': 0.0,
+        'co_before': co,
+        'co_after': []
+    } for before, co in rows])
+    return join_draws(df)
+
+
+def test_nearest_lab_of_each_analyte():
+    out = pairs([('2020-03-01 08:00', [
+        lab(AST, '2020-03-01 01:00', '50'),
+        lab(AST, '2020-03-01 10:00', '60'),
+        lab(AST, '2020-03-01 20:00', '70'),
+        lab(ALBUMIN, '2020-03-02 07:00', '4.1', 'g/dL')
+    ])])
+    assert out['lab_before.aspartate_aminotransferase.value'].tolist() == [60]
+    assert out['lab_before.albumin.value'].tolist() == [4.1]
+    # The anchor analyte keeps the pair's own value
+    assert out['lab_before.alanine_aminotransferase.value'].tolist() == [30]
+    assert out['lab_before.ast_alt_ratio'].tolist() == [2]
+    assert 'co_before' not in out and 'co_after' not in out
+
+
+def test_ties_go_to_the_earlier_lab():
+    out = pairs([('2020-03-01 08:00', [
+        lab(AST, '2020-03-01 05:00', '50'),
+        lab(AST, '2020-03-01 11:00', '70')
+    ])])
+    assert out['lab_before.aspartate_aminotransferase.value'].tolist() == [50]
+
+
+def test_unparseable_and_missing_labs():
+    out = pairs([
+        ('2020-03-01 08:00', [lab(AST, '2020-03-01 08:00', 'pending'), lab(AST, '2020-03-01 12:00', '55')]),
+        ('2020-03-01 08:00', []),
+        ('2020-03-01 08:00', None),
+        (None, [lab(AST, '2020-03-01 08:00', '40')])
+    ])
+    values = out['lab_before.aspartate_aminotransferase.value'].tolist()
+    assert values[0] == 55
+    assert np.isnan(values[1]) and np.isnan(values[2])
+    # A pair without an anchor date has no nearest lab
+    assert np.isnan(values[3])
+    assert np.isnan(out['lab_after.aspartate_aminotransferase.value']).all()
+    assert out['lab_after.alanine_aminotransferase.value'].tolist() == [40] * 4
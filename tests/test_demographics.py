@@ -0,0 +1,174 @@
+import os
+import datetime
+import pandas as pd
+import pytest
+from Preprecessed_UPDATED import ALTLab
+from scoring import extract_frame
+from demographics import DemographicsCache, DemographicsIndex
+from streaming_stats import part_paths
+from mongo_eval import run
+
+FIELDS = ['date_of_birth', 'gender']
+
+
+def source(patient_ids):
+    return pd.DataFrame({'PatientID': list(patient_ids), 'date_of_birth': pd.Timestamp('1970-01-01'), 'gender': 'F'})
+
+
+class Fetch:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, patient_ids):
+        self.calls.append(sorted(patient_ids))
+        return source(patient_ids)
+
+
+def parts(cache):
+    return sorted(part for bucket in range(cache.buckets) for part in part_paths(cache.bucket_dir(bucket)))
+
+
+def test_only_missing_patients_are_fetched(tmp_path):
+    cache, fetch = DemographicsCache(str(tmp_path), FIELDS, buckets=4), Fetch()
+    assert sorted(cache.get(['a', 'b'], fetch)['PatientID']) == ['a', 'b']
+    first = {part: os.stat(part).st_mtime_ns for part in parts(cache)}
+    found = cache.get(['b', 'c', 'c'], fetch)
+    assert sorted(found['PatientID']) == ['b', 'c'] and list(found.columns) == cache.columns
+    assert fetch.calls == [['a', 'b'], ['c']]
+    # Earlier parts are left as they are; new rows are a part of their own
+    assert all(os.stat(part).st_mtime_ns == mtime for part, mtime in first.items())
+    assert len(parts(cache)) == len(first) + 1
+    assert cache.get(['a', 'b', 'c'], fetch).shape == (3, 3) and len(fetch.calls) == 2
+
+
+def test_lookups_read_only_their_buckets(tmp_path):
+    cache = DemographicsCache(str(tmp_path), FIELDS, buckets=8)
+    ids = ['p%d' % i for i in range(200)]
+    cache.add(source(ids))
+    bucket = cache.bucket(['p0'])[0]
+    for other in range(cache.buckets):
+        if other != bucket:
+            for part in part_paths(cache.bucket_dir(other)):
+                os.remove(part)
+    assert cache.get(['p0'])['PatientID'].tolist() == ['p0']
+    assert set(cache.bucket(ids)) == set(range(8))
+
+
+def test_concurrent_additions_are_read_once(tmp_path):
+    # Two labs fetching the same patient both keep their part
+    left, right = DemographicsCache(str(tmp_path), FIELDS, buckets=1), DemographicsCache(str(tmp_path), FIELDS, buckets=1)
+    left.add(source(['a']))
+    right.add(source(['a', 'b']))
+    assert len(parts(left)) == 2
+    assert sorted(left.get(['a', 'b'])['PatientID']) == ['a', 'b']
+    index = right.load()
+    assert sorted(index.index) == ['a', 'b'] and list(index.columns) == FIELDS
+
+
+def test_empty_cache(tmp_path):
+    cache = DemographicsCache(str(tmp_path / 'missing'), FIELDS)
+    assert cache.get(['a']).empty and cache.load().empty
+    assert cache.get([], Fetch()).empty
+
+
+class Lab(ALTLab):
+    documents = [
+        {'PatientID': 'a', 'demographics': [{'date_of_birth': datetime.datetime(1970, 1, 1), 'gender': 'F'}]},
+        {'PatientID': 'b', 'demographics': []},
+        {'PatientID': 'c'}
+    ]
+    def aggregate(self, pipeline, raw=False, collection=None):
+        self.pipelines.append(pipeline)
+        return iter(run(pipeline, self.documents))
+
+
+def test_lab_demographics_are_fetched_in_batches(tmp_path):
+    lab = Lab()
+    lab.pipelines = []
+    lab.output_dir = str(tmp_path)
+    lab.batch_size = 2
+    found = lab.get_demographics(['a', 'b', 'c', 'd']).set_index('PatientID')
+    assert sorted(found.index) == ['a', 'b', 'c'] and len(lab.pipelines) == 2
+    assert found.loc['a', 'gender'] == 'F' and pd.isna(found.loc['b', 'gender'])
+    # Patients without a document are asked for again
+    lab.get_demographics(['a', 'd'])
+    assert lab.pipelines[-1][0]['$match']['PatientID']['$in'] == ['d']
+
+
+def test_demo_pass_reads_each_bucket_once(tmp_path, monkeypatch):
+    lab = Lab()
+    lab.pipelines = []
+    lab.output_dir = str(tmp_path)
+    lab.use_snapshots = False
+    lab.clear_facet('labs')
+    lab.demographics_buckets = 4
+    lab.documents = [{'PatientID': 'p%d' % i, 'demographics': [{'date_of_birth': datetime.datetime(1970, 1, 1), 'gender': 'F'}]} for i in range(40)]
+    # Two parts of pairs with patients spread over both, and an empty part
+    for part, patients in enumerate([range(0, 30), range(20, 40)]):
+        lab.write_part(pd.DataFrame({
+            '_id': ['x%d-%d' % (part, i) for i in patients],
+            'PatientID': ['p%d' % i for i in patients],
+            'Practice': 'a',
+            'lab_before.date': pd.Timestamp('2020-06-01')
+        }), 'labs', part)
+    lab.write_part(pd.DataFrame(), 'labs', 2)
+    reads = []
+    read_bucket = DemographicsCache.read_bucket
+    monkeypatch.setattr(DemographicsCache, 'read_bucket', lambda cache, bucket, patient_ids=None: reads.append(bucket) or read_bucket(cache, bucket, patient_ids))
+    lab.run_aggregator_demo()
+    assert sorted(reads) == sorted(set(reads)) and len(lab.pipelines) == len(reads)
+    demo = pd.concat([pd.read_parquet(part) for part in part_paths(lab.facet_dir('demo'))], ignore_index=True)
+    assert len(demo) == 50 and demo['_id'].is_unique
+    assert (demo['age'] == 50).all() and (demo['gender'] == 'F').all()
+    assert 'lab_before.date' not in demo.columns
+
+
+def test_demo_pass_over_empty_labs(tmp_path):
+    lab = Lab()
+    lab.pipelines = []
+    lab.output_dir = str(tmp_path)
+    lab.use_snapshots = False
+    lab.clear_facet('labs')
+    lab.write_part(pd.DataFrame(), 'labs', 0)
+    lab.run_aggregator_demo()
+    assert [pd.read_parquet(part).empty for part in part_paths(lab.facet_dir('demo'))] == [True]
+    assert lab.pipelines == []
+
+
+def test_index_is_read_once_and_never_written(tmp_path, monkeypatch):
+    cache, fetch = DemographicsCache(str(tmp_path), FIELDS, buckets=4), Fetch()
+    cache.add(source(['a', 'b']))
+    before = parts(cache)
+    assert DemographicsIndex(DemographicsCache(str(tmp_path / 'missing'), FIELDS)).get(['a']).empty
+    index = DemographicsIndex(cache, lambda ids: fetch(ids)[lambda df: df['PatientID'] != 'd'])
+    monkeypatch.setattr(DemographicsCache, 'read_bucket', lambda *args, **kwargs: pytest.fail('read after load'))
+    found = index.get(['b', 'c', 'd'])
+    assert list(found.columns) == cache.columns and found['PatientID'].tolist() == ['b', 'c']
+    assert fetch.calls == [['c', 'd']] and parts(cache) == before
+    # Fetched rows and patients without any are remembered
+    assert index.get(['a', 'c', 'd'])['PatientID'].tolist() == ['a', 'c']
+    assert len(fetch.calls) == 1
+
+
+def test_scoring_looks_demographics_up_in_the_index(tmp_path, monkeypatch):
+    first = datetime.datetime(2020, 1, 1)
+    lab = Lab()
+    lab.pipelines = []
+    lab.output_dir = str(tmp_path)
+    lab.documents = [{
+        '_id': i,
+        'PatientID': 'p%d' % i,
+        'Practice': 'a',
+        'lab_results': [{'api_test_name': 'Alanine aminotransferase (ALT) measurement', 'date': first + datetime.timedelta(days=days), 'result': '30', 'unit': 'U/L', 'range': '5-40'} for days in (0, 90)],
+        'vitals': [],
+        'demographics': [{'date_of_birth': datetime.datetime(1970, 1, 1), 'gender': 'F'}]
+    } for i in range(4)]
+    lab.demographics_cache().add(source(['p0', 'p1']))
+    index = DemographicsIndex(lab.demographics_cache(), lab.fetch_demographics)
+    monkeypatch.setattr(Lab, 'get_demographics', lambda self, ids: pytest.fail('demographics read per batch'))
+    for batch in (['p0', 'p2'], ['p1', 'p2', 'p3']):
+        frame = extract_frame(lab, patient_ids=batch, demographics=index)
+        assert sorted(frame['PatientID']) == batch and (frame['age'] == 50).all()
+    # Only the misses of each batch were fetched
+    fetched = [pipeline[0]['$match']['PatientID']['$in'] for pipeline in lab.pipelines if 'demographics' in str(pipeline[1])]
+    assert fetched == [['p2'], ['p3']]
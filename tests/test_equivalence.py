@@ -0,0 +1,78 @@
+import os
+import pandas as pd
+from equivalence import compare_outputs
+
+
+def write_parts(path, *frames):
+    os.makedirs(path, exist_ok=True)
+    for i, frame in enumerate(frames):
+        frame.to_parquet(os.path.join(path, 'part-%05d.parquet' % i), index=False)
+    return str(path)
+
+
+def test_equal_outputs_split_and_typed_differently(tmp_path):
+    # The same rows in another order and split, with counts stored as int64 on
+    # one side and double on the other, and a column null-typed in one part
+    left = write_parts(tmp_path / 'left', pd.DataFrame({
+        'PatientID': ['a', 'a', 'b', 'c'],
+        'count': [1, 2, 3, 4],
+        'unit': ['U/L', 'U/L', None, 'g/dL'],
+        'date': pd.to_datetime(['2020-01-01', '2020-02-01', '2020-03-01', '2020-04-01'])
+    }))
+    right = write_parts(tmp_path / 'right', pd.DataFrame({
+        'PatientID': ['c', 'a'],
+        'count': [4.0, 2.0],
+        'unit': ['g/dL', 'U/L'],
+        'date': pd.to_datetime(['2020-04-01', '2020-02-01'])
+    }), pd.DataFrame({
+        'PatientID': ['a'],
+        'count': [1.0],
+        'unit': ['U/L'],
+        'date': pd.to_datetime(['2020-01-01'])
+    }), pd.DataFrame({
+        'PatientID': ['b'],
+        'count': [3.0],
+        'unit': [None],
+        'date': pd.to_datetime(['2020-03-01'])
+    }))
+    differences, summary = compare_outputs(left, right, partitions=4, batch_size=2, work_dir=str(tmp_path))
+    assert summary['equal'] and differences.empty
+    assert summary['patients_left'] == summary['patients_right'] == 3
+    assert summary['columns_only_left'] == summary['columns_only_right'] == []
+
+
+def test_unequal_outputs(tmp_path):
+    left = write_parts(tmp_path / 'left', pd.DataFrame({
+        'PatientID': ['a', 'a', 'b', 'c'],
+        'result': ['1', '2', '3', '4'],
+        'unit': ['U/L', 'g/dL', 'U/L', 'U/L'],
+        '_id': ['x1', 'x2', 'x3', 'x4']
+    }))
+    right = write_parts(tmp_path / 'right', pd.DataFrame({
+        'PatientID': ['a', 'a', 'b', 'd'],
+        'result': ['1', '2', '30', '4'],
+        # units swapped between the rows of patient a
+        'unit': ['g/dL', 'U/L', 'U/L', 'U/L'],
+        '_id': ['y1', 'y2', 'y3', 'y4'],
+        'extra': [1, 2, 3, 4]
+    }))
+    differences, summary = compare_outputs(left, right, partitions=3, ignore=['_id', 'extra'], work_dir=str(tmp_path))
+    report = {row.PatientID: (row.status, row.fields) for row in differences.itertuples(index=False)}
+    assert report == {
+        'a': ('changed', ['(rows)']),
+        'b': ('changed', ['result']),
+        'c': ('only_left', ['result', 'unit']),
+        'd': ('only_right', ['result', 'unit'])
+    }
+    assert not summary['equal'] and summary['differing_patients'] == 4
+    assert summary['columns_only_left'] == summary['columns_only_right'] == []
+    _, summary = compare_outputs(left, right, partitions=3, work_dir=str(tmp_path))
+    assert summary['columns_only_right'] == ['extra']
+
+
+def test_row_count_differences(tmp_path):
+    frame = pd.DataFrame({'PatientID': ['a', 'b'], 'result': ['1', '2']})
+    left = write_parts(tmp_path / 'left', frame)
+    right = write_parts(tmp_path / 'right', pd.concat([frame, frame.iloc[:1]]))
+    differences, _ = compare_outputs(left, right, work_dir=str(tmp_path))
+    assert differences.values.tolist() == [['a', 'changed', ['(row count)', 'result']]]
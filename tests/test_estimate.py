@@ -0,0 +1,102 @@
+import datetime
+import pytest
+from bson import ObjectId
+from Preprecessed_UPDATED import ALTLab
+from mongo_eval import match, run
+
+ALT = 'Alanine aminotransferase (ALT) measurement'
+
+
+def patients(n):
+    # Evenly spread sample buckets; every other patient has an ALT pair
+    first = datetime.datetime(2020, 1, 1)
+    docs = []
+    for i in range(n):
+        dates = [first, first + datetime.timedelta(days=90)] if i % 2 == 0 else [first]
+        docs.append({
+            '_id': ObjectId(),
+            'PatientID': 'p%d' % i,
+            'Practice': 'a',
+            'sample_bucket': i * ALTLab.sample_buckets // n,
+            'lab_results': [{'api_test_name': ALT, 'date': date, 'result': '30', 'unit': 'U/L', 'range': '5-40'} for date in dates],
+            'vitals': [],
+            'diagnosis': [{'date': first, 'status': 'Active', 'icd_10': 'K70.1'}],
+            'medications': [],
+            'Active_Meds': []
+        })
+    return docs
+
+
+class Collection:
+    name = 'patients'
+
+    def __init__(self, docs, indexes=('_id', 'sample_bucket')):
+        self.docs = docs
+        self.indexes = {'%s_1' % field: {'key': [(field, 1)]} for field in indexes}
+
+    def aggregate(self, pipeline, **options):
+        assert pipeline == [{'$collStats': {'storageStats': {}}}]
+        sizes = {name: 4096 for name in self.indexes}
+        return iter([{'storageStats': {'count': len(self.docs), 'avgObjSize': 2500, 'indexSizes': sizes, 'totalIndexSize': sum(sizes.values())}}])
+
+    def index_information(self):
+        return self.indexes
+
+    def count_documents(self, query):
+        return sum(match(query, doc) for doc in self.docs)
+
+
+class Lab(ALTLab):
+    def aggregate(self, pipeline, raw=False, collection=None):
+        assert collection is None and not raw
+        if '$count' in pipeline[-1]:
+            count = len(run(pipeline[:-1], self.collection.docs))
+            return iter([{'count': count}] if count else [])
+        return iter(run(pipeline, self.collection.docs))
+
+
+def lab(docs, indexes=('_id', 'sample_bucket'), **options):
+    lab = Lab(**options)
+    lab.collection = Collection(docs, indexes)
+    lab.estimate_sample = len(docs) // 4
+    return lab
+
+
+def test_estimate_scales_the_sample():
+    estimate = lab(patients(400)).estimate()
+    assert (estimate['documents'], estimate['covered_documents'], estimate['sample_documents']) == (400, 400, 100)
+    assert (estimate['matched_documents'], estimate['pairs'], estimate['pair_yield']) == (400, 200, 0.5)
+    assert sorted(estimate['facets']) == sorted(Lab.estimate_facets)
+    assert estimate['facets']['labs']['rows'] == 200
+    assert estimate['facets']['diagnosis']['rows'] == 200
+    assert estimate['facets']['demo']['rows'] == 200
+    assert estimate['index_bytes'] == 8192 and estimate['indexes']['sample_bucket_1'] == {'keys': ['sample_bucket'], 'bytes': 4096}
+    assert estimate['sample_indexed'] and not estimate['analyte_indexed']
+    recommended = estimate['recommended']
+    assert 1000 <= recommended['batch_size'] <= 100000
+    assert recommended['chunk_size'] >= 1000 and recommended['chunks'] == 1
+
+
+def test_estimate_of_a_hashed_sample():
+    # Only the sampled half is covered, but chunks still range over all
+    estimate = lab(patients(400), sample_fraction=0.5).estimate()
+    assert (estimate['covered_documents'], estimate['sample_documents']) == (200, 100)
+    assert (estimate['matched_documents'], estimate['pairs']) == (200, 100)
+    assert estimate['facets']['labs']['rows'] == 100
+
+
+def test_estimate_without_sampled_documents():
+    docs = patients(400)
+    for doc in docs:
+        doc['sample_bucket'] = ALTLab.sample_buckets - 1
+    with pytest.raises(ValueError, match='holds no documents$'):
+        lab(docs).estimate()
+    with pytest.raises(ValueError, match='create_sample_index'):
+        lab(docs, indexes=['_id']).estimate()
+
+
+def test_demo_needs_the_labs_estimate():
+    estimating = lab(patients(400))
+    estimating.estimate_facets = ['diagnosis', 'demo']
+    with pytest.raises(ValueError, match='labs'):
+        estimating.estimate()
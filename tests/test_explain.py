@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from sklearn.ensemble import GradientBoostingRegressor
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import make_pipeline
+from explain import explain, strata, stratified_sample
+
+shap = pytest.importorskip('shap')
+
+
+def matrix(rows=300):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(rows, 4))
+    X[rng.random(X.shape) < 0.05] = np.nan
+    return SimpleNamespace(
+        X=X,
+        y=np.nan_to_num(X[:, 0]) * 2 + rng.normal(scale=0.1, size=rows),
+        practices=np.array(['practice%d' % i for i in rng.integers(6, size=rows)]),
+        patient_ids=np.array(['p%d' % i for i in rng.integers(100, size=rows)]),
+        names=['a', 'b', 'c', 'd'],
+        version='test'
+    )
+
+
+@pytest.mark.parametrize('feature_perturbation', ['interventional', 'tree_path_dependent'])
+def test_parallel_chunks_match_shap(tmp_path, feature_perturbation):
+    m = matrix()
+    model = make_pipeline(SimpleImputer(strategy='median'), GradientBoostingRegressor(n_estimators=20, random_state=0)).fit(m.X, m.y)
+    result = explain(m, model, sample=120, background=40, stratify='practice', feature_perturbation=feature_perturbation, chunk_size=50, max_workers=1, cache_dir=str(tmp_path))
+    codes = strata(m, 'practice')
+    assert np.array_equal(result.rows, stratified_sample(codes, 120, 0))
+    background = model[:-1].transform(m.X[stratified_sample(codes, 40, 1)])
+    explainer = shap.TreeExplainer(model[-1], data=background if feature_perturbation == 'interventional' else None, feature_perturbation=feature_perturbation)
+    expected = np.asarray(explainer.shap_values(model[:-1].transform(m.X[result.rows]), check_additivity=False), dtype=np.float32)
+    assert np.array_equal(result.values, expected)
+    assert result.expected_value == float(np.ravel(explainer.expected_value)[0])
+    # Served from the cache the second time
+    again = explain(m, model, sample=120, background=40, stratify='practice', feature_perturbation=feature_perturbation, chunk_size=50, max_workers=1, cache_dir=str(tmp_path))
+    assert np.array_equal(again.values, result.values)
+
+
+@pytest.mark.parametrize('strata_count', [3, 150, 5000])
+def test_stratified_sample_size(strata_count):
+    codes = np.random.default_rng(1).integers(strata_count, size=20000)
+    codes = np.unique(codes, return_inverse=True)[1]
+    rows = stratified_sample(codes, 200, seed=3)
+    assert len(rows) == 200 and len(np.unique(rows)) == 200
+    assert np.array_equal(rows, stratified_sample(codes, 200, seed=3))
+    taken = np.bincount(codes[rows], minlength=codes.max() + 1)
+    counts = np.bincount(codes)
+    assert (taken <= counts).all()
+    if strata_count <= 200:
+        assert (taken >= 1).all()
+        assert np.abs(taken - counts * 200 / len(codes)).max() <= 1.5
+    else:
+        assert taken.max() <= 2
+
+
+def test_stratified_sample_small_strata():
+    codes = np.repeat(np.arange(4), [1000, 5, 3, 1])
+    taken = np.bincount(codes[stratified_sample(codes, 20)])
+    assert taken.sum() == 20 and taken[1:].min() == 1
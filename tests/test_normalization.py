@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from normalization import (
+    FLAG_IMPOSSIBLE, FLAG_UNIT_REPAIRED, FLAG_UNIT_UNKNOWN, FLAG_UNPARSED,
+    compile_lookup, normalize_labs, normalize_values, normalize_vitals, parse_ranges, parse_results
+)
+
+
+def test_compile_lookup_broadcasts_distinct_values():
+    values = compile_lookup(pd.Series(['a', None, 'b', 'a', 'c']), {'a': 1, 'b': 2}, default=0)
+    assert values.tolist() == [1, 0, 2, 1, 0]
+
+
+def test_parse_results():
+    value, censored = parse_results(pd.Series(['12', ' <5', '>= 1,200', '3.5e1', 'x', None, 40]))
+    np.testing.assert_array_equal(value, [12, 5, 1200, 35, np.nan, np.nan, 40])
+    assert censored.tolist() == [0, -1, 1, 0, 0, 0, 0]
+
+
+def test_parse_ranges():
+    low, high = parse_ranges(pd.Series(['5-40', '3.5 to 5', '<40', '>10', 'normal']))
+    np.testing.assert_array_equal(low, [5, 3.5, np.nan, 10, np.nan])
+    np.testing.assert_array_equal(high, [40, 5, 40, np.nan, np.nan])
+
+
+def test_normalize_values():
+    value, censored, factor, flags = normalize_values(
+        ['albumin', 'albumin', 'albumin', 'alanine_aminotransferase', 'alanine_aminotransferase', 'albumin'],
+        pd.Series(['35', '<3.5', '4', '1', 'high', '50']),
+        pd.Series(['g/L', 'G/DL ', '61', 'ukat/L', 'U/L', 'mmol/L'])
+    )
+    np.testing.assert_allclose(value, [3.5, 3.5, 4, 60, np.nan, np.nan])
+    assert censored.tolist() == [0, -1, 0, 0, 0, 0]
+    np.testing.assert_array_equal(factor, [0.1, 1, 1, 60, 1, np.nan])
+    assert flags.tolist() == [0, 0, FLAG_UNIT_REPAIRED, 0, FLAG_UNPARSED, FLAG_UNIT_UNKNOWN]
+    _, _, _, flags = normalize_values(['albumin'], pd.Series(['40']), pd.Series(['g/dL']))
+    assert flags.tolist() == [FLAG_IMPOSSIBLE]
+
+
+def test_normalize_labs_without_unit_or_range_columns():
+    # json_normalize drops fields no document of a batch has
+    df = pd.DataFrame({
+        'lab_after.api_test_name': ['albumin'],
+        'lab_after.result': ['4.1'],
+        'lab_before.api_test_name': ['albumin'],
+        'lab_before.result': ['40'],
+        'lab_before.unit': ['g/L'],
+        'lab_before.range': ['35-50']
+    })
+    out = normalize_labs(df)
+    assert out['lab_after.value'].tolist() == [4.1] and out['lab_after.flags'].tolist() == [FLAG_UNIT_REPAIRED]
+    assert np.isnan(out['lab_after.range_low'].iloc[0])
+    assert out['lab_before.value'].tolist() == [4.0]
+    np.testing.assert_allclose(out[['lab_before.range_low', 'lab_before.range_high']].iloc[0], [3.5, 5.0])
+    assert normalize_labs(pd.DataFrame()).empty
+
+
+def test_normalize_vitals_keeps_the_latest_valid_reading():
+    records = [
+        [
+            {'name': 'Body Weight', 'result': '150', 'unit': 'lbs', 'date': pd.Timestamp('2020-01-01')},
+            {'name': 'weight', 'result': '70', 'unit': 'kg', 'date': pd.Timestamp('2020-02-01')},
+            {'name': 'HT', 'result': '1.75', 'unit': 'm', 'date': pd.Timestamp('2020-01-01')},
+            {'name': 'systolic', 'result': '500', 'date': pd.Timestamp('2020-01-01')},
+            {'name': 'diastolic', 'result': '80', 'unit': 'mmHg', 'date': pd.Timestamp('2020-01-01')}
+        ],
+        [],
+        [{'name': 'pulse', 'result': '60', 'date': pd.Timestamp('2020-01-01')}]
+    ]
+    out = normalize_vitals(pd.DataFrame({'_id': ['a', 'b', 'c'], 'vitals': records}))
+    assert 'vitals' not in out
+    assert out['weight'].tolist()[0] == 70 and out['height'].tolist()[0] == 175
+    assert round(out['bmi'].iloc[0], 2) == round(70 / 1.75 ** 2, 2)
+    assert np.isnan(out['systolic'].iloc[0]) and np.isnan(out['map'].iloc[0])
+    assert out['vitals.invalid'].tolist() == [1, 0, 0]
+    assert out.loc[1:, ['height', 'weight', 'bmi']].isna().all().all()
+
+
+def test_normalize_vitals_from_arrow_columns():
+    # The 'arrow' decoder hands the vitals over as an Arrow list of records
+    kind = pa.list_(pa.struct([('name', pa.string()), ('result', pa.string()), ('unit', pa.string()), ('date', pa.timestamp('ms'))]))
+    vitals = pd.Series(pa.array([[{'name': 'bmi', 'result': '22', 'unit': None, 'date': None}], None], type=kind), dtype=pd.ArrowDtype(kind))
+    out = normalize_vitals(pd.DataFrame({'_id': ['a', 'b'], 'vitals': vitals}))
+    assert out['bmi'].iloc[0] == 22 and np.isnan(out['bmi'].iloc[1])
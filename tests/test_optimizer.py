@@ -0,0 +1,156 @@
+import datetime
+import random
+import pytest
+from bson import ObjectId
+from Preprecessed_UPDATED import ALTLab, AlbuminLab, ASTLab
+from optimizer import canonical, optimize, optimize_pipeline
+from mongo_eval import run
+
+NAMES = [
+    'Alanine aminotransferase (ALT) measurement',
+    'Aspartate aminotransferase (AST) measurement',
+    'Serum albumin measurement',
+    'Serum or plasma albumin measurement (mass/volume)',
+    'Glucose'
+]
+
+
+def day(rng):
+    return datetime.datetime(2015, 1, 1) + datetime.timedelta(days=rng.randrange(3000), hours=rng.randrange(24))
+
+
+def lab_results(rng):
+    labs, date = [], day(rng)
+    for _ in range(rng.randrange(12)):
+        date = date + datetime.timedelta(days=rng.choice([0, 1, 30, 85, 90, 95, 100, 120]))
+        lab = {
+            'api_test_name': rng.choice(NAMES),
+            'date': date if rng.random() > 0.1 else rng.choice([None, '2019-01-01']),
+            'result': rng.choice(['12', '<5', 40, 'x', None]),
+            'unit': rng.choice(['U/L', 'g/dL']),
+            'range': '5-40'
+        }
+        if rng.random() < 0.1:
+            del lab['unit']
+        if rng.random() < 0.05:
+            del lab['date']
+        labs.append(lab)
+    return labs
+
+
+def patients(n, seed=0):
+    # Labs, diagnoses and medications with missing and null fields, dates
+    # stored as strings or nulls, and empty arrays
+    rng = random.Random(seed)
+    docs = []
+    for i in range(n):
+        doc = {
+            '_id': ObjectId(),
+            'PatientID': 'p%d' % i,
+            'Practice': rng.choice(['a', 'b', None]),
+            'sample_bucket': rng.randrange(10000),
+            'lab_results': lab_results(rng),
+            'demographics': {'gender': 'F'},
+            'vitals': [{'date': day(rng), 'name': 'bmi', 'result': '21'} for _ in range(rng.randrange(4))],
+            'diagnosis': [
+                {
+                    '_id': k,
+                    'date': rng.choice([day(rng), None, 'x']),
+                    'status': rng.choice(['Active', 'Inactive']),
+                    'icd_10': rng.choice(['K70.1', 'E11', 'K70.2'])
+                } for k in range(rng.randrange(6))
+            ],
+            'medications': [
+                {
+                    'date': rng.choice([day(rng), None]),
+                    'gpi': '27',
+                    'status': rng.choice(['Active', 'Inactive']),
+                    'action': 'x',
+                    'end_date': None,
+                    'sig_parsed': rng.choice([{'days': rng.randrange(1, 60), 'dose_g': 0.5, 'frequency': 2}, {}, None])
+                } for _ in range(rng.randrange(6))
+            ],
+            'Active_Meds': []
+        }
+        for field in ('diagnosis', 'medications', 'vitals', 'Practice'):
+            if rng.random() < 0.1:
+                del doc[field]
+        if rng.random() < 0.05:
+            doc['lab_results'] = []
+        docs.append(doc)
+    return docs
+
+
+def pipelines(lab):
+    yield 'labs', lab.get_labs_pipeline()
+    yield 'diagnosis', lab.get_diagnosis_pipeline()
+    yield 'vitals', lab.get_vitals_pipeline()
+    yield 'medications', lab.get_medications_pipeline()
+    yield 'sweep', lab.get_sweep_pipeline([[80, 101], [30, 60]])
+    yield 'co_measurements', lab.get_co_measurement_pipeline([ALTLab(), ASTLab(), AlbuminLab()])
+
+
+def rows(pipeline, docs):
+    return sorted(canonical(doc) for doc in run(pipeline, docs))
+
+
+DOCS = patients(300)
+
+
+@pytest.mark.parametrize('cls', [ALTLab, ASTLab, AlbuminLab])
+@pytest.mark.parametrize('trend_features', [False, True])
+@pytest.mark.parametrize('sample_fraction', [None, 0.5])
+def test_optimized_pipelines_return_the_same_documents(cls, trend_features, sample_fraction):
+    lab = cls(sample_fraction=sample_fraction, trend_features=trend_features)
+    matched = 0
+    for facet, pipeline in pipelines(lab):
+        expected = rows(pipeline, DOCS)
+        assert rows(optimize(pipeline), DOCS) == expected, facet
+        matched += len(expected)
+    assert matched
+
+
+def test_optimize_leaves_the_input_pipeline_unchanged():
+    pipeline = ALTLab().get_labs_pipeline()
+    before = canonical(pipeline)
+    optimize(pipeline)
+    assert canonical(pipeline) == before
+
+
+def test_evaluator_tells_pipelines_apart():
+    # The comparison is only meaningful if a changed result is noticed
+    pipeline = ALTLab().get_labs_pipeline()
+    changed = pipeline + [{'$set': {'lab_after.result': None}}]
+    assert rows(changed, DOCS) != rows(pipeline, DOCS)
+
+
+class Counted(ALTLab):
+    def aggregate(self, pipeline, raw=False, collection=None):
+        self.calls += 1
+        return iter(run(pipeline, DOCS))
+
+
+def test_sample_verdicts_are_kept_per_pipeline():
+    lab = Counted()
+    lab.calls = 0
+    pipeline = lab.get_labs_pipeline()
+    assert optimize_pipeline(lab, pipeline, 'labs', sample=50) == optimize(pipeline)
+    assert lab.calls == 4
+    assert optimize_pipeline(lab, pipeline, 'labs', sample=50) == optimize(pipeline)
+    assert lab.calls == 4
+    optimize_pipeline(lab, pipeline, 'labs', sample=60)
+    optimize_pipeline(lab, lab.get_vitals_pipeline(), 'vitals', sample=50)
+    assert lab.calls == 12
+    # Off by default
+    optimize_pipeline(lab, lab.get_diagnosis_pipeline(), 'diagnosis', lab.optimizer_sample)
+    assert lab.calls == 12
+
+
+@pytest.mark.parametrize('trend_features', [False, True])
+def test_optimized_pipelines_on_a_server(mongo_db, trend_features):
+    mongo_db.patients.insert_many(patients(300, seed=1))
+    for cls in (ALTLab, ASTLab, AlbuminLab):
+        lab = cls(sample_fraction=0.5, trend_features=trend_features)
+        for facet, pipeline in pipelines(lab):
+            expected = sorted(canonical(doc) for doc in mongo_db.patients.aggregate(pipeline))
+            assert sorted(canonical(doc) for doc in mongo_db.patients.aggregate(optimize(pipeline))) == expected, facet
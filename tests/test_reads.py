@@ -0,0 +1,90 @@
+import pytest
+from bson import Timestamp
+from pymongo.read_preferences import ReadPreference, Secondary
+import Preprecessed_UPDATED
+from Preprecessed_UPDATED import ALTLab
+
+
+class Collection:
+    # Records the options every read reaches the driver with
+    def __init__(self, name, calls, read_preference=ReadPreference.PRIMARY, client=None):
+        self.name = name
+        self.calls = calls
+        self.read_preference = read_preference
+        self.client = client
+
+    def with_options(self, read_preference=None):
+        return Collection(self.name, self.calls, read_preference, self.client)
+
+    def aggregate(self, pipeline, **options):
+        self.calls.append(('aggregate', self, options))
+        return iter([])
+
+    def aggregate_raw_batches(self, pipeline, **options):
+        self.calls.append(('aggregate_raw_batches', self, options))
+        return iter([])
+
+
+class Database:
+    name = 'emr'
+
+    def __init__(self, calls, client=None):
+        self.calls = calls
+        self.client = client
+
+    def __getitem__(self, name):
+        return Collection(name, self.calls, client=self.client)
+
+
+class Client:
+    def __init__(self, calls, uri, **options):
+        self.uri = uri
+        self.options = options
+        self.calls = calls
+
+    def __getitem__(self, name):
+        assert name == Database.name
+        return Database(self.calls, self)
+
+
+def lab(**settings):
+    lab = ALTLab()
+    lab.calls = []
+    lab.db = Database(lab.calls)
+    lab.collection = lab.db['patients']
+    for name, value in settings.items():
+        setattr(lab, name, value)
+    return lab
+
+
+def test_primary_reads_by_default():
+    read = lab()
+    list(read.aggregate([]))
+    (method, collection, options), = read.calls
+    assert method == 'aggregate' and collection.name == 'patients'
+    assert collection.read_preference == ReadPreference.PRIMARY
+    assert options == {'allowDiskUse': True, 'batchSize': read.batch_size}
+
+
+@pytest.mark.parametrize('raw', [False, True])
+def test_secondary_snapshot_reads(raw):
+    time = Timestamp(1700000000, 3)
+    read = lab(read_preference='secondary', read_tags=[{'nodeType': 'ANALYTICS'}], max_staleness_seconds=120, cluster_time=time)
+    list(read.aggregate([], raw=raw, collection='lab_timelines.alanine_aminotransferase'))
+    (method, collection, options), = read.calls
+    assert method == ('aggregate_raw_batches' if raw else 'aggregate')
+    assert collection.name == 'lab_timelines.alanine_aminotransferase'
+    assert collection.read_preference == Secondary(tag_sets=[{'nodeType': 'ANALYTICS'}], max_staleness=120)
+    assert options['readConcern'] == {'level': 'snapshot', 'atClusterTime': time}
+
+
+def test_hidden_analytics_member(monkeypatch):
+    read = lab(analytics_uri='mongodb://analytics:27017', read_preference='secondaryPreferred')
+    monkeypatch.setattr(Preprecessed_UPDATED, 'MongoClient', lambda uri, **options: Client(read.calls, uri, **options))
+    list(read.aggregate([]))
+    list(read.aggregate([]))
+    (_, first, _), (_, second, _) = read.calls
+    # One direct connection, reused
+    assert first.client is second.client
+    assert (first.client.uri, first.client.options) == ('mongodb://analytics:27017', {'directConnection': True})
+    assert first.name == 'patients' and first.read_preference.mode == ReadPreference.SECONDARY_PREFERRED.mode
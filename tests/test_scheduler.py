@@ -0,0 +1,131 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import scheduler
+from Preprecessed_UPDATED import PreprocessedLabs
+
+
+def options(monkeypatch, argv):
+    # The options main passes on, from the command line
+    captured = {}
+
+    def run(graph, state, options, *args):
+        captured.update(options)
+        return set(graph), set()
+
+    monkeypatch.setattr(scheduler, 'run', run)
+    scheduler.main(['--labs', 'alt', '--steps', 'labs', '--state', '/dev/null/state.json'] + argv)
+    return captured
+
+
+def test_lab_options_reach_the_instance(monkeypatch):
+    parsed = options(monkeypatch, ['--trend-features', '--decoder', 'arrow', '--read-timelines', '--sample-fraction', '0.5'])
+    lab = scheduler.lab_instance('alt', parsed)
+    assert lab.trend_features and lab.decoder == 'arrow' and lab.read_timelines
+    assert 'lab_history' in str(lab.get_labs_pipeline()) and '$limit' not in lab.base_pipeline[0]
+
+
+def test_unset_options_keep_the_class_defaults(monkeypatch):
+    lab = scheduler.lab_instance('ast', options(monkeypatch, []))
+    assert (lab.trend_features, lab.decoder, lab.read_timelines) == (PreprocessedLabs.trend_features, PreprocessedLabs.decoder, PreprocessedLabs.read_timelines)
+    assert lab.get_history_pipeline() == lab.base_pipeline
+
+
+def test_decoder_choices(monkeypatch):
+    with pytest.raises(SystemExit):
+        options(monkeypatch, ['--decoder', 'json'])
+
+
+class Nodes:
+    # Stands in for run_node in a thread pool: records when nodes start and
+    # finish, and writes an output that only changes when asked to
+    def __init__(self, root, failures=None):
+        self.root = root
+        self.failures = dict(failures or {})
+        self.events = []
+        self.changed = set()
+
+    def output_dir(self, node):
+        return os.path.join(self.root, node.replace(':', '-'))
+
+    def __call__(self, node, options):
+        self.events.append(('start', node))
+        if self.failures.get(node):
+            self.failures[node] -= 1
+            self.events.append(('failed', node))
+            raise RuntimeError(node)
+        path = os.path.join(self.output_dir(node), 'part-00000.parquet')
+        os.makedirs(self.output_dir(node), exist_ok=True)
+        if not os.path.exists(path) or node in self.changed:
+            with open(path, 'a') as f:
+                f.write(node)
+        self.events.append(('done', node))
+        return scheduler.fingerprint(self.output_dir(node))
+
+    def started(self):
+        return [node for event, node in self.events if event == 'start']
+
+
+@pytest.fixture
+def nodes(tmp_path, monkeypatch):
+    nodes = Nodes(str(tmp_path / 'output'))
+    monkeypatch.setattr(scheduler, 'ProcessPoolExecutor', lambda workers, mp_context=None: ThreadPoolExecutor(workers))
+    monkeypatch.setattr(scheduler, 'run_node', nodes)
+    monkeypatch.setattr(scheduler, 'output_dir', nodes.output_dir)
+    return nodes
+
+
+def run(nodes, tmp_path, **kwargs):
+    graph = scheduler.build_graph(['alt', 'ast'], ['features'])
+    return graph, scheduler.run(graph, scheduler.State(str(tmp_path / 'state.json')), {}, workers=4, backoff=0, **kwargs)
+
+
+def test_nodes_run_after_their_upstream_nodes(nodes, tmp_path):
+    graph, (done, failed) = run(nodes, tmp_path)
+    assert done == set(graph) and not failed
+    for node, upstream in graph.items():
+        started = nodes.events.index(('start', node))
+        assert all(nodes.events.index(('done', parent)) < started for parent in upstream)
+    assert sorted(nodes.started()) == sorted(graph)
+
+
+def test_failed_nodes_are_retried(nodes, tmp_path):
+    nodes.failures = {'alt:labs': 2}
+    graph, (done, failed) = run(nodes, tmp_path, retries=2)
+    assert done == set(graph) and nodes.started().count('alt:labs') == 3
+    state = scheduler.State(str(tmp_path / 'state.json'))
+    assert all(record['status'] == 'done' for record in state.nodes.values())
+
+
+def test_failures_skip_only_descendants(nodes, tmp_path):
+    nodes.failures = {'alt:vitals': 3}
+    graph, (done, failed) = run(nodes, tmp_path, retries=1)
+    skipped = {'alt:clean_vitals', 'alt:features'}
+    assert failed == {'alt:vitals'} and done == set(graph) - skipped - failed
+    assert nodes.started().count('alt:vitals') == 2 and not skipped & set(nodes.started())
+    state = scheduler.State(str(tmp_path / 'state.json'))
+    assert state.nodes['alt:vitals']['status'] == 'failed' and not skipped & set(state.nodes)
+
+
+def test_runs_resume_from_the_state(nodes, tmp_path):
+    nodes.failures = {'alt:vitals': 2}
+    run(nodes, tmp_path, retries=1)
+    # The failed node and its descendants run; extraction always does, and
+    # an unchanged output leaves the rest up to date
+    nodes.events = []
+    graph, (done, failed) = run(nodes, tmp_path)
+    extraction = {node for node in graph if node.split(':')[1] in scheduler.EXTRACTION_STEPS}
+    assert done == set(graph) and set(nodes.started()) == extraction | {'alt:clean_vitals', 'alt:features'}
+    nodes.events = []
+    run(nodes, tmp_path)
+    assert set(nodes.started()) == extraction
+    # A changed output reruns what was built from it, as far as outputs change
+    nodes.events, nodes.changed = [], {'ast:labs'}
+    run(nodes, tmp_path)
+    assert set(nodes.started()) == extraction | {'ast:targets'}
+    nodes.events, nodes.changed = [], {'ast:labs', 'ast:targets'}
+    run(nodes, tmp_path)
+    assert set(nodes.started()) == extraction | {'ast:targets', 'ast:features'}
+    nodes.events, nodes.changed = [], set()
+    run(nodes, tmp_path, force={'alt:clean_demo'})
+    assert set(nodes.started()) == extraction | {'alt:clean_demo'}
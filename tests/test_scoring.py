@@ -0,0 +1,37 @@
+import pandas as pd
+from Preprecessed_UPDATED import ALTLab
+from scoring import FACETS, facet_pipelines
+from streaming_stats import StreamingStats, clean_parts, load_cleaning
+
+
+def test_facet_pipelines_ignore_the_sample():
+    lab = ALTLab(sample_fraction=0.1)
+    source = {'$match': {'PatientID': {'$in': ['p1', 'p2']}}}
+    pipelines = facet_pipelines(lab, source)
+    assert sorted(pipelines) == sorted(FACETS)
+    for facet, pipeline in pipelines.items():
+        assert pipeline[0] == source
+        assert pipeline[1:] == getattr(lab, 'get_%s_pipeline' % facet)()[1:]
+        assert 'sample_bucket' not in str(pipeline)
+
+
+def test_saved_cleaning_matches_the_cleaned_parts(tmp_path):
+    source, destination = tmp_path / 'vitals', tmp_path / 'vitals_clean'
+    source.mkdir()
+    vitals = pd.DataFrame({
+        'Practice': ['a', 'a', 'b', 'b', 'b'],
+        'bmi': [20.0, None, 60.0, 25.0, None],
+        'weight': [70.0, 80.0, None, 90.0, 100.0]
+    })
+    vitals.to_parquet(source / 'part-00000.parquet', index=False)
+    stats = StreamingStats(['bmi', 'weight'], [], 'Practice').update(vitals)
+    clean_parts(str(source), str(destination), stats, [('bmi', 10, 50)])
+    saved, filters = load_cleaning(str(destination))
+    assert filters == [('bmi', 10, 50)]
+    cleaned = pd.read_parquet(destination)
+    rows = pd.read_parquet(source)
+    for column in ('bmi', 'weight'):
+        rows[column] = rows[column].fillna(rows['Practice'].map(saved.medians(column)[0]))
+    rows = rows[rows['bmi'].between(10, 50)].reset_index(drop=True)
+    pd.testing.assert_frame_equal(cleaned.reset_index(drop=True), rows)
+    assert load_cleaning(str(source)) is None
@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+import numpy as np
+from search import ResultCache, fold_arrays, successive_halving
+
+
+def matrix():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(120, 4))
+    y = X[:, 0] * 2 + rng.normal(scale=0.1, size=120)
+    return SimpleNamespace(X=X, y=y, version='test')
+
+
+def folds():
+    order = np.arange(120)
+    return [(order[40:], order[:40]), (np.r_[order[:40], order[80:]], order[40:80])]
+
+
+def test_fold_arrays():
+    indices, bounds = fold_arrays(folds())
+    for (train, test), (start, middle, end) in zip(folds(), bounds):
+        assert np.array_equal(indices[start:middle], train)
+        assert np.array_equal(indices[middle:end], test)
+
+
+def test_successive_halving(tmp_path):
+    grid = {'max_depth': [1, 2, 4], 'min_samples_leaf': [1, 20, 60]}
+    best, history = successive_halving(matrix(), folds(), 'rf', grid, min_budget=2, max_budget=18, eta=3, max_workers=1, cache_dir=str(tmp_path))
+    budgets = [record['budget'] for record in history]
+    assert budgets.count(2) == 9 and budgets.count(6) == 3 and budgets.count(18) == 1
+    assert best == history[-1] and best['budget'] == 18
+    # Deep trees on the signal beat the stumps
+    assert best['params']['max_depth'] > 1
+
+
+def test_successive_halving_reuses_cached_scores(tmp_path):
+    grid = {'max_depth': [2, 4]}
+    first = successive_halving(matrix(), folds(), 'rf', grid, min_budget=2, max_budget=6, max_workers=1, cache_dir=str(tmp_path))
+    cached = list((tmp_path / 'test' / 'rf').glob('*.json'))
+    second = successive_halving(matrix(), folds(), 'rf', grid, min_budget=2, max_budget=6, max_workers=1, cache_dir=str(tmp_path))
+    assert first == second
+    assert sorted((tmp_path / 'test' / 'rf').glob('*.json')) == sorted(cached)
+    assert len(cached) == 2 * 2 + 1 * 2
+
+
+def test_result_cache(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    key = cache.key(model='rf', params={'a': 1}, fold=0)
+    assert key == cache.key(fold=0, params={'a': 1}, model='rf')
+    assert cache.get(key) is None
+    cache.put(key, {'rmse': 1.5})
+    assert cache.get(key) == {'rmse': 1.5}
@@ -0,0 +1,56 @@
+import datetime
+import numpy as np
+from sequences import export_sequences, sequence_pipeline
+from mongo_eval import run
+
+DAY = datetime.datetime(2020, 1, 1)
+
+
+class Lab:
+    name = 'alanine_aminotransferase'
+    batch_size = 2
+    base_pipeline = [{'$limit': 10}, {'$match': {'lab_results.api_test_name': {'$in': ['ALT']}}}]
+
+    def __init__(self, docs, output_dir):
+        self.docs = docs
+        self.output_dir = output_dir
+
+    def aggregate(self, pipeline):
+        return iter(run(pipeline, self.docs))
+
+
+def patient(i, medications):
+    return {
+        'PatientID': 'p%d' % i,
+        'lab_results': [{'date': DAY + datetime.timedelta(days=10 * i + j), 'api_test_name': 'ALT', 'result': str(20 + j), 'unit': 'U/L'} for j in range(i + 1)] + [{'date': DAY, 'api_test_name': 'Glucose', 'result': '5', 'unit': 'mmol/L'}],
+        'vitals': [],
+        'medications': medications,
+        'diagnosis': [{'date': DAY, 'icd_10': 'K70.1', 'status': 'Active'}, {'date': DAY, 'icd_10': 'E11.9', 'status': 'Resolved'}]
+    }
+
+
+def test_medication_dose_comes_from_sig_parsed():
+    docs = [patient(0, [
+        {'date': DAY, 'gpi': '2710', 'sig_parsed': {'dose_g': 0.5, 'frequency': 2, 'days': 30}},
+        {'date': DAY, 'gpi': '2720', 'sig_parsed': {'dose_g': 0.5, 'frequency': None, 'days': 30}},
+        {'date': DAY, 'gpi': '2730'}
+    ])]
+    doc, = run(sequence_pipeline({'ALT': 'alanine_aminotransferase'}), docs)
+    assert [med['dosage'] for med in doc['medications']] == [30, None, None]
+    assert [lab['name'] for lab in doc['lab_results']] == ['ALT']
+    assert [diag['icd_10'] for diag in doc['diagnosis']] == ['K70.1']
+
+
+def test_export_sequences(tmp_path):
+    docs = [patient(i, [{'date': DAY, 'gpi': '2710', 'sig_parsed': {'dose_g': 0.5, 'frequency': 2, 'days': 30}}]) for i in (3, 0, 4, 1, 2)]
+    store = export_sequences([Lab(docs, str(tmp_path))], str(tmp_path / 'sequences'))
+    assert list(store.patient_ids) == ['p%d' % i for i in range(5)]
+    assert store.lengths.tolist() == [i + 3 for i in range(5)]
+    events = store.get('p3')
+    names = [store.vocabulary[code] for code in events['codes']]
+    assert names.count('lab:alanine_aminotransferase') == 4
+    assert events['values'][names.index('gpi:27')] == 30
+    assert not np.isnan(store.values).any()
+    assert (np.diff(events['timestamps'].astype(np.int64)) >= 0).all()
+    batch = store.batch([0, 4], max_length=5)
+    assert batch['mask'].sum(axis=1).tolist() == [3, 5]
@@ -0,0 +1,23 @@
+import inspect
+import normalization
+import snapshots
+import trends
+from snapshots import code_digest, repo_modules
+
+
+def test_repo_modules_follow_imports():
+    assert sorted(repo_modules(trends)) == ['normalization', 'trends']
+    assert 'numpy' not in repo_modules(trends)
+
+
+def test_code_digest_covers_helper_modules(monkeypatch):
+    before = code_digest(trends.add_trends)
+    assert code_digest(trends.add_trends) == before
+    getsource = inspect.getsource
+
+    def edited(value):
+        source = getsource(value)
+        return source + '\nUNIT_FACTORS = {}\n' if value is normalization else source
+
+    monkeypatch.setattr(snapshots.inspect, 'getsource', edited)
+    assert code_digest(trends.add_trends) != before
@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from splits import SplitPlan, assign_folds, group_codes, temporal_holdout
+
+
+def matrix(rows=2000, patients=300, practices=12):
+    rng = np.random.default_rng(0)
+    patient = rng.integers(patients, size=rows)
+    start = np.datetime64('2015-01-01', 'ns')
+    return SimpleNamespace(
+        patient_ids=np.array(['p%d' % p for p in patient]),
+        practices=np.array(['practice%d' % (p % practices) for p in patient]),
+        dates=start + rng.integers(0, 3000, size=rows).astype('timedelta64[D]'),
+        version='test',
+        path=None
+    )
+
+
+@pytest.mark.parametrize('group_by', ['patient', 'practice'])
+def test_holdout_and_folds(group_by):
+    m = matrix()
+    plan = SplitPlan.build(m, group_by=group_by, n_splits=4)
+    assert len(plan.train) and len(plan.holdout)
+    assert not set(plan.train) & set(plan.holdout)
+    assert not set(m.patient_ids[plan.train]) & set(m.patient_ids[plan.holdout])
+    cutoff = np.datetime64(plan.meta['cutoff'])
+    assert (m.dates[plan.holdout] >= cutoff).all() and (m.dates[plan.train] < cutoff).all()
+    groups = m.patient_ids if group_by == 'patient' else m.practices
+    tested = []
+    for train, test in plan.folds:
+        assert len(train) and len(test)
+        assert not set(groups[train]) & set(groups[test])
+        tested.extend(test)
+    assert sorted(tested) == sorted(plan.train)
+
+
+def test_temporal_holdout_purges_patients():
+    dates = np.array(['2020-01-01', '2021-01-01', '2020-06-01', '2019-01-01'], dtype='datetime64[ns]')
+    codes = group_codes(['a', 'a', 'b', 'c'])
+    train, holdout, cutoff = temporal_holdout(dates, codes, cutoff='2020-12-01')
+    assert list(holdout) == [1] and list(train) == [2, 3]
+
+
+def test_assign_folds_keeps_groups_whole():
+    codes = group_codes(np.repeat(np.arange(50), 3))
+    folds = assign_folds(codes, 5)
+    assert len(set(folds)) == 5
+    for group in range(50):
+        assert len(set(folds[codes == group])) == 1
+
+
+def test_for_matrix_caches(tmp_path):
+    m = matrix()
+    m.path = str(tmp_path)
+    plan = SplitPlan.for_matrix(m, group_by='practice', n_splits=3)
+    again = SplitPlan.for_matrix(m, group_by='practice', n_splits=3)
+    assert np.array_equal(plan.train, again.train) and again.meta == plan.meta
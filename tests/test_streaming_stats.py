@@ -0,0 +1,102 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from streaming_stats import QuantileSketch, StreamingStats, clean_parts, collect_stats, load_cleaning, part_paths
+
+QS = np.linspace(0.01, 0.99, 99)
+
+
+def rank_error(sketch, values):
+    # Largest distance, as a fraction of n, between q and the rank of the
+    # value the sketch returns for q
+    values = np.sort(values)
+    ranks = np.array([np.searchsorted(values, sketch.quantile(q), side='right') for q in QS]) / len(values)
+    return np.abs(ranks - QS).max()
+
+
+@pytest.mark.parametrize('k', [100, 200])
+def test_rank_error_is_bounded(k):
+    values = np.random.default_rng(0).lognormal(size=200000)
+    sketch = QuantileSketch(k)
+    for chunk in np.array_split(values, 37):
+        sketch.update(chunk)
+    assert sketch.count == len(values)
+    assert rank_error(sketch, values) < 2 / k
+    # Memory stays O(k log n)
+    assert sum(len(items) for items in sketch.levels) < 3 * k * np.log2(len(values))
+
+
+def test_merge_is_associative():
+    rng = np.random.default_rng(1)
+    parts = [rng.normal(loc, size=n) for loc, n in ((0, 30000), (3, 50000), (-2, 20000))]
+    a, b, c = (QuantileSketch().update(part) for part in parts)
+    left = QuantileSketch().update(parts[0]).merge(QuantileSketch().update(parts[1])).merge(c)
+    right = a.merge(b.merge(c))
+    values = np.concatenate(parts)
+    assert left.count == right.count == len(values)
+    assert rank_error(left, values) < 0.01 and rank_error(right, values) < 0.01
+    np.testing.assert_allclose(left.quantiles(QS), right.quantiles(QS), atol=0.1)
+
+
+def test_empty_input():
+    sketch = QuantileSketch()
+    assert np.isnan(sketch.quantile(0.5))
+    sketch.update([]).update([np.nan, np.nan])
+    assert sketch.count == 0 and np.isnan(sketch.quantile(0.5))
+    other = QuantileSketch().update([1, 2, 3])
+    assert other.merge(QuantileSketch()).quantile(0.5) == 2
+    assert QuantileSketch().merge(other).quantile(0.5) == 2
+    stats = StreamingStats(['x'], ['y'], 'g').update(pd.DataFrame({'x': [], 'y': [], 'g': []}))
+    medians, overall = stats.medians('x')
+    assert medians == {} and np.isnan(overall)
+    assert stats.modes('y') == ({}, None)
+
+
+def test_sketch_round_trips_through_json():
+    sketch = QuantileSketch(50).update(np.arange(10000))
+    again = QuantileSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+    assert again.quantiles(QS) == sketch.quantiles(QS)
+    again.update([1]), sketch.update([1])
+    assert again.quantiles(QS) == sketch.quantiles(QS)
+
+
+def frame():
+    return pd.DataFrame({
+        'practice': ['a', 'a', 'a', 'b', 'b', 'c'],
+        'bmi': [20, 22, np.nan, 30, 70, np.nan],
+        'gender': ['F', 'F', None, 'M', None, None]
+    })
+
+
+def test_stats_by_group_fall_back_to_overall():
+    stats = StreamingStats(['bmi'], ['gender'], 'practice').update(frame().iloc[:3]).merge(StreamingStats(['bmi'], ['gender'], 'practice').update(frame().iloc[3:]))
+    medians, overall = stats.medians('bmi')
+    assert medians == {'a': 22, 'b': 70} or medians == {'a': 20, 'b': 30}
+    assert overall in (22, 30)
+    modes, overall = stats.modes('gender')
+    assert modes == {'a': 'F', 'b': 'M'} and overall == 'F'
+
+
+def test_clean_parts(tmp_path):
+    source, destination = str(tmp_path / 'vitals'), str(tmp_path / 'vitals_clean')
+    os.makedirs(source)
+    df = frame()
+    df.iloc[:3].to_parquet(os.path.join(source, 'part-00000.parquet'), index=False)
+    df.iloc[3:].to_parquet(os.path.join(source, 'part-00001.parquet'), index=False)
+    stats = collect_stats(source, ['bmi'], ['gender'], 'practice')
+    kept, dropped = clean_parts(source, destination, stats, [('bmi', 10, 50)])
+    assert (kept, dropped) == (5, 1)
+    cleaned = pd.concat([pd.read_parquet(part) for part in part_paths(destination)], ignore_index=True)
+    assert not cleaned[['bmi', 'gender']].isna().any().any()
+    assert cleaned.loc[cleaned['practice'] == 'c', 'gender'].tolist() == ['F']
+    saved, filters = load_cleaning(destination)
+    assert filters == [('bmi', 10, 50)] and saved.modes('gender') == stats.modes('gender')
+    # A rerun replaces the parts, and an empty source leaves none
+    os.remove(os.path.join(source, 'part-00001.parquet'))
+    clean_parts(source, destination, stats)
+    assert len(part_paths(destination)) == 1
+    os.remove(os.path.join(source, 'part-00000.parquet'))
+    assert clean_parts(source, destination, stats) == (0, 0) and not part_paths(destination)
+    assert load_cleaning(str(tmp_path)) is None
@@ -0,0 +1,31 @@
+from Preprecessed_UPDATED import ALTLab
+
+
+class Lab(ALTLab):
+    rows = []
+
+    def run_aggregator(self, pipeline, facet):
+        # What run_chunks leaves behind
+        self.clear_facet(facet)
+        self.write_batch(self.rows, facet, 0)
+
+
+def test_run_sweep_counts_per_window(tmp_path):
+    lab = Lab()
+    lab.output_dir = str(tmp_path)
+    lab.rows = [
+        {'PatientID': 'a', 'window_min_days': 80, 'window_max_days': 101, 'pairs': 2},
+        {'PatientID': 'b', 'window_min_days': 80, 'window_max_days': 101, 'pairs': 1},
+        {'PatientID': 'a', 'window_min_days': 30, 'window_max_days': 60, 'pairs': 1}
+    ]
+    counts = lab.run_sweep([(80, 101), (30, 60), (200, 300)])
+    assert counts[['patients', 'pairs']].values.tolist() == [[2, 3], [1, 1], [0, 0]]
+
+
+def test_run_sweep_without_rows(tmp_path):
+    lab = Lab()
+    lab.output_dir = str(tmp_path)
+    counts = lab.run_sweep([(80, 101), (30, 60)])
+    assert counts[['window_min_days', 'window_max_days']].values.tolist() == [[80, 101], [30, 60]]
+    assert counts[['patients', 'pairs']].values.tolist() == [[0, 0], [0, 0]]
+    assert lab.read_output('sweep').empty
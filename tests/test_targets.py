@@ -0,0 +1,72 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from targets import BinEdges, TARGET_COLUMNS, apply_bins, build_targets, compute_targets, fit_edges
+from streaming_stats import part_paths
+
+
+@pytest.fixture(autouse=True)
+def artifact_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(BinEdges, 'artifact_dir', str(tmp_path / 'bin_edges'))
+
+
+def pairs(before, after):
+    return pd.DataFrame({
+        'lab_before.value': before,
+        'lab_after.value': after,
+        'lab_before.date': pd.Timestamp('2020-01-01'),
+        'lab_after.date': pd.Timestamp('2020-04-01')
+    })
+
+
+def write_parts(path, *frames):
+    os.makedirs(path, exist_ok=True)
+    for i, frame in enumerate(frames):
+        frame.to_parquet(os.path.join(path, 'part-%05d.parquet' % i), index=False)
+    return str(path)
+
+
+def test_targets():
+    df = compute_targets(pairs([20.0, 0.0, np.nan], [30.0, 10.0, 5.0]))
+    assert df['delta'].tolist()[:2] == [10.0, 10.0] and np.isnan(df['delta'][2])
+    assert df['ratio'][0] == 1.5 and np.isnan(df['ratio'][1])
+    assert (df['days_between'] == 91).all()
+
+
+def test_empty_labs_keep_the_target_schema(tmp_path):
+    df = compute_targets(pd.DataFrame())
+    assert df.empty and {'delta', 'ratio', 'days_between'} <= set(df.columns)
+    labs = write_parts(tmp_path / 'labs', pd.DataFrame())
+    edges = fit_edges(labs, 'albumin')
+    assert edges.rows == 0 and edges.edges == {column: [] for column in TARGET_COLUMNS}
+    build_targets(labs, str(tmp_path / 'targets'), edges)
+    targets = pd.read_parquet(part_paths(str(tmp_path / 'targets'))[0])
+    assert targets.empty and 'lab_after.value.bin' in targets.columns
+
+
+def test_apply_bins():
+    df = apply_bins(pd.DataFrame({'x': [0.5, 1.0, 2.5, 9.0, np.nan]}), {'x': [1, 2, 3]})
+    # Edges are closed on the left and the outer bins are open
+    assert df['x.bin'].tolist() == [0, 1, 2, 3, -1]
+    assert df['x.bin'].dtype == np.int8
+
+
+def test_edges_are_versioned(tmp_path):
+    labs = write_parts(tmp_path / 'labs', pairs(np.arange(100.0), np.arange(100.0) * 2), pairs(np.arange(100.0), np.arange(100.0)))
+    first = fit_edges(labs, 'albumin', n_bins=4)
+    assert first.version == 1 and first.rows == 200
+    assert first.edges['lab_after.value'] == sorted(first.edges['lab_after.value']) and len(first.edges['delta']) <= 3
+    # Identical edges keep their version; new edges get the next one
+    assert fit_edges(labs, 'albumin', n_bins=4).version == 1
+    assert fit_edges(labs, 'albumin', n_bins=5).version == 2
+    assert BinEdges.versions('albumin', 'quantile') == [1, 2]
+    loaded = BinEdges.load('albumin', 'quantile', 1)
+    assert (loaded.edges, loaded.rows, loaded.fingerprint) == (first.edges, 200, first.fingerprint)
+    assert BinEdges.load('albumin', 'quantile').version == 2
+    assert BinEdges.load('albumin', 'clinical') is None
+    clinical = fit_edges(labs, 'albumin', method='clinical')
+    assert clinical.version == 1 and clinical.rows is None
+    build_targets(labs, str(tmp_path / 'targets'), loaded)
+    targets = pd.concat([pd.read_parquet(part) for part in part_paths(str(tmp_path / 'targets'))])
+    assert (targets['bin_edges.version'] == 1).all() and targets['lab_after.value.bin'].nunique() == 4
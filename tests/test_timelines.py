@@ -0,0 +1,225 @@
+import datetime
+from types import SimpleNamespace
+import pytest
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+from Preprecessed_UPDATED import ALTLab, AlbuminLab
+from equivalence import compare_outputs
+from optimizer import canonical
+from timelines import HISTORY_LOST, PAIR_STAGES, STATE_COLLECTION, TimelineConsumer, change_pipeline, pair_stages, timeline_collection, timeline_definition, timeline_pipeline
+from test_optimizer import patients as optimizer_patients
+from mongo_eval import match, run
+
+ALT = 'Alanine aminotransferase (ALT) measurement'
+
+
+def patient(i, *labs):
+    return {
+        '_id': ObjectId(),
+        'PatientID': 'p%d' % i,
+        'Practice': 'a',
+        'sample_bucket': i,
+        'lab_results': [{'api_test_name': name, 'date': date, 'result': '30', 'unit': 'U/L', 'range': '5-40'} for name, date in labs],
+        'vitals': []
+    }
+
+
+def patients():
+    first = datetime.datetime(2020, 1, 1)
+    return [
+        patient(0, (ALT, first), (ALT, first + datetime.timedelta(days=90)), (ALT, first + datetime.timedelta(days=200))),
+        patient(1, (ALT, first), (ALT, first + datetime.timedelta(days=10))),
+        patient(2, (ALT, first), (ALT, None), (ALT, '2020-04-01'), ('Glucose', first)),
+        patient(3, ('Glucose', first), ('Glucose', first + datetime.timedelta(days=90))),
+        patient(4)
+    ]
+
+
+@pytest.mark.parametrize('trend_features', [False, True])
+def test_timelines_hold_the_pairs_of_the_base_pipeline(trend_features):
+    lab = ALTLab(trend_features=trend_features)
+    pipeline = timeline_pipeline(lab, 'r1')
+    assert pipeline[-1]['$merge']['into'] == 'lab_timelines.%s' % lab.name
+    docs = patients()
+    timelines = {doc['_id']: doc for doc in run(pipeline[:-1], docs)}
+    # Through the $size match that keeps documents with a pair
+    pairs = run(lab.base_pipeline[1:8], docs)
+    assert len(pairs) == 1
+    for doc in pairs:
+        timeline = timelines[doc['_id']]
+        assert canonical(timeline['valid_labs']) == canonical(doc['valid_labs'])
+        assert (timeline['sample_bucket'], timeline['refresh']) == (0, 'r1')
+    # Documents without a pair keep their labs; those without the analyte
+    # have no timeline
+    assert [(timeline['PatientID'], len(timeline['labs']), len(timeline['valid_labs'])) for timeline in timelines.values()] == [('p0', 3, 2), ('p1', 2, 0), ('p2', 3, 0)]
+
+
+def test_pair_stages_check_the_base_pipeline():
+    lab = AlbuminLab()
+    assert [next(iter(stage)) for stage in pair_stages(lab)] == [operator for operator, _ in PAIR_STAGES]
+    lab.base_pipeline = lab.base_pipeline[:1] + lab.base_pipeline[2:]
+    with pytest.raises(ValueError):
+        pair_stages(lab)
+
+
+def update(fields=None, removed=(), truncated=()):
+    return {
+        'operationType': 'update',
+        'documentKey': {'_id': 1},
+        'updateDescription': {
+            'updatedFields': fields or {},
+            'removedFields': list(removed),
+            'truncatedArrays': [{'field': field, 'newSize': 0} for field in truncated]
+        }
+    }
+
+
+def test_change_pipeline_keeps_changes_to_timeline_fields():
+    events = {
+        'insert': {'operationType': 'insert', 'documentKey': {'_id': 1}},
+        'delete': {'operationType': 'delete', 'documentKey': {'_id': 1}},
+        'lab': update({'lab_results.12': {'api_test_name': ALT}}),
+        'lab_field': update({'lab_results.3.result': '40'}),
+        'labs': update({'lab_results': []}),
+        'practice': update({'Practice': 'b'}),
+        'removed': update(removed=['sample_bucket']),
+        'truncated': update(truncated=['lab_results']),
+        'vitals': update({'vitals.0.result': '21'}),
+        'prefix': update({'lab_results_count': 3, 'PatientIDs': []}),
+        'removed_other': update(removed=['Active_Meds']),
+        'truncated_other': update(truncated=['diagnosis']),
+        'drop': {'operationType': 'drop'}
+    }
+    for name, event in events.items():
+        event['name'] = name
+    kept = run(change_pipeline()[:1], list(events.values()))
+    assert [event['name'] for event in kept] == ['insert', 'delete', 'lab', 'lab_field', 'labs', 'practice', 'removed', 'truncated']
+    assert run(change_pipeline(), kept[:1]) == [{'documentKey': {'_id': 1}}]
+
+
+class Served(ALTLab):
+    # The patient collection and the timelines in memory
+    use_snapshots = False
+    batch_size = 50
+    chunk_size = 40
+
+    def __init__(self, collections, output_dir, **options):
+        super().__init__(**options)
+        self.collections = collections
+        self.output_dir = output_dir
+        self.collection = SimpleNamespace(name='patients')
+        self.db = {name: SimpleNamespace(name=name) for name in collections}
+        self.db[STATE_COLLECTION] = SimpleNamespace(find_one=lambda query: {'definition': timeline_definition(self), 'version': 1})
+
+    def aggregate(self, pipeline, raw=False, collection=None):
+        return iter(run(pipeline, self.collections[collection or 'patients'], self.collections))
+
+    def read_collection(self, name=None):
+        docs = self.collections[name or 'patients']
+        return SimpleNamespace(count_documents=lambda query: sum(match(query, doc) for doc in docs))
+
+
+def served(tmp_path, first_stage, trend_features=False):
+    docs = optimizer_patients(200, seed=2)
+    for doc in docs:
+        for lab in doc['lab_results']:
+            if isinstance(lab['result'], int):
+                lab['result'] = str(lab['result'])
+    lab = ALTLab(sample_fraction=0.5 if first_stage == 'sample' else None)
+    timelines = run(timeline_pipeline(lab, 'r1')[:-1], docs)
+    collections = {'patients': docs, timeline_collection(lab).name: timelines}
+    labs = []
+    for read_timelines in (False, True):
+        lab = Served(collections, str(tmp_path / str(read_timelines)), sample_fraction=0.5 if first_stage == 'sample' else None, trend_features=trend_features)
+        if first_stage == 'limit':
+            lab.base_pipeline[0] = {'$limit': 120}
+        lab.read_timelines = read_timelines
+        labs.append(lab)
+    return labs, timelines
+
+
+@pytest.mark.parametrize('first_stage, trend_features', [('limit', False), ('limit', True), ('sample', False)])
+def test_facets_read_from_the_timelines(tmp_path, first_stage, trend_features):
+    (patients_lab, timelines_lab), _ = served(tmp_path, first_stage, trend_features)
+    for facet in ('labs', 'diagnosis', 'medications'):
+        getattr(patients_lab, 'run_aggregator_%s' % facet)()
+        getattr(timelines_lab, 'run_aggregator_%s' % facet)()
+        differences, summary = compare_outputs(patients_lab.facet_dir(facet), timelines_lab.facet_dir(facet), work_dir=str(tmp_path))
+        assert summary['equal'] and summary['patients_left'], (facet, differences.head().to_dict('records'))
+
+
+@pytest.mark.parametrize('first_stage', ['limit', 'sample'])
+def test_timelines_of_another_cohort_fail(tmp_path, first_stage):
+    (_, lab), timelines = served(tmp_path, first_stage)
+    # Timelines outside the cohort do not matter
+    ids = sorted(doc['_id'] for doc in lab.collections['patients'])
+    outside = [timeline for timeline in timelines if (timeline['_id'] > ids[119] if first_stage == 'limit' else not match(lab.base_pipeline[0]['$match'], timeline))]
+    timelines.remove(outside[0])
+    lab.run_aggregator_labs()
+    inside = [timeline for timeline in timelines if timeline not in outside]
+    timelines.remove(inside[0])
+    with pytest.raises(ValueError, match='refresh'):
+        lab.run_aggregator_labs()
+
+
+@pytest.fixture
+def replica_set(mongo_client, mongo_db):
+    if 'setName' not in mongo_client.admin.command('hello'):
+        pytest.skip('change streams need a replica set')
+    return mongo_db
+
+
+def poll(consumer, tries=20):
+    for _ in range(tries):
+        refreshed = consumer.poll()
+        if refreshed:
+            return refreshed
+    return 0
+
+
+def test_consumer_keeps_the_timelines_up_to_date(replica_set, monkeypatch):
+    lab = ALTLab()
+    lab.db, lab.collection = replica_set, replica_set.patients
+    docs = patients()
+    replica_set.patients.insert_many(docs)
+    timelines, states = timeline_collection(lab), replica_set[STATE_COLLECTION]
+
+    def version():
+        return states.find_one({'_id': lab.name})['version']
+
+    consumer = TimelineConsumer([lab], batch_size=100, max_delay=0.2).start()
+    assert sorted(timeline['PatientID'] for timeline in timelines.find()) == ['p0', 'p1', 'p2']
+    assert version() == 1
+    # A new pair is picked up; a change to other fields is not
+    first = datetime.datetime(2021, 1, 1)
+    replica_set.patients.update_one({'_id': docs[1]['_id']}, {'$push': {'lab_results': {'$each': [{'api_test_name': ALT, 'date': first + datetime.timedelta(days=days), 'result': '30', 'unit': 'U/L', 'range': '5-40'} for days in (0, 90)]}}})
+    assert poll(consumer) == 1
+    assert len(timelines.find_one({'_id': docs[1]['_id']})['valid_labs']) == 2 and version() == 2
+    replica_set.patients.update_one({'_id': docs[3]['_id']}, {'$set': {'vitals': [{'name': 'bmi'}]}})
+    assert poll(consumer, 3) == 0 and version() == 2
+    consumer.close()
+    # A restarted consumer resumes from the saved token without a rebuild
+    replica_set.patients.delete_one({'_id': docs[0]['_id']})
+    consumer = TimelineConsumer([lab], batch_size=100, max_delay=0.2).start()
+    assert version() == 2 and timelines.find_one({'_id': docs[0]['_id']}) is not None
+    assert poll(consumer) == 1 and version() == 3
+    assert timelines.find_one({'_id': docs[0]['_id']}) is None
+    consumer.close()
+    # A token the oplog no longer holds rebuilds the timelines
+    opened = []
+    open_stream = TimelineConsumer.open
+
+    def open_lost(self, token=None):
+        opened.append(token)
+        if token is not None:
+            raise OperationFailure('resume point lost', code=HISTORY_LOST)
+        return open_stream(self)
+
+    monkeypatch.setattr(TimelineConsumer, 'open', open_lost)
+    before = version()
+    timelines.delete_many({})
+    consumer = TimelineConsumer([lab], batch_size=100, max_delay=0.2).start()
+    assert opened[0] is not None and opened[-1] is None
+    assert version() == before + 1
+    assert sorted(timeline['PatientID'] for timeline in timelines.find()) == ['p1', 'p2']
+    consumer.close()
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import make_pipeline
+from trees import CompiledEnsemble, check_equal, compile_model
+
+
+def data(rows=600, features=6, missing=0.1):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(rows, features)).astype(np.float32)
+    y = X[:, 0] * 3 + np.sin(X[:, 1]) + rng.normal(scale=0.1, size=rows)
+    X[rng.random(X.shape) < missing] = np.nan
+    return X, y
+
+
+def models():
+    yield RandomForestRegressor(n_estimators=20, min_samples_leaf=3, random_state=0)
+    yield make_pipeline(SimpleImputer(strategy='median'), GradientBoostingRegressor(n_estimators=30, random_state=0))
+    yield make_pipeline(SimpleImputer(strategy='median'), RandomForestRegressor(n_estimators=10, max_depth=14, random_state=0))
+
+
+@pytest.mark.parametrize('model', list(models()), ids=['rf', 'gb', 'rf-deep'])
+def test_compiled_predictions_are_bit_exact(model):
+    X, y = data()
+    model.fit(X, y)
+    result = check_equal(model, compile_model(model), X)
+    assert result['equal'], result
+
+
+def test_compiled_xgboost_is_bit_exact():
+    xgboost = pytest.importorskip('xgboost')
+    X, y = data()
+    model = xgboost.XGBRegressor(n_estimators=30, max_depth=5, random_state=0).fit(X, y)
+    result = check_equal(model, compile_model(model), X)
+    assert result['equal'], result
+
+
+def test_save_and_load(tmp_path):
+    X, y = data(missing=0)
+    model = RandomForestRegressor(n_estimators=5, random_state=0).fit(X, y)
+    compiled = compile_model(model)
+    compiled.save(str(tmp_path / 'model.npz'))
+    loaded = CompiledEnsemble.load(str(tmp_path / 'model.npz'))
+    assert np.array_equal(loaded.predict(X), model.predict(X))
@@ -0,0 +1,48 @@
+import pandas as pd
+from Preprecessed_UPDATED import ALTLab, AlbuminLab, ASTLab
+from trends import TREND_FEATURES, add_trends
+
+
+def test_trend_features_is_a_constructor_argument():
+    plain, trend = ALTLab(), ALTLab(trend_features=True)
+    assert not plain.trend_features and trend.trend_features and not ALTLab.trend_features
+    # Only the labs facets carry the history
+    assert trend.base_pipeline == plain.base_pipeline and 'lab_results' not in str(trend.base_pipeline[6])
+    assert len(trend.get_history_pipeline()) == len(plain.get_history_pipeline()) + 1
+    assert 'lab_history' in str(trend.get_history_pipeline()[-1]) and 'lab_history' not in str(plain.get_history_pipeline())
+    for facet in ('diagnosis', 'vitals', 'medications'):
+        assert getattr(trend, 'get_%s_pipeline' % facet)() == getattr(plain, 'get_%s_pipeline' % facet)()
+    assert trend.parameters()['trend_features'] and not plain.parameters()['trend_features']
+
+
+def test_timeline_pipelines_carry_the_history_of_the_labs_facet():
+    lab = ALTLab(trend_features=True)
+    labs = lab.get_timeline_pipeline(lab.get_labs_pipeline())
+    assert 'lab_history' in str(labs[:5]) and labs[3]['$replaceWith']['$mergeObjects'][1]['lab_results'] == '$labs'
+    diagnosis = lab.get_timeline_pipeline(lab.get_diagnosis_pipeline())
+    assert 'lab_results' not in str(diagnosis[3]) and 'lab_history' not in str(diagnosis)
+
+
+def test_co_measurements_reduce_the_history():
+    lab = ASTLab(trend_features=True)
+    assert 'lab_history' in str(lab.get_co_measurement_pipeline([ALTLab(), AlbuminLab()]))
+    assert add_trends in lab.batch_stages['co_measurements']
+
+
+def test_add_trends_replaces_the_history():
+    df = pd.DataFrame({
+        'lab_before.api_test_name': ['alanine_aminotransferase', 'alanine_aminotransferase'],
+        'lab_before.date': pd.to_datetime(['2020-06-01', '2020-06-01']),
+        'lab_history': [
+            [
+                {'date': pd.Timestamp('2020-01-01'), 'result': '30', 'unit': 'U/L', 'range': '5-40'},
+                {'date': pd.Timestamp('2020-03-01'), 'result': '50', 'unit': 'U/L', 'range': '5-40'}
+            ],
+            []
+        ]
+    })
+    out = add_trends(df)
+    assert 'lab_history' not in out
+    assert set(TREND_FEATURES) <= set(out.columns)
+    assert out['trend.count'].tolist() == [2, 0]
+    assert out['trend.max'].iloc[0] == 50
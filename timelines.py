@@ -0,0 +1,298 @@
+import argparse
+import copy
+import logging
+import time
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+from snapshots import digest
+
+# One side collection per analyte, <TIMELINE_COLLECTION>.<lab name>, holding a
+# timeline per patient document under the document's own _id
+TIMELINE_COLLECTION = 'lab_timelines'
+STATE_COLLECTION = 'lab_timelines_state'
+
+# Only changes to these fields of a patient document can change its timeline
+TIMELINE_FIELDS = ['lab_results', 'PatientID', 'Practice', 'sample_bucket']
+
+# Operator and computed field of each pair selection stage of the base
+# pipeline, in order
+PAIR_STAGES = [
+    ('$match', 'lab_results.api_test_name'),
+    ('$set', 'lab_results'),
+    ('$project', 'lab_results'),
+    ('$project', 'lab_results'),
+    ('$addFields', 'valid_labs')
+]
+
+# A resume token older than the oplog can no longer be resumed from
+HISTORY_LOST = 286
+
+logger = logging.getLogger('timelines')
+
+
+def timeline_collection(lab):
+    return lab.db['%s.%s' % (TIMELINE_COLLECTION, lab.name)]
+
+
+def pair_stages(lab):
+    # Pair selection of the base pipeline, the stages after the sample stage:
+    # match, analyte mapping, filter, sort and reduce. They are checked by
+    # operator and field, so that a change to the base pipeline fails here
+    # rather than writing wrong timelines. Filter and sort keep sample_bucket
+    stages = copy.deepcopy(lab.base_pipeline[1:1 + len(PAIR_STAGES)])
+    expected = len(stages) == len(PAIR_STAGES) and all(operator in stage and field in stage[operator] for stage, (operator, field) in zip(stages, PAIR_STAGES))
+    if not expected:
+        raise ValueError('Stages 1-%d of the base pipeline of %s are not the pair selection %s' % (len(PAIR_STAGES), lab.name, PAIR_STAGES))
+    for stage in stages:
+        if '$project' in stage:
+            stage['$project']['sample_bucket'] = 1
+    return stages
+
+
+def timeline_pipeline(lab, refresh):
+    # Pair selection of the base pipeline shaped into a timeline and merged
+    # into the side collection: the analyte's labs newest first and the pair
+    # as valid_labs. Every timeline written by one run carries the same
+    # refresh id
+    return pair_stages(lab) + [
+        {
+            '$project': {
+                'PatientID': 1, 
+                'Practice': 1, 
+                'sample_bucket': 1, 
+                'labs': {
+                    '$map': {
+                        'input': '$lab_results', 
+                        'as': 'lab', 
+                        'in': {
+                            'date': '$$lab.date', 
+                            'result': '$$lab.result', 
+                            'unit': '$$lab.unit', 
+                            'range': '$$lab.range'
+                        }
+                    }
+                }, 
+                'valid_labs': '$valid_labs.valid_labs', 
+                'refresh': {
+                    '$literal': refresh
+                }
+            }
+        }, {
+            '$merge': {
+                'into': timeline_collection(lab).name, 
+                'on': '_id', 
+                'whenMatched': 'replace', 
+                'whenNotMatched': 'insert'
+            }
+        }
+    ]
+
+
+def timeline_definition(lab):
+    # Changes with the analyte's test names and the pair window
+    return digest(timeline_pipeline(lab, None))
+
+
+def refresh_timelines(lab, ids=None):
+    # Recomputes the timelines of the given patient documents, or of all of
+    # them, on the server. Timelines of documents that were deleted or lost
+    # their last lab of the analyte are not rewritten, and are removed
+    refresh = ObjectId()
+    match = [] if ids is None else [{'$match': {'_id': {'$in': list(ids)}}}]
+    lab.collection.aggregate(match + timeline_pipeline(lab, refresh), allowDiskUse=True)
+    stale = {'refresh': {'$ne': refresh}}
+    if ids is not None:
+        stale['_id'] = {'$in': list(ids)}
+    timeline_collection(lab).delete_many(stale)
+
+
+def create_timeline_indexes(lab):
+    # The sample stages of the base pipeline run against the timelines as is
+    timelines = timeline_collection(lab)
+    timelines.create_index([('sample_bucket', 1)])
+    timelines.create_index([('Practice', 1), ('sample_bucket', 1)])
+
+
+def timeline_version(lab):
+    # Part of the snapshot key of facets read from the timelines
+    state = lab.db[STATE_COLLECTION].find_one({'_id': lab.name})
+    return None if state is None else {'definition': state['definition'], 'version': state['version']}
+
+
+def change_pipeline():
+    # Inserts, replacements and deletions, and updates that touch a timeline
+    # field; the consumer only needs the _id of the changed document
+    return [
+        {
+            '$match': {
+                '$or': [
+                    {
+                        'operationType': {
+                            '$in': ['insert', 'replace', 'delete']
+                        }
+                    }, {
+                        'operationType': 'update', 
+                        '$expr': {
+                            '$anyElementTrue': [
+                                {
+                                    '$map': {
+                                        'input': {
+                                            '$concatArrays': [
+                                                {
+                                                    '$map': {
+                                                        'input': {
+                                                            '$objectToArray': '$updateDescription.updatedFields'
+                                                        }, 
+                                                        'as': 'field', 
+                                                        'in': '$$field.k'
+                                                    }
+                                                }, 
+                                                '$updateDescription.removedFields', 
+                                                {
+                                                    '$ifNull': [
+                                                        '$updateDescription.truncatedArrays.field', []
+                                                    ]
+                                                }
+                                            ]
+                                        }, 
+                                        'as': 'path', 
+                                        'in': {
+                                            '$regexMatch': {
+                                                'input': '$$path', 
+                                                'regex': '^(%s)(\\.|$)' % '|'.join(TIMELINE_FIELDS)
+                                            }
+                                        }
+                                    }
+                                }
+                            ]
+                        }
+                    }
+                ]
+            }
+        }, {
+            '$project': {
+                'documentKey': 1
+            }
+        }
+    ]
+
+
+class TimelineConsumer:
+    # Keeps the timelines of the given labs up to date from one change stream
+    # on the patient collection. Changed documents are gathered into batches
+    # and their timelines recomputed; the resume token is saved with every
+    # applied batch, so a restarted consumer continues where it stopped.
+    # Labs without a saved state, or whose definition changed, are rebuilt
+    # after the stream is opened, so no change is missed while they build.
+    # Needs a replica set; a single-node one is enough
+    def __init__(self, labs, batch_size=1000, max_delay=1.0):
+        self.labs = labs
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.collection = labs[0].collection
+        self.states = labs[0].db[STATE_COLLECTION]
+        self.stream = None
+
+    def open(self, token=None):
+        options = {'max_await_time_ms': int(self.max_delay * 1000)}
+        if token is not None:
+            options['resume_after'] = token
+        return self.collection.watch(change_pipeline(), **options)
+
+    def start(self):
+        states = {lab.name: self.states.find_one({'_id': lab.name}) for lab in self.labs}
+        current = [lab for lab in self.labs if states[lab.name] is not None and states[lab.name]['definition'] == timeline_definition(lab)]
+        tokens = {digest(states[lab.name]['token']) for lab in current}
+        if len(tokens) != 1:
+            current = []
+        self.stream = None
+        if current:
+            try:
+                self.stream = self.open(states[current[0].name]['token'])
+            except OperationFailure as error:
+                if error.code != HISTORY_LOST:
+                    raise
+                logger.warning('resume token is no longer in the oplog, rebuilding')
+                self.stream, current = None, []
+        if self.stream is None:
+            self.stream = self.open()
+        for lab in self.labs:
+            if lab not in current:
+                start = time.time()
+                create_timeline_indexes(lab)
+                refresh_timelines(lab)
+                logger.info('%s timelines rebuilt in %.1fs', lab.name, time.time() - start)
+        self.save([lab for lab in self.labs if lab not in current])
+        return self
+
+    def save(self, changed):
+        # The version counts the batches applied to a lab's timelines, so it
+        # only moves when they may have changed; the token always moves
+        token = self.stream.resume_token
+        for lab in self.labs:
+            self.states.update_one({'_id': lab.name}, {
+                '$set': {
+                    'definition': timeline_definition(lab), 
+                    'token': token
+                }, 
+                '$inc': {
+                    'version': int(lab in changed)
+                }
+            }, upsert=True)
+
+    def poll(self):
+        # Reads changes until batch_size documents are pending or the stream
+        # stays idle for max_delay, then applies them. Returns the number of
+        # documents whose timelines were recomputed
+        ids, first = {}, None
+        while len(ids) < self.batch_size and self.stream.alive:
+            event = self.stream.try_next()
+            if event is None:
+                break
+            ids[digest(event['documentKey']['_id'])] = event['documentKey']['_id']
+            first = first or time.time()
+            if time.time() - first >= self.max_delay:
+                break
+        if not self.stream.alive:
+            # The collection was dropped or renamed
+            raise RuntimeError('change stream on %s was invalidated' % self.collection.name)
+        if ids:
+            for lab in self.labs:
+                refresh_timelines(lab, ids.values())
+            logger.info('%d documents refreshed', len(ids))
+        self.save(self.labs if ids else [])
+        return len(ids)
+
+    def run(self, stop=None):
+        # Until stop (a threading.Event) is set
+        self.start()
+        try:
+            while stop is None or not stop.is_set():
+                self.poll()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+
+def main(argv=None):
+    from scheduler import LABS
+    parser = argparse.ArgumentParser(description='Keep the lab timelines of the patient collection up to date.')
+    parser.add_argument('--labs', nargs='+', choices=sorted(LABS), default=sorted(LABS))
+    parser.add_argument('--batch-size', type=int, default=1000, help='changed documents refreshed together')
+    parser.add_argument('--max-delay', type=float, default=1.0, help='seconds a change may wait for its batch')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild every timeline before consuming changes')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    labs = [LABS[name]() for name in args.labs]
+    if args.rebuild:
+        labs[0].db[STATE_COLLECTION].delete_many({'_id': {'$in': [lab.name for lab in labs]}})
+    TimelineConsumer(labs, args.batch_size, args.max_delay).run()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
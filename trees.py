@@ -0,0 +1,235 @@
+import json
+import time
+import numpy as np
+from sklearn.dummy import DummyRegressor
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+
+
+class TreeArrays:
+    # All trees of an ensemble in flat node arrays. Nodes are renumbered
+    # breadth-first so the children of a split are adjacent: a row moves to
+    # child[node] + (x > threshold). Leaves are their own child with an
+    # infinite threshold, so every (row, tree) pair can take the same number
+    # of steps without branching
+    def __init__(self):
+        self.feature, self.threshold, self.child, self.missing_left, self.value, self.roots = [], [], [], [], [], []
+        self.nodes = 0
+        self.depth = 0
+
+    def add(self, feature, threshold, left, right, value, missing_left):
+        order, frontier = [], np.zeros(1, dtype=np.int64)
+        while len(frontier):
+            order.append(frontier)
+            split = frontier[left[frontier] >= 0]
+            frontier = np.column_stack([left[split], right[split]]).ravel()
+        self.depth = max(self.depth, len(order) - 1)
+        order = np.concatenate(order)
+        index = np.empty(len(left), dtype=np.int64)
+        index[order] = np.arange(len(order))
+        leaf = left[order] < 0
+        self.roots.append(self.nodes)
+        self.feature.append(np.where(leaf, 0, feature[order]).astype(np.intp))
+        self.threshold.append(np.where(leaf, np.inf, threshold[order]).astype(np.float64))
+        self.child.append(np.where(leaf, np.arange(len(order)), index[left[order]]) + self.nodes)
+        self.missing_left.append(np.where(leaf, True, missing_left[order]).astype(bool))
+        self.value.append(np.asarray(value, dtype=np.float64)[order])
+        self.nodes += len(order)
+
+    def arrays(self):
+        return {
+            'feature': np.concatenate(self.feature),
+            'threshold': np.concatenate(self.threshold),
+            'child': np.concatenate(self.child).astype(np.intp),
+            'missing_left': np.concatenate(self.missing_left),
+            'value': np.concatenate(self.value),
+            'roots': np.asarray(self.roots, dtype=np.intp),
+            'depth': self.depth
+        }
+
+
+class CompiledEnsemble:
+    # Predicts base + sum(scale * leaf) over trees (divided by the tree count for
+    # forests), accumulating tree by tree in the order and precision of the
+    # source library so the output is bit-identical
+    chunk_size = 1 << 16
+    compact_depth = 10
+
+    def __init__(self, feature, threshold, child, missing_left, value, roots, depth, base=0.0, scale=1.0, average=False, dtype=np.float64, preprocess=None):
+        self.feature = feature
+        self.threshold = threshold
+        self.child = child
+        self.leaf = child == np.arange(len(child))
+        self.missing_left = missing_left
+        self.value = value.astype(dtype)
+        self.roots = roots
+        self.depth = int(depth)
+        self.base = base
+        self.scale = scale
+        self.average = average
+        self.dtype = dtype
+        self.preprocess = preprocess
+
+    def apply(self, X):
+        # Level-synchronous descent of all trees at once, laid out tree-major so
+        # each tree's leaves end up contiguous. In deep forests, pairs that
+        # reached a leaf are dropped once they are the majority
+        n, trees = len(X), len(self.roots)
+        node = np.repeat(self.roots, n)
+        offset = np.tile(np.arange(n, dtype=np.intp) * X.shape[1], trees)
+        values = X.ravel()
+        missing = np.isnan(values).any()
+        pairs, current = None, node
+        for _ in range(self.depth):
+            x = values[offset + self.feature[current]]
+            # x > threshold is False for NaN, which sends missing values left
+            go_right = x > self.threshold[current]
+            if missing:
+                go_right |= np.isnan(x) & ~self.missing_left[current]
+            current = self.child[current] + go_right
+            if self.depth < self.compact_depth:
+                continue
+            inner = ~self.leaf[current]
+            if inner.sum() * 2 < len(current):
+                if pairs is None:
+                    node, pairs = current, np.flatnonzero(inner)
+                else:
+                    node[pairs] = current
+                    pairs = pairs[inner]
+                current, offset = current[inner], offset[inner]
+        if pairs is None:
+            node = current
+        else:
+            node[pairs] = current
+        return node.reshape(trees, n)
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        if isinstance(self.preprocess, np.ndarray):
+            X = np.where(np.isnan(X), self.preprocess, X)
+        elif self.preprocess is not None:
+            X = self.preprocess.transform(X)
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        out = np.empty(len(X), dtype=self.dtype)
+        rows = max(1, self.chunk_size // len(self.roots))
+        for start in range(0, len(X), rows):
+            leaves = self.value[self.apply(X[start:start + rows])]
+            if self.scale != 1:
+                leaves *= self.scale
+            chunk = np.full(leaves.shape[1], self.base, dtype=self.dtype)
+            for tree in leaves:
+                chunk += tree
+            if self.average:
+                chunk /= len(leaves)
+            out[start:start + rows] = chunk
+        return out
+
+    def save(self, path):
+        np.savez(
+            path,
+            feature=self.feature, threshold=self.threshold, child=self.child,
+            missing_left=self.missing_left, value=self.value, roots=self.roots,
+            meta=json.dumps({'depth': self.depth, 'base': self.base, 'scale': self.scale, 'average': self.average, 'dtype': np.dtype(self.dtype).str})
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            meta = json.loads(str(arrays['meta']))
+            meta['dtype'] = np.dtype(meta['dtype'])
+            return cls(*[arrays[name] for name in ('feature', 'threshold', 'child', 'missing_left', 'value', 'roots')], **meta)
+
+
+def sklearn_trees(estimators):
+    trees = TreeArrays()
+    for estimator in estimators:
+        tree = estimator.tree_
+        if tree.n_outputs != 1:
+            raise ValueError('Only single-output trees can be compiled')
+        # Older scikit-learn has no missing value support; NaN then fails
+        # x <= threshold and goes right
+        missing_left = getattr(tree, 'missing_go_to_left', np.zeros(tree.node_count, dtype=bool))
+        trees.add(tree.feature, tree.threshold, tree.children_left, tree.children_right, tree.value[:, 0, 0], np.asarray(missing_left, dtype=bool))
+    return trees.arrays()
+
+
+def xgboost_trees(booster):
+    # The JSON model keeps thresholds and leaf weights as exact float32 values;
+    # a leaf's weight is stored in its split_conditions slot. XGBoost goes left
+    # on x < threshold in float32, which for float32 x is x <= the next float32
+    # below the threshold
+    model = json.loads(booster.save_raw('json'))['learner']
+    trees = TreeArrays()
+    for tree in model['gradient_booster']['model']['trees']:
+        if int(tree['tree_param'].get('size_leaf_vector', 1)) > 1 or tree.get('categories_nodes'):
+            raise ValueError('Vector-leaf and categorical trees cannot be compiled')
+        conditions = np.asarray(tree['split_conditions'], dtype=np.float32)
+        left = np.asarray(tree['left_children'])
+        trees.add(
+            np.asarray(tree['split_indices']), np.nextafter(conditions, np.float32(-np.inf)), left, np.asarray(tree['right_children']),
+            np.where(left < 0, conditions, 0), np.asarray(tree['default_left'], dtype=bool)
+        )
+    base_score = model['learner_model_param']['base_score'].strip('[]').split(',')
+    if len(base_score) != 1 or model['objective']['name'] not in ('reg:squarederror', 'reg:absoluteerror', 'reg:pseudohubererror'):
+        raise ValueError('Only single-target identity-link XGBoost regressors can be compiled')
+    return trees.arrays(), float(np.float32(base_score[0]))
+
+
+def compile_model(model):
+    preprocess = None
+    if isinstance(model, Pipeline):
+        preprocess, model = model[:-1], model[-1]
+        # A lone median/mean imputer reduces to filling NaN with its float32
+        # statistics, which skips the per-call validation of transform
+        imputer = preprocess[0]
+        if len(preprocess) == 1 and isinstance(imputer, SimpleImputer) and not imputer.add_indicator and imputer.missing_values is np.nan and not np.isnan(imputer.statistics_).any():
+            preprocess = imputer.statistics_.astype(np.float32)
+    if isinstance(model, RandomForestRegressor):
+        return CompiledEnsemble(**sklearn_trees(model.estimators_), average=True, preprocess=preprocess)
+    if isinstance(model, GradientBoostingRegressor):
+        if isinstance(model.init_, DummyRegressor):
+            base = float(np.ravel(model.init_.constant_)[0])
+        elif model.init_ == 'zero':
+            base = 0.0
+        else:
+            raise ValueError('Only constant init estimators can be compiled')
+        return CompiledEnsemble(**sklearn_trees(model.estimators_[:, 0]), base=base, scale=model.learning_rate, preprocess=preprocess)
+    if type(model).__module__.startswith('xgboost'):
+        arrays, base = xgboost_trees(model.get_booster())
+        return CompiledEnsemble(**arrays, base=base, dtype=np.float32, preprocess=preprocess)
+    raise ValueError('Cannot compile %s' % type(model).__name__)
+
+
+def check_equal(model, compiled, X):
+    # Exact comparison, not a tolerance: the compiled predictor must reproduce
+    # the library's float bits on the extracted feature matrix
+    expected = model.predict(X)
+    actual = compiled.predict(X)
+    mismatched = np.flatnonzero(expected != actual)
+    return {
+        'rows': len(X),
+        'mismatched': len(mismatched),
+        'max_abs_diff': float(np.max(np.abs(expected - actual))) if len(X) else 0.0,
+        'equal': not len(mismatched)
+    }
+
+
+def benchmark(model, compiled, X, batch_sizes=(1, 10, 100, 1000, 10000), repeats=20):
+    results = []
+    for batch_size in batch_sizes:
+        batch = np.ascontiguousarray(X[:batch_size])
+        timings = {}
+        for name, predictor in (('library', model), ('compiled', compiled)):
+            predictor.predict(batch)
+            started = time.perf_counter()
+            for _ in range(repeats):
+                predictor.predict(batch)
+            timings[name] = (time.perf_counter() - started) / repeats * 1000
+        results.append({
+            'batch_size': len(batch),
+            'library_ms': timings['library'],
+            'compiled_ms': timings['compiled'],
+            'speedup': timings['library'] / timings['compiled']
+        })
+    return results
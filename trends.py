@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+from normalization import explode_records, normalize_values, parse_ranges
+
+# Number of most recent history labs in the rolling mean and variance
+RECENT_LABS = 3
+
+TREND_FEATURES = [
+    'trend.count',
+    'trend.slope',
+    'trend.recent_mean',
+    'trend.recent_var',
+    'trend.min',
+    'trend.max',
+    'trend.days_since_abnormal'
+]
+
+
+def add_trends(df):
+    # Fixed-width statistics of the labs before lab_before.date, computed for
+    # all pairs of a batch at once from the exploded lab_history column. The
+    # slope is in normalized units per year; abnormal means outside the
+    # reference range of the lab itself
+    if 'lab_history' not in df.columns:
+        return df
+    if df['lab_history'].isna().all():
+        # The Arrow decoder fills the column with nulls when the pipeline
+        # carried no history (PreprocessedLabs.trend_features off)
+        return df.drop(columns=['lab_history'])
+    history = explode_records(df['lab_history']).reindex(columns=['date', 'result', 'unit', 'range'])
+    row = pd.Index(df.index).get_indexer(history.index)
+    measurement = df['lab_before.api_test_name'].to_numpy(dtype=object)[row]
+    value, _, factor, _ = normalize_values(measurement, history['result'], history['unit'])
+    low, high = parse_ranges(history['range'])
+    before = pd.to_datetime(df['lab_before.date']).to_numpy(dtype='datetime64[ns]')
+    days = (before[row] - pd.to_datetime(history['date']).to_numpy(dtype='datetime64[ns]')) / np.timedelta64(1, 'D')
+    labs = pd.DataFrame({
+        'row': row,
+        'days': days,
+        'value': value,
+        'abnormal': (value < low * factor) | (value > high * factor)
+    })
+    labs = labs[labs['value'].notna() & labs['days'].notna()].sort_values(['row', 'days'], kind='stable')
+    trends = pd.DataFrame(index=np.arange(len(df)), columns=TREND_FEATURES, dtype=float)
+    trends['trend.count'] = np.bincount(labs['row'], minlength=len(df))
+    groups = labs.groupby('row')
+    trends['trend.min'] = groups['value'].min()
+    trends['trend.max'] = groups['value'].max()
+    # Least squares slope against time, centred per pair
+    dx = (groups['days'].transform('mean').to_numpy() - labs['days'].to_numpy()) / 365.25
+    dy = labs['value'].to_numpy() - groups['value'].transform('mean').to_numpy()
+    sxx = np.bincount(labs['row'], dx * dx, minlength=len(df))
+    sxy = np.bincount(labs['row'], dx * dy, minlength=len(df))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trends['trend.slope'] = np.where(sxx > 0, sxy / sxx, np.nan)
+    # Sorted by days since the lab, so the first rows of a pair are the latest
+    recent = labs[groups.cumcount() < RECENT_LABS].groupby('row')['value']
+    trends['trend.recent_mean'] = recent.mean()
+    trends['trend.recent_var'] = recent.var()
+    trends['trend.days_since_abnormal'] = labs[labs['abnormal']].groupby('row')['days'].min()
+    df = df.drop(columns=['lab_history'])
+    for column in TREND_FEATURES:
+        df[column] = trends[column].to_numpy()
+    return df